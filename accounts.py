@@ -0,0 +1,52 @@
+import firebase
+from attachments import release_updates, release_all_updates, schedule_sweep
+from changelog import change_updates, record_changes
+from mailindex import delivered_copies, location_updates
+from search import unindex_many_updates
+
+# Removal of a deleted account's data, run as a background job (see jobs.py).
+# The user record itself is removed by the request so the account is gone at
+# once; everything else is found through the per-user indexes instead of
+# scanning folders.
+DELETE_BATCH_SIZE = 500
+
+# Per-user nodes dropped wholesale once the copies in other mailboxes are gone.
+# The indexes go last so a failed run can simply be started again.
+ACCOUNT_NODES = ("inbox", "sent", "drafts", "search_index", "changes", "notifications",
+                 "mail_index", "deliveries")
+
+
+def delete_account_data(user_key, progress, batch_size=DELETE_BATCH_SIZE):
+    """Delete a user's mail everywhere in batched multi-path updates"""
+    # Copies of the user's sent mail in other users' inboxes. Their owners'
+    # mail and search indexes are updated and their clients get tombstones.
+    delivered = delivered_copies(user_key)
+    progress.update(done=0, total=len(delivered) + 1, message="Removing delivered mail")
+
+    done = 0
+    for start in range(0, len(delivered), batch_size):
+        updates = {}
+        tombstones = {}
+        by_receiver = {}
+        for receiver_key, mail_id in delivered[start:start + batch_size]:
+            updates[f"inbox/{receiver_key}/{mail_id}"] = None
+            updates.update(location_updates(receiver_key, "inbox", mail_id, present=False))
+            tombstones.update(change_updates(receiver_key, "delete", "inbox", mail_id))
+            by_receiver.setdefault(receiver_key, []).append(mail_id)
+        # One keyed read of the index docs and one of the attachments per receiver
+        for receiver_key, mail_ids in by_receiver.items():
+            updates.update(unindex_many_updates(receiver_key, mail_ids))
+            updates.update(release_updates(receiver_key, mail_ids))
+        firebase.ref.update(updates)
+        record_changes(tombstones)
+        done += len(delivered[start:start + batch_size])
+        progress.update(done=done)
+
+    progress.update(message="Removing mailbox")
+    updates = release_all_updates(user_key)
+    updates.update({f"{node}/{user_key}": None for node in ACCOUNT_NODES})
+    firebase.ref.update(updates)
+    progress.update(done=done + 1, message="Account data deleted")
+    # Files only this account referenced are orphans now
+    schedule_sweep()
+    return {'delivered_removed': len(delivered)}
@@ -1,15 +1,44 @@
-from flask import Flask, render_template, request, redirect, session, flash, jsonify, send_from_directory
+from flask import (Flask, render_template, request, redirect, session, flash, jsonify, send_from_directory,
+                   send_file, Response, g)
 from datetime import datetime, timedelta
 import firebase
+from profiles import get_profile, prime_profile, invalidate_profile, profile_cache_stats
+from mailstore import (FOLDERS, page_size, new_timestamps,
+                       now_ms, push_key_floor, legacy_timestamp_ms, format_time, categorize_mail,
+                       enhance_email_data, build_mailbox_view)
+from changelog import SYNC_SETTLE_MS, initial_cursor, read_changes, summarize_changes, latest_change_key
+from events import hub, stream_changes
+from avatars import (engine as avatar_engine, avatar_blobs, avatar_initials, store_avatar, load_avatar,
+                     profile_pic_url)
+from mailindex import rebuild_mail_index
+from accounts import delete_account_data
+from jobs import start_job, get_job
+from attachments import (AttachmentTooLarge, MAX_UPLOAD_BYTES, ATTACHMENT_SENDFILE, store_uploads,
+                         attachment_path, accel_path, sweep_orphans)
+from notifications import (dispatcher as notifications, invalidate_settings as invalidate_notification_settings,
+                           settings_cache_stats as notification_settings_stats)
+from ratelimit import limiter
+from fanout import Fanout, fanout_stats
+from metrics import (registry as metrics_registry, cache_samples, REQUEST_LATENCY, MESSAGES_PER_REQUEST,
+                     READ_CACHE_LOOKUPS)
+import readcache
+from directory import directory, backfill_user_directory, AUTOCOMPLETE_LIMIT, MAX_AUTOCOMPLETE_LIMIT
+from storage import storage
+from search import search_mail, rebuild_search_index
 import re
 import random
-import os
-from PIL import Image, ImageDraw, ImageFont
-from werkzeug.utils import secure_filename
+import mimetypes
 import time
+import logging
+import os
+from PIL import Image
 import secrets
 from functools import wraps
+import click
+from migrations import backfill_timestamps, recategorize_mail, migrate_profile_pictures
 app = Flask(__name__)
+# Debug output (session dumps, per-message traces) only with LOG_LEVEL=DEBUG
+app.logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 app.permanent_session_lifetime = timedelta(days=60)  # Session expires after 60 days
 
 # Configure session security
@@ -17,9 +46,39 @@ app.config.update(
     SESSION_COOKIE_SECURE=True if os.environ.get('HTTPS') == 'true' else False,
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE='Lax',
-    PERMANENT_SESSION_LIFETIME=timedelta(days=60)
+    PERMANENT_SESSION_LIFETIME=timedelta(days=60),
+    MAX_CONTENT_LENGTH=MAX_UPLOAD_BYTES,  # Larger requests are refused before the body is read
+    USE_X_SENDFILE=ATTACHMENT_SENDFILE == "x-sendfile"
 )
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=request.endpoint or "unmatched",
+                                method=request.method, status=response.status_code)
+    return response
+
+# Repeated reads of a path within one request are served from memory (see readcache)
+@app.before_request
+def open_read_cache():
+    readcache.start()
+
+@app.teardown_request
+def close_read_cache(error=None):
+    cache = readcache.stop()
+    if cache is None or not cache.reads:
+        return
+    endpoint = request.endpoint or "unmatched"
+    READ_CACHE_LOOKUPS.inc(cache.saved, endpoint=endpoint, outcome="hit")
+    READ_CACHE_LOOKUPS.inc(cache.reads - cache.saved, endpoint=endpoint, outcome="miss")
+    if cache.saved:
+        app.logger.info("%s %s: read cache saved %d of %d reads", request.method, request.path, cache.saved, cache.reads)
+
 @app.before_request
 def make_session_permanent():
     session.permanent = True
@@ -37,33 +96,19 @@ def make_session_permanent():
 
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-key-change-in-production')
 
-# Rate limiting storage
-request_counts = {}
 CSRF_SECRET_KEY = os.environ.get('CSRF_SECRET_KEY', secrets.token_urlsafe(32))
 
-# Rate limiting decorator
+# Rate limiting decorator; each decorated route has its own limit per user (or IP)
 def rate_limit(max_requests=10, per_seconds=60):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
             user_id = session.get('user_email', request.remote_addr)
-            current_time = time.time()
-            
-            # Clean old entries
-            if user_id in request_counts:
-                request_counts[user_id] = [
-                    timestamp for timestamp in request_counts[user_id]
-                    if current_time - timestamp < per_seconds
-                ]
-            else:
-                request_counts[user_id] = []
-            
-            # Check rate limit
-            if len(request_counts[user_id]) >= max_requests:
-                return jsonify({'error': 'Rate limit exceeded. Please wait a moment.'}), 429
-            
-            # Add current request
-            request_counts[user_id].append(current_time)
+            allowed, retry_after = limiter.hit(f.__name__, user_id, max_requests, per_seconds)
+            if not allowed:
+                response = jsonify({'error': 'Rate limit exceeded. Please wait a moment.'})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, 429
             return f(*args, **kwargs)
         return decorated_function
     return decorator
@@ -85,11 +130,14 @@ def inject_csrf_token():
 
 # Updated domain from @bharatmail.free.nf to @bharatmail.in for custom domain
 EMAIL_SUFFIX = "@bharatmail.in"
+
+# Bulk delete goes out as one multi-path update; ids end up in database paths
+MAX_BULK_DELETE = 1000
+MAIL_ID_PATTERN = re.compile(r"^[^.$#\[\]/]{1,768}$")
 UPLOAD_FOLDER = "static/profile_pics"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 
-from PIL import Image, ImageDraw, ImageFont
 # Avatar background colors
 AVATAR_COLORS = [
     "#FF5733", "#33A1FF", "#28A745", "#FFC300",
@@ -103,257 +151,14 @@ def is_valid_username(username):
 def suggest_email(username):
     return f"{username}{random.randint(10, 99)}{EMAIL_SUFFIX}"
 
-def categorize_mail(subject, message):
-    subject_lower = subject.lower() if subject else ""
-    message_lower = message.lower() if message else ""
-    # Placeholder keywords for categorization
-    promotions_keywords = ["sale", "discount", "offer", "deal", "promo"]
-    social_keywords = ["friend", "party", "social", "invite", "like", "comment"]
-    updates_keywords = ["update", "news", "alert", "notification", "reminder"]
-
-    if any(word in subject_lower or word in message_lower for word in promotions_keywords):
-        return "Promotions"
-    elif any(word in subject_lower or word in message_lower for word in social_keywords):
-        return "Social"
-    elif any(word in subject_lower or word in message_lower for word in updates_keywords):
-        return "Updates"
-    else:
-        return "Inbox"
-
 def get_user_avatar_data(email):
     """Get user avatar data (initials, color, avatar image)"""
-    if not email:
-        return {
-            'initials': 'U',
-            'avatar_color': '#666666',
-            'avatar': None
-        }
-    
-    try:
-        user_key = email.replace(".", ",")
-        user_data = firebase.ref.child("users").child(user_key).get()
-        
-        if user_data:
-            first_name = user_data.get('first_name', '').strip()
-            last_name = user_data.get('last_name', '').strip()
-            
-            # Generate initials
-            if first_name and last_name:
-                initials = (first_name[0] + last_name[0]).upper()
-            elif first_name:
-                initials = first_name[:2].upper()
-            elif last_name:
-                initials = last_name[:2].upper()
-            else:
-                initials = email[:2].upper()
-            
-            # Generate consistent background color based on email
-            colors = ['#FF5733', '#33A1FF', '#28A745', '#FFC300', '#8E44AD', '#FF69B4', '#20B2AA', '#FF4500']
-            color_index = sum(ord(c) for c in email) % len(colors)
-            
-            return {
-                'initials': initials,
-                'avatar_color': colors[color_index],
-                'avatar': user_data.get('profile_pic'),
-                'name': f"{first_name} {last_name}".strip() or email.split('@')[0].replace('.', ' ').title()
-            }
-    except Exception as e:
-        print(f"Error getting user avatar data for {email}: {e}")
-    
-    # Fallback
-    return {
-        'initials': email[:2].upper() if email else 'U',
-        'avatar_color': '#666666',
-        'avatar': None,
-        'name': email.split('@')[0].replace('.', ' ').title() if email else 'Unknown'
-    }
-
-def format_time(timestamp_str):
-    """Format timestamp for display"""
-    try:
-        if not timestamp_str:
-            return "Unknown"
-        
-        # Parse timestamp - handle microseconds and different formats
-        if 'T' in timestamp_str:
-            # ISO format - remove microseconds if present
-            timestamp_str = timestamp_str.split('.')[0] if '.' in timestamp_str else timestamp_str
-            dt = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-        else:
-            # Legacy format - handle microseconds
-            if '.' in timestamp_str:
-                timestamp_str = timestamp_str.split('.')[0]
-            try:
-                dt = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                # Try other possible formats
-                try:
-                    dt = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S.%f')
-                except ValueError:
-                    # If all parsing fails, return original
-                    return timestamp_str
-        
-        now = datetime.now()
-        diff = now - dt.replace(tzinfo=None) if dt.tzinfo else now - dt
-        
-        if diff.days == 0:
-            if diff.seconds < 3600:  # Less than 1 hour
-                minutes = diff.seconds // 60
-                return f"{minutes}m ago" if minutes > 0 else "Just now"
-            else:
-                hours = diff.seconds // 3600
-                return f"{hours}h ago"
-        elif diff.days == 1:
-            return "Yesterday"
-        elif diff.days < 7:
-            return f"{diff.days}d ago"
-        else:
-            return dt.strftime('%b %d')
-            
-    except Exception as e:
-        print(f"Error formatting time {timestamp_str}: {e}")
-        return "Unknown"
-
-def parse_timestamp_for_sorting(timestamp_str):
-    """Parse timestamp for sorting purposes - returns datetime object"""
-    try:
-        if not timestamp_str:
-            return datetime.min
-        
-        # Parse timestamp - handle microseconds and different formats
-        if 'T' in timestamp_str:
-            # ISO format - remove microseconds if present
-            timestamp_str = timestamp_str.split('.')[0] if '.' in timestamp_str else timestamp_str
-            return datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-        else:
-            # Legacy format - handle microseconds
-            if '.' in timestamp_str:
-                timestamp_str = timestamp_str.split('.')[0]
-            try:
-                return datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                # Try other possible formats
-                try:
-                    return datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S.%f')
-                except ValueError:
-                    # If all parsing fails, return minimum datetime
-                    print(f"Warning: Could not parse timestamp for sorting: {timestamp_str}")
-                    return datetime.min
-            
-    except Exception as e:
-        print(f"Error parsing timestamp for sorting {timestamp_str}: {e}")
-        return datetime.min
-
-def enhance_email_data(mail, current_email, category=None):
-    """Enhance email data with avatar, name, and formatted time"""
-    try:
-        # Add formatted time
-        mail['formatted_time'] = format_time(mail.get('timestamp'))
-        
-        # Add message preview
-        message = mail.get('message', '')
-        mail['message_preview'] = message[:100] + '...' if len(message) > 100 else message
-        
-        # Add category if provided
-        if category:
-            mail['category'] = category
-        
-        # Always get sender data
-        sender_email = mail.get('sender')
-        if sender_email:
-            sender_data = get_user_avatar_data(sender_email)
-            mail['sender_name'] = sender_data['name']
-            mail['sender_initials'] = sender_data['initials']
-            mail['sender_avatar_color'] = sender_data['avatar_color']
-            mail['sender_avatar'] = sender_data['avatar']
-        
-        # Always get receiver data
-        receiver_email = mail.get('receiver')
-        if receiver_email:
-            receiver_data = get_user_avatar_data(receiver_email)
-            mail['receiver_name'] = receiver_data['name']
-            mail['receiver_initials'] = receiver_data['initials']
-            mail['receiver_avatar_color'] = receiver_data['avatar_color']
-            mail['receiver_avatar'] = receiver_data['avatar']
-        
-    except Exception as e:
-        print(f"Error enhancing email data: {e}")
-    
-    return mail
+    return get_profile(email)
 
-def generate_avatar(first_name, last_name, font_path="DejaVuSans-Bold.ttf"):
-    import base64
-    from io import BytesIO
-    
-    initials = ((first_name[0] if first_name else "") + (last_name[0] if last_name else "")).upper()
-    if not initials.strip():
-        initials = "U"
-
-    bg_color = random.choice(AVATAR_COLORS)
-    # Create high-resolution image for better quality
-    img_size = 400  # Increased from 120 to 400 for better quality
-    img = Image.new("RGB", (img_size, img_size), bg_color)
-    draw = ImageDraw.Draw(img)
-
-    # Add subtle gradient effect
-    
-    # Create a subtle inner shadow/gradient effect
-    overlay = Image.new('RGBA', (img_size, img_size), (0, 0, 0, 0))
-    overlay_draw = ImageDraw.Draw(overlay)
-    
-    # Add a subtle vignette effect
-    for i in range(20):
-        alpha = int(255 * (i / 20) * 0.1)  # Very subtle
-        overlay_draw.ellipse(
-            [i, i, img_size-i, img_size-i], 
-            outline=None, 
-            fill=(0, 0, 0, alpha)
-        )
-    
-    img = Image.alpha_composite(img.convert('RGBA'), overlay).convert('RGB')
-    draw = ImageDraw.Draw(img)
-
-    # Dynamically pick the largest font size that fits well
-    fontsize = int(img_size * 0.4)  # Adjusted proportion for larger image
-    font = None
-    while fontsize > 40:  # Minimum font size increased
-        try:
-            font = ImageFont.truetype(font_path, fontsize)
-        except:
-            font = ImageFont.load_default()
-            break
-        bbox = draw.textbbox((0, 0), initials, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        # Leave appropriate padding
-        if text_width < img_size * 0.7 and text_height < img_size * 0.7:
-            break
-        fontsize -= 8  # Larger steps for efficiency
-
-    # Center the text with better positioning
-    bbox = draw.textbbox((0, 0), initials, font=font)
-    w = bbox[2] - bbox[0]
-    h = bbox[3] - bbox[1]
-    x = (img_size - w) / 2
-    y = (img_size - h) / 2 - (bbox[1] / 2)  # Adjust for font baseline
-    
-    # Add text shadow for depth
-    shadow_offset = 2
-    draw.text((x + shadow_offset, y + shadow_offset), initials, fill=(0, 0, 0, 30), font=font)
-    
-    # Draw main text
-    draw.text((x, y), initials, fill="white", font=font)
-
-    # Apply anti-aliasing by resizing if needed
-    if img_size > 200:
-        img = img.resize((200, 200), Image.Resampling.LANCZOS)
-
-    # Convert to base64 data URL for cloud deployment compatibility
-    buffer = BytesIO()
-    img.save(buffer, format='PNG', quality=95)
-    img_data = buffer.getvalue()
-    img_base64 = base64.b64encode(img_data).decode('utf-8')
-    return f"data:image/png;base64,{img_base64}"
+def generate_avatar(first_name, last_name):
+    """Initials avatar with a random background; returns its hash in the avatar store"""
+    initials = avatar_initials(first_name, last_name)
+    return store_avatar(avatar_engine.render(initials, random.choice(AVATAR_COLORS)))
 
 
 # ---------------- Routes ----------------
@@ -375,23 +180,26 @@ def register():
             return redirect("/register")
 
         email = f"{username}{EMAIL_SUFFIX}"
-        if firebase.ref.child("users").child(email.replace(".", ",")).get():
+        if storage.user_exists(email.replace(".", ",")):
             suggested = suggest_email(username)
             flash(f"Email already taken! Try: {suggested}")
             return redirect("/register")
 
-        avatar_url = generate_avatar(first_name, last_name)
+        avatar_hash = generate_avatar(first_name, last_name)
 
-        firebase.ref.child("users").child(email.replace(".", ",")).set({
+        storage.create_user(email.replace(".", ","), {
             "first_name": first_name,
             "last_name": last_name,
             "username": username,
             "email": email,
             "password": password,
             "phone": "",
-            "profile_pic": avatar_url,
+            "avatar_hash": avatar_hash,
             "created_at": str(datetime.now())
         })
+        # Drop any cached "unknown address" entry for the new user
+        invalidate_profile(email)
+        directory.put(email, first_name, last_name)
 
         flash(f"Registration successful! Your email is {email}")
         return redirect("/login")
@@ -412,39 +220,29 @@ def login():
             email = f"{email_or_username}{EMAIL_SUFFIX}"
 
         email_key = email.replace(".", ",")
-        user = firebase.ref.child("users").child(email_key).get()
+        user = storage.get_user(email_key)
 
         if user:
             if user['password'] == password:
                 if not add_mode:
                     # Normal login clears everything
-                    print(f"\n=== NORMAL LOGIN ===")
-                    print(f"Clearing session and logging in: {email}")
+                    app.logger.debug("Normal login, clearing session: %s", email)
                     session.clear()
                     session['user_email'] = email
                     accounts = [email]  # Start fresh with just this account
                     session['accounts'] = accounts
-                    print(f"Session after normal login: {dict(session)}")
                     flash(f"Welcome {user['first_name']}! You are now logged in as {email}")
                 else:
                     # Add account mode - preserve existing sessions
-                    print(f"\n=== ADD ACCOUNT MODE ===")
                     current_user = session.get('user_email')
-                    print(f"Current user before adding: {current_user}")
-                    print(f"Session before adding account: {dict(session)}")
-                    print(f"Adding account: {email}")
+                    app.logger.debug("Adding account %s (current user: %s)", email, current_user)
                     
                     session['user_email'] = email  # Switch to new account immediately
                     accounts = session.get('accounts', [])
-                    print(f"Existing accounts: {accounts}")
                     if email not in accounts:
                         accounts.append(email)
-                        print(f"Added {email} to accounts list")
-                    else:
-                        print(f"{email} already in accounts list")
                     session['accounts'] = accounts
-                    print(f"Final accounts list: {accounts}")
-                    print(f"Session after adding account: {dict(session)}")
+                    app.logger.debug("Accounts in session: %s", accounts)
                     
                     if current_user:
                         flash(f"Account {email} added successfully! You are now using {email}. You can switch back to {current_user} anytime.")
@@ -459,6 +257,18 @@ def login():
 
     return render_template("login.html", add_mode=add_mode)
 
+def search_inbox_page(user_key, query, limit):
+    """Inbox page of the best search matches, best first - the index returns ranked ids, only those are read
+
+    Reads through its own Fanouts, so call it from the request thread.
+    """
+    hits = search_mail(user_key, query, folders=("inbox",), limit=limit)
+    return {
+        'messages': storage.get_messages("inbox", user_key, [mail_id for _, mail_id, _ in hits]),
+        'next': None,
+        'has_more': False
+    }
+
 @app.route("/inbox")
 def inbox():
     current_email = session.get('user_email')
@@ -466,152 +276,51 @@ def inbox():
         return redirect("/login")
 
     user_key = current_email.replace(".", ",")
-    user = firebase.ref.child("users").child(user_key).get()
-
-    # Fetch received messages from the user's inbox
-    inbox_ref = firebase.ref.child("inbox").child(current_email.replace(".", ",")).get() or {}
-    messages = []
-    for key, m in inbox_ref.items():
-        if m.get('receiver') == current_email:
-            m['id'] = key
-            messages.append(m)
-    
-    # Categorize mails and enhance with avatar data
-    categorized_mails = {
-        "Inbox": [],
-        "Promotions": [],
-        "Social": [],
-        "Updates": []
-    }
-    
-    # Categorize and enhance messages
-    enhanced_messages = []
-    for mail in messages:
-        # Categorize first
-        category = categorize_mail(mail.get("subject", ""), mail.get("message", ""))
-        # Then enhance with category
-        enhanced_mail = enhance_email_data(mail, current_email, category)
-        enhanced_messages.append(enhanced_mail)
-    
-    # Debug: Print first few timestamps to see the format
-    if enhanced_messages:
-        print(f"\n=== TIMESTAMP DEBUG ===")
-        for i, msg in enumerate(enhanced_messages[:3]):
-            print(f"Message {i+1}: {msg.get('timestamp')} -> {msg.get('formatted_time')}")
-        print(f"=== END TIMESTAMP DEBUG ===\n")
-    
-    # Sort enhanced messages by timestamp (newest first)
-    try:
-        enhanced_messages.sort(key=lambda x: parse_timestamp_for_sorting(x.get('timestamp')), reverse=True)
-        print(f"Sorted {len(enhanced_messages)} messages by timestamp")
-        
-        # Debug: Show first few sorted messages
-        if enhanced_messages:
-            print(f"\n=== SORTED MESSAGES DEBUG ===")
-            for i, msg in enumerate(enhanced_messages[:5]):
-                timestamp = msg.get('timestamp', 'Unknown')
-                formatted_time = msg.get('formatted_time', 'Unknown')
-                print(f"Message {i+1}: {timestamp} -> {formatted_time}")
-            print(f"=== END SORTED MESSAGES DEBUG ===\n")
-            
-    except Exception as e:
-        print(f"Error sorting messages: {e}")
-        # Fallback sorting if timestamp format is different
-        enhanced_messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        print(f"Sorted {len(enhanced_messages)} messages by string timestamp")
-    
-    # Apply search filter if needed
+    # Taken before reading anything so changes made meanwhile are synced later
+    sync_cursor = initial_cursor()
+    accounts = session.get('accounts', [])
+
+    # Only the newest window of each folder is fetched, older mail is paged in
+    # through /api/refresh with the cursors handed to the template
+    limit = page_size(request.args.get("limit"))
     search_query = request.args.get("search", "").lower()
-    if search_query:
-        enhanced_messages = [
-            m for m in enhanced_messages
-            if search_query in m.get("subject", "").lower()
-            or search_query in m.get("message", "").lower()
-        ]
-    
-    # Add categorized messages to their respective categories
-    for enhanced_mail in enhanced_messages:
-        category = enhanced_mail.get('category', 'Inbox')
-        categorized_mails[category].append(enhanced_mail)
-    
-    # Create a unified sorted list for All Mail view
-    all_emails_sorted = enhanced_messages.copy()
-
-    # Fetch Sent mails
-    sent_messages_ref = firebase.ref.child("sent").child(user_key).get() or {}
-    sent_messages = []
-    for key, m in sent_messages_ref.items():
-        m['id'] = key
-        sent_messages.append(m)
-    
-    # Enhance sent messages first
-    enhanced_sent_messages = []
-    for mail in sent_messages:
-        enhanced_mail = enhance_email_data(mail, current_email, 'Sent')
-        enhanced_sent_messages.append(enhanced_mail)
-    
-    # Sort enhanced sent messages by timestamp (newest first)
-    try:
-        enhanced_sent_messages.sort(key=lambda x: parse_timestamp_for_sorting(x.get('timestamp')), reverse=True)
-        print(f"Sorted {len(enhanced_sent_messages)} sent messages by timestamp")
-    except Exception as e:
-        print(f"Error sorting sent messages: {e}")
-        enhanced_sent_messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        print(f"Sorted {len(enhanced_sent_messages)} sent messages by string timestamp")
-    
-    categorized_mails["Sent"] = enhanced_sent_messages
-    
-    # Add sent messages to unified list
-    all_emails_sorted.extend(enhanced_sent_messages)
-
-    # Fetch Draft mails
-    draft_messages_ref = firebase.ref.child("drafts").child(user_key).get() or {}
-    draft_messages = []
-    for key, m in draft_messages_ref.items():
-        m['id'] = key
-        draft_messages.append(m)
-    
-    # Enhance draft messages first
-    enhanced_draft_messages = []
-    for mail in draft_messages:
-        enhanced_mail = enhance_email_data(mail, current_email, 'Drafts')
-        enhanced_draft_messages.append(enhanced_mail)
-    
-    # Sort enhanced draft messages by timestamp (newest first)
-    try:
-        enhanced_draft_messages.sort(key=lambda x: parse_timestamp_for_sorting(x.get('timestamp')), reverse=True)
-        print(f"Sorted {len(enhanced_draft_messages)} draft messages by timestamp")
-    except Exception as e:
-        print(f"Error sorting draft messages: {e}")
-        enhanced_draft_messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        print(f"Sorted {len(enhanced_draft_messages)} draft messages by string timestamp")
-    
-    categorized_mails["Drafts"] = enhanced_draft_messages
-    
-    # Add draft messages to unified list
-    all_emails_sorted.extend(enhanced_draft_messages)
-    
-    # Sort the unified list by timestamp (newest first)
-    try:
-        all_emails_sorted.sort(key=lambda x: parse_timestamp_for_sorting(x.get('timestamp')), reverse=True)
-        print(f"Final unified sort: {len(all_emails_sorted)} emails sorted by timestamp")
-    except Exception as e:
-        print(f"Error in final unified sort: {e}")
-        all_emails_sorted.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
 
-    accounts = session.get('accounts', [])
-    
-    # Debug information
-    print(f"\n=== DEBUG ACCOUNT INFO ===")
-    print(f"Current email: {current_email}")
-    print(f"All accounts in session: {accounts}")
-    print(f"Session contents: {dict(session)}")
+    # The user record, the folders and the other signed-in accounts are
+    # independent reads, so they all run at once
+    reads = Fanout()
+    reads.submit("user", storage.get_user, user_key, label="users")
+    for folder in FOLDERS:
+        if not (folder == "inbox" and search_query):
+            reads.submit(folder, storage.folder_page, folder, user_key, limit, label=f"page:{folder}")
+    for acc_email in accounts:
+        if acc_email != current_email:
+            reads.submit(acc_email, storage.get_user, acc_email.replace(".", ","), label="users")
+    # A search runs concurrent reads of its own, meanwhile the others complete
+    searched = search_inbox_page(user_key, search_query, limit) if search_query else None
+
+    user = reads.result("user")
+    prime_profile(current_email, user)
+    pages = {folder: searched if folder == "inbox" and search_query else reads.result(folder)
+             for folder in FOLDERS}
+
+    view = build_mailbox_view(current_email, pages, ranked=bool(search_query))
+    all_emails_sorted = view['all_emails_sorted']
+
+    MESSAGES_PER_REQUEST.observe(len(view['messages']), endpoint="inbox")
+    debug = app.logger.isEnabledFor(logging.DEBUG)
+
+    # Debug: Show first few sorted messages
+    if debug and all_emails_sorted:
+        app.logger.debug("Newest messages: %s", [
+            (msg.get('timestamp', 'Unknown'), msg.get('formatted_time', 'Unknown')) for msg in all_emails_sorted[:5]
+        ])
+    if debug:
+        app.logger.debug("Inbox for %s, accounts in session: %s", current_email, accounts)
 
     other_accounts = []
     for acc_email in accounts:
         if acc_email != current_email:
-            print(f"Processing other account: {acc_email}")
-            acc_data = firebase.ref.child("users").child(acc_email.replace(".", ",")).get()
+            acc_data = reads.result(acc_email)
             if acc_data:
                 account_name = f"{acc_data.get('first_name', '')} {acc_data.get('last_name', '')}".strip()
                 if not account_name:
@@ -620,12 +329,8 @@ def inbox():
                     "email": acc_email,
                     "name": account_name
                 })
-                print(f"Added account: {acc_email} -> {account_name}")
             else:
-                print(f"No user data found for: {acc_email}")
-    
-    print(f"Final other_accounts: {other_accounts}")
-    print(f"=== END DEBUG ===")
+                app.logger.debug("No user data found for: %s", acc_email)
 
     colors = ["#ff5733", "#33a1ff", "#8e44ad", "#27ae60", "#f39c12"]
     profile_bg_color = random.choice(colors)
@@ -641,19 +346,22 @@ def inbox():
 
     return render_template(
         "inbox.html",
-        messages=messages,
+        messages=view['messages'],
         user=user,
         user_email=current_email,
         user_name=user_name,
         user_first_name=first_name,
         user_last_name=last_name,
-        user_profile_pic=user.get("profile_pic", None),
+        user_profile_pic=profile_pic_url(user),
         profile_bg_color=profile_bg_color,
         accounts=accounts,
         search_query=search_query,
         other_accounts=other_accounts,
-        categorized_mails=categorized_mails,
-        all_emails_sorted=all_emails_sorted
+        categorized_mails=view['categorized_mails'],
+        all_emails_sorted=all_emails_sorted,
+        cursors=view['cursors'],
+        page_size=limit,
+        sync_cursor=sync_cursor
     )
 
 # Switch account
@@ -663,7 +371,7 @@ def switch_account(email):
         previous_email = session.get('user_email')
         session['user_email'] = email
         # Get user info for better messaging
-        user_data = firebase.ref.child("users").child(email.replace(".", ",")).get()
+        user_data = storage.get_user(email.replace(".", ","))
         if user_data:
             user_name = f"{user_data.get('first_name', '')} {user_data.get('last_name', '')}".strip()
             if not user_name:
@@ -696,7 +404,7 @@ def compose():
             receiver = f"{receiver_username}{EMAIL_SUFFIX}" if receiver_username else ""
             subject = request.form.get('subject', "")
             message = request.form.get('message', "")
-            timestamp = str(datetime.now())
+            timestamp, timestamp_ms = new_timestamps()
 
             draft_data = {
                 "sender": current_email,
@@ -704,9 +412,10 @@ def compose():
                 "subject": subject,
                 "message": message,
                 "attachments": [],  # attachments not saved in draft for simplicity
-                "timestamp": timestamp
+                "timestamp": timestamp,
+                "timestamp_ms": timestamp_ms
             }
-            firebase.ref.child("drafts").child(current_email.replace(".", ",")).child(draft_id).set(draft_data)
+            storage.save_draft(current_email.replace(".", ","), draft_id, draft_data)
             flash("Draft saved successfully!")
             return redirect("/compose")
 
@@ -722,29 +431,18 @@ def compose():
             
         subject = request.form['subject']
         message = request.form['message']
-        timestamp = str(datetime.now())
+        timestamp, timestamp_ms = new_timestamps()
 
-        if not firebase.ref.child("users").child(receiver.replace(".", ",")).get():
+        if not directory.exists(receiver):
             flash(f"Receiver {receiver} does not exist!")
             return redirect("/compose")
 
-        # Save attachments to uploads folder
-        attachments = []
-        upload_folder = "uploads"
-        os.makedirs(upload_folder, exist_ok=True)
-        
-        if 'attachments' in request.files:
-            files = request.files.getlist('attachments')
-            for file in files:
-                if file and file.filename:
-                    filename = secure_filename(file.filename)
-                    # Add timestamp to prevent conflicts
-                    timestamp_str = str(int(datetime.now().timestamp()))
-                    name, ext = os.path.splitext(filename)
-                    unique_filename = f"{name}_{timestamp_str}{ext}"
-                    filepath = os.path.join(upload_folder, unique_filename)
-                    file.save(filepath)
-                    attachments.append(unique_filename)  # Store unique filename
+        # Stream attachments into the content-addressed store
+        try:
+            attachments = store_uploads(request.files.getlist('attachments'))
+        except AttachmentTooLarge as e:
+            flash(f"Attachment too large: {e}")
+            return redirect("/compose")
 
         # Create mail data
         mail_data = {
@@ -754,33 +452,22 @@ def compose():
             "message": message,
             "attachments": attachments,
             "timestamp": timestamp,
+            "timestamp_ms": timestamp_ms,
+            "category": categorize_mail(subject, message),  # Categorized once, at delivery
             "is_reply": bool(reply_to),  # Track if this is a reply
             "cc": request.form.get('cc', ''),  # Include CC if provided
             "bcc": request.form.get('bcc', '')  # Include BCC if provided
         }
         
-        print(f"\n=== SENDING MAIL ===")
-        print(f"From: {sender}")
-        print(f"To: {receiver}")
-        print(f"Subject: {subject}")
-        print(f"Attachments: {attachments}")
-        print(f"Is Reply: {bool(reply_to)}")
+        # Receiver's inbox, sender's sent folder, change log and indexes in one write
+        inbox_id, sent_id = storage.deliver(mail_data)
+        mail_data['id'] = inbox_id  # Add the mail ID for notifications
+        app.logger.debug("Mail %s -> %s delivered as inbox/%s, sent/%s (subject %r, %d attachments, reply: %s)",
+                         sender, receiver, inbox_id, sent_id, subject, len(attachments), bool(reply_to))
         
-        # Save in receiver's inbox
-        receiver_key = receiver.replace(".", ",")
-        inbox_ref = firebase.ref.child("inbox").child(receiver_key).push(mail_data)
-        mail_data['id'] = inbox_ref.key  # Add the mail ID for notifications
-        print(f"Saved to receiver inbox: {inbox_ref.key}")
+        # Queued; sent (and coalesced with other new mail) in the background
+        notifications.notify(receiver, mail_data)
         
-        # Save in sender's sent folder
-        sender_key = sender.replace(".", ",")
-        sent_ref = firebase.ref.child("sent").child(sender_key).push(mail_data)
-        print(f"Saved to sender sent: {sent_ref.key}")
-        
-        # Send push notification to receiver
-        send_push_notification(receiver, mail_data)
-        
-        print(f"=== END SENDING MAIL ===")
         flash("Message sent successfully!")
         return redirect("/inbox")
 
@@ -808,19 +495,21 @@ def draft():
         if not data:
             return jsonify({"error": "No data provided"}), 400
         draft_id = data.get("draft_id") or str(random.randint(100000,999999))
+        timestamp, timestamp_ms = new_timestamps()
         draft_data = {
             "sender": current_email,
             "receiver": data.get("receiver", ""),
             "subject": data.get("subject", ""),
             "message": data.get("message", ""),
             "attachments": data.get("attachments", []),
-            "timestamp": str(datetime.now())
+            "timestamp": timestamp,
+            "timestamp_ms": timestamp_ms
         }
-        firebase.ref.child("drafts").child(user_key).child(draft_id).set(draft_data)
+        storage.save_draft(user_key, draft_id, draft_data)
         return jsonify({"message": "Draft saved", "draft_id": draft_id})
 
     else:  # GET
-        drafts = firebase.ref.child("drafts").child(user_key).get() or {}
+        drafts = storage.list_drafts(user_key)
         return jsonify(drafts)
 
 # Profile View
@@ -830,7 +519,7 @@ def profile():
     if not user_email:
         return redirect("/login")
 
-    user = firebase.ref.child("users").child(user_email.replace(".", ",")).get()
+    user = storage.get_user(user_email.replace(".", ","))
     
     # Generate profile background color
     colors = ["#ff5733", "#33a1ff", "#8e44ad", "#27ae60", "#f39c12"]
@@ -857,7 +546,7 @@ def profile():
         user_first_name=first_name,
         user_last_name=last_name,
         user_phone=user.get("phone", ""),
-        user_profile_pic=user.get("profile_pic", None),
+        user_profile_pic=profile_pic_url(user),
         profile_bg_color=profile_bg_color
     )
 
@@ -868,11 +557,6 @@ def update_profile():
     if not user_email:
         return redirect("/login")
 
-    print(f"\n=== PROFILE UPDATE DEBUG ====")
-    print(f"User: {user_email}")
-    print(f"Form data: {dict(request.form)}")
-    print(f"Files in request: {list(request.files.keys())}")
-    
     name = request.form.get("name", "").strip()
     phone = request.form.get("phone", "").strip()
     password = request.form.get("password", "").strip()
@@ -882,45 +566,34 @@ def update_profile():
     first_name = parts[0] if parts else ""
     last_name = parts[1] if len(parts) > 1 else ""
 
-    user_ref = firebase.ref.child("users").child(user_email.replace(".", ","))
     updates = {"first_name": first_name, "last_name": last_name, "phone": phone}
 
     if password:
         updates["password"] = password
-        print("Password will be updated")
 
     # Handle profile picture
     profile_pic_updated = False
     if remove_pic:
-        print("Removing profile picture and generating new avatar")
-        updates["profile_pic"] = generate_avatar(first_name, last_name)
+        updates["avatar_hash"] = generate_avatar(first_name, last_name)
+        updates["profile_pic"] = None  # Drop a legacy inline picture
         profile_pic_updated = True
     elif "profile_pic" in request.files:
         file = request.files["profile_pic"]
-        print(f"Profile pic file: {file}")
-        print(f"Filename: {getattr(file, 'filename', 'No filename attr')}")
-        print(f"Content type: {getattr(file, 'content_type', 'No content_type attr')}")
-        print(f"Content length: {getattr(file, 'content_length', 'No content_length attr')}")
         
         if file and hasattr(file, 'filename') and file.filename and file.filename.strip():
             try:
-                print(f"Processing uploaded file: {file.filename}")
-                import base64
                 from io import BytesIO
                 
                 # Reset file pointer to beginning
                 file.seek(0)
                 file_data = file.read()
-                print(f"File size: {len(file_data)} bytes")
                 
                 if len(file_data) == 0:
-                    print("ERROR: File data is empty!")
                     flash("Uploaded file is empty. Please try again.")
                 else:
                     # Reset file pointer and open image
                     file.seek(0)
                     img = Image.open(file)
-                    print(f"Image opened successfully. Size: {img.size}, Mode: {img.mode}")
 
                     # Crop to square (center crop)
                     width, height = img.size
@@ -930,47 +603,37 @@ def update_profile():
                     right = (width + min_dim) / 2
                     bottom = (height + min_dim) / 2
                     img = img.crop((left, top, right, bottom))
-                    print(f"Image cropped to: {img.size}")
 
                     # Resize to standard profile size
                     img = img.resize((200, 200))
-                    print(f"Image resized to: {img.size}")
 
-                    # Convert to base64 data URL for cloud deployment compatibility
+                    # Store the PNG in the avatar store, the user record only keeps its hash
                     buffer = BytesIO()
                     img.save(buffer, format='PNG')
                     img_data = buffer.getvalue()
-                    img_base64 = base64.b64encode(img_data).decode('utf-8')
-                    data_url = f"data:image/png;base64,{img_base64}"
-                    print(f"Base64 data URL created, length: {len(data_url)}")
+                    updates["avatar_hash"] = store_avatar(img_data)
+                    updates["profile_pic"] = None  # Drop a legacy inline picture
+                    app.logger.debug("Avatar %s stored for %s (%d bytes)", updates['avatar_hash'], user_email, len(img_data))
                     
-                    updates["profile_pic"] = data_url
                     profile_pic_updated = True
                     flash("Profile picture updated successfully!")
-                    print("Profile picture processing completed successfully")
                     
             except Exception as e:
-                print(f"ERROR processing profile picture: {e}")
-                import traceback
-                traceback.print_exc()
+                app.logger.exception("Error processing profile picture of %s", user_email)
                 flash(f"Error updating profile picture: {str(e)}")
-        else:
-            print("No valid file uploaded for profile picture")
-    else:
-        print("No profile_pic in request.files")
 
-    print(f"Final updates to be saved: {list(updates.keys())}")
-    print(f"Profile pic updated: {profile_pic_updated}")
+    app.logger.debug("Profile update for %s: fields %s, picture updated: %s",
+                     user_email, sorted(updates), profile_pic_updated)
     
     try:
-        user_ref.update(updates)
-        print("Database update completed successfully")
+        storage.update_user(user_email.replace(".", ","), updates)
+        invalidate_profile(user_email)
+        directory.put(user_email, first_name, last_name)
         flash("Profile updated successfully!")
     except Exception as e:
-        print(f"ERROR updating database: {e}")
+        app.logger.error("Error saving profile of %s: %s", user_email, e)
         flash(f"Error saving profile: {str(e)}")
     
-    print("=== END PROFILE UPDATE DEBUG ====\n")
     return redirect("/profile")
 
 # Logout specific account
@@ -1011,15 +674,16 @@ def delete_account():
         flash("No user logged in!")
         return redirect("/login")
 
-    # Remove user from Firebase
+    # Remove the user record
     user_key = user_email.replace(".", ",")
-    firebase.ref.child("users").child(user_key).delete()
+    storage.delete_user(user_key)
+    invalidate_profile(user_email)
+    directory.remove(user_email)
 
-    # Optionally, remove user's inbox messages
-    inbox_ref = firebase.ref.child("inbox").get() or {}
-    for key, msg in inbox_ref.items():
-        if msg.get("sender") == user_email or msg.get("receiver") == user_email:
-            firebase.ref.child("inbox").child(key).delete()
+    # The user's mail (own folders and copies delivered to others) is removed
+    # in the background through the per-user mail index
+    job_id = start_job("delete_account", delete_account_data, user_key)
+    app.logger.info("Account %s deleted, mail removal running as job %s", user_email, job_id)
 
     # Remove user from session and accounts list
     accounts = session.get("accounts", [])
@@ -1028,7 +692,8 @@ def delete_account():
     session['accounts'] = accounts
     session.pop('user_email', None)
 
-    flash(f"Account {user_email} deleted successfully!")
+    flash(f"Account {user_email} deleted successfully! Your mail is being removed in the background "
+          f"(progress: /api/jobs/{job_id}).")
     return redirect("/login")
 @app.route("/send_mail", methods=["POST"])
 def send_mail():
@@ -1036,32 +701,25 @@ def send_mail():
     if not current_email:
         return redirect("/login")
 
-    to_email = request.form.get('to')
+    to_email = (request.form.get('to') or "").strip().lower()
     cc_email = request.form.get('cc')
     bcc_email = request.form.get('bcc')
     subject = request.form.get('subject')
     message = request.form.get('message')
 
-    # Handle attachments
-    attachments = request.files.getlist('attachments')
-    saved_attachments = []
+    if not to_email or not directory.exists(to_email):
+        flash(f"Receiver {to_email} does not exist!")
+        return redirect("/inbox")
 
-    # Create uploads folder if missing
-    upload_folder = "uploads"
-    os.makedirs(upload_folder, exist_ok=True)
-
-    for file in attachments:
-        if file and file.filename:
-            filename = secure_filename(file.filename)
-            # Add timestamp to prevent conflicts
-            timestamp_str = str(int(datetime.now().timestamp()))
-            name, ext = os.path.splitext(filename)
-            unique_filename = f"{name}_{timestamp_str}{ext}"
-            filepath = os.path.join(upload_folder, unique_filename)
-            file.save(filepath)
-            saved_attachments.append(unique_filename)  # Store just filename
+    # Stream attachments into the content-addressed store
+    try:
+        saved_attachments = store_uploads(request.files.getlist('attachments'))
+    except AttachmentTooLarge as e:
+        flash(f"Attachment too large: {e}")
+        return redirect("/inbox")
 
     # Create mail data
+    timestamp, timestamp_ms = new_timestamps()
     mail_data = {
         "sender": current_email,
         "receiver": to_email,
@@ -1070,20 +728,17 @@ def send_mail():
         "subject": subject,
         "message": message,
         "attachments": saved_attachments,
-        "timestamp": str(datetime.now())
+        "timestamp": timestamp,
+        "timestamp_ms": timestamp_ms,
+        "category": categorize_mail(subject, message)  # Categorized once, at delivery
     }
 
-    # Save in receiver's inbox
-    receiver_key = to_email.replace(".", ",")
-    inbox_ref = firebase.ref.child("inbox").child(receiver_key).push(mail_data)
-    mail_data['id'] = inbox_ref.key  # Add the mail ID for notifications
+    # Receiver's inbox, sender's sent folder, change log and indexes in one write
+    inbox_id, _ = storage.deliver(mail_data)
+    mail_data['id'] = inbox_id  # Add the mail ID for notifications
     
-    # Save in sender's sent folder
-    user_key = current_email.replace(".", ",")
-    firebase.ref.child("sent").child(user_key).push(mail_data)
-    
-    # Send push notification to receiver
-    send_push_notification(to_email, mail_data)
+    # Queued; sent (and coalesced with other new mail) in the background
+    notifications.notify(to_email, mail_data)
 
     flash("Mail sent successfully!")
     return redirect("/inbox")
@@ -1095,16 +750,11 @@ def read_mail(mail_id):
         return redirect("/login")
 
     user_key = current_email.replace(".", ",")
-    inbox = firebase.ref.child("inbox").child(user_key).get() or {}
-    mail = inbox.get(mail_id)
-
-    if not mail:
-        sent = firebase.ref.child("sent").child(user_key).get() or {}
-        mail = sent.get(mail_id)
-
-    if not mail:
-        drafts = firebase.ref.child("drafts").child(user_key).get() or {}
-        mail = drafts.get(mail_id)
+    mail = None
+    if MAIL_ID_PATTERN.match(mail_id):
+        # Only the message itself is read, from the folder of the list it was
+        # opened from or the one the mail index points at
+        _, mail = storage.find_message(user_key, mail_id, request.args.get('folder'))
 
     if not mail:
         flash("Mail not found.")
@@ -1118,7 +768,42 @@ def read_mail(mail_id):
 
     return render_template("read_mail.html", mail=enhanced_mail)
 
-# Route to serve uploaded attachments
+# Attachments from the content-addressed store; the name is only used for the download
+@app.route("/attachments/<digest>/<filename>")
+def attachment_file(digest, filename):
+    path = attachment_path(digest)
+    if path is None or not os.path.exists(path):
+        return "Attachment not found", 404
+    if ATTACHMENT_SENDFILE == "x-accel-redirect":
+        # nginx sends the bytes (and answers range requests) itself
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        response.headers["X-Accel-Redirect"] = accel_path(digest)
+        response.headers.set("Content-Disposition", "inline", filename=filename)
+        response.set_etag(digest)
+        response = response.make_conditional(request)
+    else:
+        # Range requests, If-None-Match and If-Range are answered by send_file;
+        # with USE_X_SENDFILE the front server sends the bytes
+        response = send_file(path, download_name=filename, etag=digest, conditional=True,
+                             max_age=365 * 24 * 3600)
+    # The hash names the content, so it never changes; private because
+    # attachments belong to a mailbox
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    response.accept_ranges = "bytes"
+    return response
+
+@app.errorhandler(413)
+def request_too_large(e):
+    message = f"Upload too large (limit {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"
+    if request.path.startswith("/api/"):
+        return jsonify({'error': message}), 413
+    flash(message)
+    return redirect("/compose")
+
+# Route to serve attachments of older mail, stored by file name
 @app.route("/uploads/<filename>")
 def uploaded_file(filename):
     """Serve uploaded attachment files"""
@@ -1128,7 +813,12 @@ def uploaded_file(filename):
         # Return 404 error for missing files
         from flask import abort
         abort(404)
-    return send_from_directory(upload_folder, filename)
+    # Validated by mtime/size ETag and Last-Modified, ranges supported; a name
+    # could in theory be reused, so these are only cached for a day
+    response = send_from_directory(upload_folder, filename, max_age=24 * 3600)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
 
 # Notification subscription management
 @app.route("/api/subscribe", methods=["POST"])
@@ -1157,6 +847,7 @@ def subscribe_notifications():
             'created_at': str(datetime.now()),
             'user_email': current_email
         })
+        invalidate_notification_settings(current_email)
         
         return jsonify({'success': True, 'message': 'Notification subscription saved'})
         
@@ -1183,6 +874,7 @@ def unsubscribe_notifications():
             'enabled': False,
             'updated_at': str(datetime.now())
         })
+        invalidate_notification_settings(current_email)
         
         return jsonify({'success': True, 'message': 'Notifications disabled'})
         
@@ -1212,49 +904,6 @@ def get_notification_status():
         print(f"Error getting notification status: {e}")
         return jsonify({'error': 'Failed to get notification status'}), 500
 
-# Function to send push notification (called when new email arrives)
-def send_push_notification(user_email, mail_data):
-    """Send push notification to user when they receive a new email"""
-    try:
-        user_key = user_email.replace(".", ",")
-        notification_data = firebase.ref.child("notifications").child(user_key).get()
-        
-        if not notification_data or not notification_data.get('enabled'):
-            print(f"Notifications not enabled for {user_email}")
-            return
-            
-        subscription = notification_data.get('subscription')
-        if not subscription:
-            print(f"No subscription found for {user_email}")
-            return
-            
-        # Format notification message
-        sender = mail_data.get('sender', 'Unknown')
-        subject = mail_data.get('subject', '(No subject)')
-        
-        notification_payload = {
-            'title': f'New email from {sender}',
-            'body': subject,
-            'icon': '/static/logo.png',
-            'badge': '/static/logo.png',
-            'url': '/inbox',
-            'mailId': mail_data.get('id')
-        }
-        
-        # Here you would integrate with a push service like FCM, OneSignal, etc.
-        # For now, we'll just log the notification
-        print(f"\n=== PUSH NOTIFICATION ===")
-        print(f"To: {user_email}")
-        print(f"Title: {notification_payload['title']}")
-        print(f"Body: {notification_payload['body']}")
-        print(f"=== END NOTIFICATION ===")
-        
-        # In a real implementation, you would send the notification here:
-        # send_to_push_service(subscription, notification_payload)
-        
-    except Exception as e:
-        print(f"Error sending push notification: {e}")
-
 # Check for new emails API (for real-time checking)
 @app.route("/api/check-new-emails", methods=["POST"])
 @rate_limit(max_requests=30, per_seconds=60)  # Allow 30 checks per minute
@@ -1271,31 +920,38 @@ def check_new_emails():
     try:
         user_key = current_email.replace(".", ",")
         
-        # Get last check timestamp from session or use 5 minutes ago
-        last_check = session.get('last_email_check')
-        if last_check:
-            last_check_time = datetime.fromisoformat(last_check)
-        else:
-            last_check_time = datetime.now() - timedelta(minutes=5)
-            
-        # Fetch recent messages
-        inbox_ref = firebase.ref.child("inbox").child(user_key).get() or {}
-        new_emails = []
-        
-        for key, m in inbox_ref.items():
-            if m.get('receiver') == current_email:
-                email_time = datetime.fromisoformat(m.get('timestamp', '2000-01-01T00:00:00'))
-                if email_time > last_check_time:
-                    m['id'] = key
-                    new_emails.append(m)
-        
-        # Update last check timestamp
-        session['last_email_check'] = datetime.now().isoformat()
+        # Mail that arrived after the newest inbox key this session has seen
+        # (5 minutes back on the first check). Inbox keys are chronological
+        # push keys, so this is one keyed range query, not a folder download.
+        last_seen = session.get('last_seen_inbox_key')
+        if not isinstance(last_seen, str):
+            # Cursors of older sessions: epoch ms, or the ISO time of the last check
+            last_check_ms = session.pop('last_email_check_ms', None)
+            legacy_check_ms = legacy_timestamp_ms(session.pop('last_email_check', None))
+            if not isinstance(last_check_ms, int):
+                last_check_ms = legacy_check_ms or now_ms() - 5 * 60 * 1000
+            last_seen = push_key_floor(last_check_ms)
+        arrived, has_more = storage.messages_after("inbox", user_key, last_seen)
+        
+        # Like /api/sync, the cursor stays SYNC_SETTLE_MS behind now: a key
+        # written meanwhile by a worker with a slightly late clock can still
+        # land before it. Mail past the cursor is read again by the next check,
+        # so its ids are remembered to report it only once. A full window moves
+        # the cursor to its end, the rest is picked up by the next check.
+        reported = set(session.get('reported_inbox_keys') or [])
+        newest = arrived[-1]['id'] if arrived else last_seen
+        if not has_more:
+            newest = min(newest, push_key_floor(now_ms() - SYNC_SETTLE_MS))
+        cursor = max(last_seen, newest)
+        session['last_seen_inbox_key'] = cursor
+        session['reported_inbox_keys'] = [m['id'] for m in arrived if m['id'] > cursor]
+        new_emails = [m for m in arrived if m.get('receiver') == current_email and m['id'] not in reported]
         
         return jsonify({
             'success': True,
             'new_emails': len(new_emails),
-            'emails': new_emails[:5]  # Return max 5 new emails
+            'emails': new_emails[:5],  # Return max 5 new emails
+            'has_more': has_more
         })
         
     except Exception as e:
@@ -1317,144 +973,133 @@ def refresh_emails():
     
     try:
         user_key = current_email.replace(".", ",")
-        
-        # Fetch received messages from the user's inbox
-        inbox_ref = firebase.ref.child("inbox").child(user_key).get() or {}
-        messages = []
-        for key, m in inbox_ref.items():
-            if m.get('receiver') == current_email:
-                m['id'] = key
-                messages.append(m)
-        
-        # Sort messages by timestamp (newest first)
-        try:
-            messages.sort(key=lambda x: datetime.fromisoformat(x.get('timestamp', '1970-01-01T00:00:00')), reverse=True)
-        except:
-            try:
-                # Try legacy format
-                messages.sort(key=lambda x: datetime.strptime(x.get('timestamp', '1970-01-01 00:00:00'), '%Y-%m-%d %H:%M:%S'), reverse=True)
-            except:
-                # Fallback sorting if timestamp format is different
-                messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        
-        # Categorize mails and enhance with avatar data
-        categorized_mails = {
-            "Inbox": [],
-            "Promotions": [],
-            "Social": [],
-            "Updates": []
-        }
-        
-        # Categorize and enhance messages
-        enhanced_messages = []
-        for mail in messages:
-            # Categorize first
-            category = categorize_mail(mail.get("subject", ""), mail.get("message", ""))
-            # Then enhance with category
-            enhanced_mail = enhance_email_data(mail, current_email, category)
-            enhanced_messages.append(enhanced_mail)
-        
-        # Sort enhanced messages by timestamp (newest first)
-        try:
-            enhanced_messages.sort(key=lambda x: parse_timestamp_for_sorting(x.get('timestamp')), reverse=True)
-        except Exception as e:
-            print(f"Error sorting messages in refresh: {e}")
-            # Fallback sorting if timestamp format is different
-            enhanced_messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        
-        # Add categorized messages to their respective categories
-        for enhanced_mail in enhanced_messages:
-            category = enhanced_mail.get('category', 'Inbox')
-            categorized_mails[category].append(enhanced_mail)
-        
-        # Fetch Sent mails
-        sent_messages_ref = firebase.ref.child("sent").child(user_key).get() or {}
-        sent_messages = []
-        for key, m in sent_messages_ref.items():
-            m['id'] = key
-            sent_messages.append(m)
-        
-        # Sort sent messages by timestamp (newest first)
-        try:
-            sent_messages.sort(key=lambda x: datetime.fromisoformat(x.get('timestamp', '1970-01-01T00:00:00')), reverse=True)
-        except:
-            try:
-                # Try legacy format
-                sent_messages.sort(key=lambda x: datetime.strptime(x.get('timestamp', '1970-01-01 00:00:00'), '%Y-%m-%d %H:%M:%S'), reverse=True)
-            except:
-                sent_messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        
-        # Enhance sent messages first
-        enhanced_sent_messages = []
-        for mail in sent_messages:
-            enhanced_mail = enhance_email_data(mail, current_email, 'Sent')
-            enhanced_sent_messages.append(enhanced_mail)
-        
-        # Sort enhanced sent messages by timestamp (newest first)
-        try:
-            enhanced_sent_messages.sort(key=lambda x: parse_timestamp_for_sorting(x.get('timestamp')), reverse=True)
-        except Exception as e:
-            print(f"Error sorting sent messages in refresh: {e}")
-            enhanced_sent_messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        
-        categorized_mails["Sent"] = enhanced_sent_messages
-        
-        # Create unified list for All Mail view
-        all_emails_sorted = enhanced_messages.copy()
-        all_emails_sorted.extend(enhanced_sent_messages)
-        
-        # Fetch Draft mails
-        draft_messages_ref = firebase.ref.child("drafts").child(user_key).get() or {}
-        draft_messages = []
-        for key, m in draft_messages_ref.items():
-            m['id'] = key
-            draft_messages.append(m)
-        
-        # Sort draft messages by timestamp (newest first)
-        try:
-            draft_messages.sort(key=lambda x: datetime.fromisoformat(x.get('timestamp', '1970-01-01T00:00:00')), reverse=True)
-        except:
-            try:
-                # Try legacy format
-                draft_messages.sort(key=lambda x: datetime.strptime(x.get('timestamp', '1970-01-01 00:00:00'), '%Y-%m-%d %H:%M:%S'), reverse=True)
-            except:
-                draft_messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        
-        # Enhance draft messages first
-        enhanced_draft_messages = []
-        for mail in draft_messages:
-            enhanced_mail = enhance_email_data(mail, current_email, 'Drafts')
-            enhanced_draft_messages.append(enhanced_mail)
-        
-        # Sort enhanced draft messages by timestamp (newest first)
-        try:
-            enhanced_draft_messages.sort(key=lambda x: parse_timestamp_for_sorting(x.get('timestamp')), reverse=True)
-        except Exception as e:
-            print(f"Error sorting draft messages in refresh: {e}")
-            enhanced_draft_messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        
-        categorized_mails["Drafts"] = enhanced_draft_messages
-        
-        # Add draft messages to unified list and sort all together
-        all_emails_sorted.extend(enhanced_draft_messages)
-        try:
-            all_emails_sorted.sort(key=lambda x: parse_timestamp_for_sorting(x.get('timestamp')), reverse=True)
-        except Exception as e:
-            print(f"Error in final unified sort for refresh: {e}")
-            all_emails_sorted.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+        sync_cursor = initial_cursor()
+        
+        # Optional paging parameters: {"folder": ..., "limit": ..., "before"/"after": cursor}.
+        # Without a folder the newest window of every folder is returned.
+        params = request.get_json(silent=True) or {}
+        limit = page_size(params.get('limit'))
+        folder = params.get('folder')
+        if folder and folder not in FOLDERS:
+            return jsonify({'error': 'Unknown folder'}), 400
+        
+        reads = Fanout()
+        for name in ([folder] if folder else FOLDERS):
+            reads.submit(name, storage.folder_page, name, user_key, limit,
+                         before=params.get('before'), after=params.get('after'), label=f"page:{name}")
+        pages = reads.results()
+        view = build_mailbox_view(current_email, pages)
+        MESSAGES_PER_REQUEST.observe(len(view['messages']), endpoint="refresh_emails")
         
         return jsonify({
             'success': True,
-            'categorized_mails': categorized_mails,
-            'all_emails_sorted': all_emails_sorted,
+            'categorized_mails': view['categorized_mails'],
+            'all_emails_sorted': view['all_emails_sorted'],
             'timestamp': str(datetime.now()),
-            'total_messages': len(messages)
+            'total_messages': len(view['messages']),
+            'cursors': view['cursors'],
+            'sync_cursor': sync_cursor
         })
         
     except Exception as e:
         print(f"Error refreshing emails: {e}")
         return jsonify({'error': 'Failed to refresh emails'}), 500
 
+# Delta sync API - only what changed since the client's cursor
+@app.route("/api/sync", methods=["POST"])
+@rate_limit(max_requests=30, per_seconds=60)  # Allow 30 syncs per minute
+def sync_emails():
+    current_email = session.get('user_email')
+    if not current_email:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    # Validate CSRF token
+    csrf_token = request.headers.get('X-CSRF-Token') or request.form.get('csrf_token')
+    if not validate_csrf_token(csrf_token):
+        return jsonify({'error': 'Invalid CSRF token'}), 403
+    
+    try:
+        user_key = current_email.replace(".", ",")
+        params = request.get_json(silent=True) or {}
+        
+        changes, cursor, more, reset = read_changes(user_key, params.get('cursor'))
+        if reset:
+            # Unknown or expired cursor - the client has to reload the mailbox
+            return jsonify({'success': True, 'reset': True, 'cursor': cursor})
+        
+        puts, deletes = summarize_changes(changes)
+        
+        # Read the current state of the changed messages, one batch per folder
+        put_ids = {folder: [] for folder in FOLDERS}
+        for folder, mail_id in puts:
+            put_ids[folder].append(mail_id)
+        pages = {}
+        for folder in FOLDERS:
+            messages = storage.get_messages(folder, user_key, put_ids[folder]) if put_ids[folder] else []
+            pages[folder] = {'messages': messages}
+            found = {mail['id'] for mail in messages}
+            # Changed and then removed before this sync
+            deletes.extend((folder, mail_id) for mail_id in put_ids[folder] if mail_id not in found)
+        view = build_mailbox_view(current_email, pages)
+        
+        return jsonify({
+            'success': True,
+            'reset': False,
+            'cursor': cursor,
+            'more': more,
+            'upserts': view['all_emails_sorted'],
+            'deletes': [{'folder': folder, 'id': mail_id} for folder, mail_id in deletes]
+        })
+        
+    except Exception as e:
+        print(f"Error syncing emails: {e}")
+        return jsonify({'error': 'Failed to sync emails'}), 500
+
+# Server-Sent Events stream that tells the inbox when to call /api/sync
+@app.route("/api/events")
+def mail_events():
+    current_email = session.get('user_email')
+    if not current_email:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    user_key = current_email.replace(".", ",")
+    if hub.full():
+        # Too many open streams in this worker - the client falls back to polling
+        return jsonify({'error': 'Too many open event streams'}), 503, {'Retry-After': '30'}
+    
+    # EventSource sends the id of the last event it saw when it reconnects
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+    return Response(
+        stream_changes(user_key, cursor, lambda: latest_change_key(user_key)),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Don't let nginx buffer the stream
+        }
+    )
+
+# Progress of a background job (e.g. account deletion); the id is only known to whoever started it
+@app.route("/api/jobs/<job_id>")
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+# Profile pictures from the content-addressed avatar store
+@app.route("/avatar/<avatar_hash>")
+def avatar(avatar_hash):
+    png = load_avatar(avatar_hash)
+    if png is None:
+        return "Avatar not found", 404
+    response = Response(png, mimetype="image/png")
+    # A hash always names the same image, so it can be cached forever
+    response.set_etag(avatar_hash)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
 # Debug route to check session
 @app.route("/debug/session")
 def debug_session():
@@ -1465,43 +1110,66 @@ def debug_session():
         "session_keys": list(session.keys())
     })
 
-# API endpoint to fetch all users for auto-complete
+# Debug route to inspect the shared profile cache
+@app.route("/debug/cache")
+def debug_cache():
+    return jsonify({
+        "profiles": profile_cache_stats(),
+        "avatars": avatar_engine.stats(),
+        "directory": directory.stats(),
+        "events": hub.stats(),
+        "notifications": notifications.stats(),
+        "rate_limits": limiter.stats(),
+        "fanout": fanout_stats()
+    })
+
+# Values owned by other modules, read when /metrics is scraped
+@metrics_registry.collector
+def collect_app_metrics():
+    rate_limits = limiter.stats()
+    notification_stats = notifications.stats()
+    return cache_samples({
+        "profiles": profile_cache_stats(),
+        "avatar_renders": avatar_engine.stats(),
+        "avatar_blobs": avatar_blobs.stats(),
+        "notification_settings": notification_settings_stats()
+    }) + [
+        ("bharatmail_rate_limit_rejections_total", "counter", "Requests refused by the rate limiter",
+         [({'route': route}, count) for route, count in rate_limits['rejected'].items()]),
+        ("bharatmail_rate_limit_allowed_total", "counter", "Requests let through by the rate limiter",
+         [({}, rate_limits['allowed'])]),
+        ("bharatmail_notification_queue_depth", "gauge", "Users with a notification waiting",
+         [({}, notification_stats['queue_depth'])]),
+        ("bharatmail_notifications_total", "counter", "Notifications by outcome",
+         [({'outcome': outcome}, notification_stats[outcome]) for outcome in ("sent", "skipped", "retried", "failed", "dropped")]),
+        ("bharatmail_event_streams", "gauge", "Open live update streams",
+         [({}, hub.stats()['streams'])])
+    ]
+
+# Prometheus text exposition; set METRICS_TOKEN to require "Authorization: Bearer <token>"
+@app.route("/metrics")
+def metrics():
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return "Unauthorized", 401
+    return Response(metrics_registry.expose(), mimetype="text/plain; version=0.0.4")
+
+# API endpoint for recipient auto-complete
 @app.route("/api/users")
 def get_users():
     current_email = session.get('user_email')
     if not current_email:
         return jsonify({'error': 'Not authenticated'}), 401
     
+    # Prefix search over the in-memory user directory: ?q=<prefix>&limit=<n>
+    query = request.args.get('q', '')
     try:
-        print(f"Fetching users for auto-complete. Current user: {current_email}")
-        # Fetch all users from Firebase
-        users_ref = firebase.ref.child("users").get() or {}
-        users = []
-        
-        for email_key, user_data in users_ref.items():
-            if user_data:
-                # Convert Firebase key back to email
-                email = email_key.replace(",", ".")
-                
-                # Create user name from first and last name
-                first_name = user_data.get('first_name', '').strip()
-                last_name = user_data.get('last_name', '').strip()
-                name = f"{first_name} {last_name}".strip()
-                
-                # Fallback to email prefix if no name
-                if not name:
-                    name = email.split('@')[0].replace('.', ' ').title()
-                
-                users.append({
-                    'email': email,
-                    'name': name,
-                    'first_name': first_name,
-                    'last_name': last_name
-                })
-        
-        print(f"Returning {len(users)} users for auto-complete")
-        return jsonify(users)
-        
+        limit = min(max(int(request.args.get('limit', AUTOCOMPLETE_LIMIT)), 1), MAX_AUTOCOMPLETE_LIMIT)
+    except ValueError:
+        limit = AUTOCOMPLETE_LIMIT
+    
+    try:
+        return jsonify(directory.search(query, limit))
     except Exception as e:
         print(f"Error fetching users: {e}")
         return jsonify({'error': 'Failed to fetch users'}), 500
@@ -1524,38 +1192,23 @@ def delete_emails():
             return jsonify({'error': 'No email IDs provided'}), 400
         
         email_ids = data['email_ids']
+        if not isinstance(email_ids, list) or not all(isinstance(i, str) and MAIL_ID_PATTERN.match(i) for i in email_ids):
+            return jsonify({'error': 'Invalid email IDs'}), 400
+        if len(email_ids) > MAX_BULK_DELETE:
+            return jsonify({'error': f'At most {MAX_BULK_DELETE} emails can be deleted at once'}), 400
         user_key = current_email.replace(".", ",")
-        deleted_count = 0
         
-        # Delete from inbox
-        inbox_ref = firebase.ref.child("inbox").child(user_key)
-        for email_id in email_ids:
-            try:
-                inbox_ref.child(email_id).delete()
-                deleted_count += 1
-            except Exception as e:
-                print(f"Error deleting email {email_id} from inbox: {e}")
+        # Only ids that exist are deleted (the counts are exact); messages,
+        # index entries and tombstones go out in one write
+        result = storage.delete_messages(user_key, email_ids)
         
-        # Delete from sent
-        sent_ref = firebase.ref.child("sent").child(user_key)
-        for email_id in email_ids:
-            try:
-                sent_ref.child(email_id).delete()
-            except Exception as e:
-                print(f"Error deleting email {email_id} from sent: {e}")
-        
-        # Delete from drafts
-        drafts_ref = firebase.ref.child("drafts").child(user_key)
-        for email_id in email_ids:
-            try:
-                drafts_ref.child(email_id).delete()
-            except Exception as e:
-                print(f"Error deleting email {email_id} from drafts: {e}")
-        
-        print(f"Deleted {deleted_count} emails for user {current_email}")
+        deleted_count = len(result['found'])
+        print(f"Deleted {deleted_count} emails for user {current_email} ({result['deleted']})")
         return jsonify({
             'success': True,
             'deleted_count': deleted_count,
+            'deleted': result['deleted'],
+            'not_found': result['not_found'],
             'message': f'Successfully deleted {deleted_count} emails'
         })
         
@@ -1563,6 +1216,65 @@ def delete_emails():
         print(f"Error deleting emails: {e}")
         return jsonify({'error': 'Failed to delete emails'}), 500
 
+# ---------------- CLI Commands ----------------
+@app.cli.command("backfill-timestamps")
+@click.option("--batch-size", default=500, show_default=True, help="Paths written per multi-path update")
+@click.option("--dry-run", is_flag=True, help="Scan and report without writing anything")
+def backfill_timestamps_command(batch_size, dry_run):
+    """Add epoch-millisecond timestamps to existing inbox/sent/drafts messages"""
+    result = backfill_timestamps(batch_size=batch_size, dry_run=dry_run, log=click.echo)
+    click.echo(f"Backfill finished: {result}")
+
+@app.cli.command("recategorize-mail")
+@click.option("--batch-size", default=500, show_default=True, help="Paths written per multi-path update")
+@click.option("--dry-run", is_flag=True, help="Scan and report without writing anything")
+def recategorize_mail_command(batch_size, dry_run):
+    """Re-run the category keywords over every inbox message (after changing them)"""
+    result = recategorize_mail(batch_size=batch_size, dry_run=dry_run, log=click.echo)
+    click.echo(f"Recategorization finished: {result}")
+
+@app.cli.command("migrate-profile-pictures")
+@click.option("--batch-size", default=500, show_default=True, help="Paths written per multi-path update")
+@click.option("--dry-run", is_flag=True, help="Scan and report without writing anything")
+def migrate_profile_pictures_command(batch_size, dry_run):
+    """Move inline base64 profile pictures out of user records into the avatar store"""
+    result = migrate_profile_pictures(batch_size=batch_size, dry_run=dry_run, log=click.echo)
+    click.echo(f"Profile picture migration finished: {result}")
+
+@app.cli.command("rebuild-mail-index")
+@click.option("--batch-size", default=500, show_default=True, help="Paths written per multi-path update")
+@click.option("--dry-run", is_flag=True, help="Scan and report without writing anything")
+def rebuild_mail_index_command(batch_size, dry_run):
+    """Rebuild the per-user message location and delivery index from the mail folders"""
+    result = rebuild_mail_index(batch_size=batch_size, dry_run=dry_run, log=click.echo)
+    click.echo(f"Mail index rebuilt: {result}")
+
+@app.cli.command("sweep-attachments")
+@click.option("--grace-hours", default=1, show_default=True, help="Keep unreferenced files younger than this")
+@click.option("--dry-run", is_flag=True, help="Report orphaned files without deleting them")
+def sweep_attachments_command(grace_hours, dry_run):
+    """Delete stored attachment files that no message references any more"""
+    result = sweep_orphans(grace_seconds=grace_hours * 3600, dry_run=dry_run, log=click.echo)
+    click.echo(f"Sweep finished: {result}")
+
+@app.cli.command("rebuild-search-index")
+@click.option("--user", "user_email", default=None, help="Only rebuild the index of this address")
+@click.option("--batch-size", default=500, show_default=True, help="Paths written per multi-path update")
+@click.option("--dry-run", is_flag=True, help="Scan and report without writing anything")
+def rebuild_search_index_command(user_email, batch_size, dry_run):
+    """Rebuild the mailbox search index from the inbox, sent and drafts folders"""
+    user_key = user_email.replace(".", ",") if user_email else None
+    result = rebuild_search_index(user_key=user_key, batch_size=batch_size, dry_run=dry_run, log=click.echo)
+    click.echo(f"Search index rebuilt: {result}")
+
+@app.cli.command("backfill-user-directory")
+@click.option("--batch-size", default=500, show_default=True, help="Paths written per multi-path update")
+@click.option("--dry-run", is_flag=True, help="Scan and report without writing anything")
+def backfill_user_directory_command(batch_size, dry_run):
+    """Write the autocomplete projection of every user record and drop stale entries"""
+    result = backfill_user_directory(batch_size=batch_size, dry_run=dry_run, log=click.echo)
+    click.echo(f"User directory backfilled: {result}")
+
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5001))
     debug = os.environ.get('FLASK_ENV', 'production') == 'development'
@@ -0,0 +1,196 @@
+import os
+import re
+import time
+import hashlib
+import tempfile
+import threading
+import traceback
+import firebase
+from werkzeug.utils import secure_filename
+from cache import TTLCache
+from mailstore import read_keys
+
+# Content-addressed attachment storage.
+# Uploads are streamed to disk in chunks while being hashed and each distinct
+# file is stored once, as <ATTACHMENT_DIR>/<hash[:2]>/<hash>. Messages carry
+# {"name", "hash", "size", "type"} descriptors instead of file names.
+# References are tracked in the database:
+#   attachment_refs/<hash>/<user_key>:<folder>:<mail_id> = True
+#   mail_attachments/<user_key>/<mail_id>/<hash>         = folder
+# The second layout lets deletes find the references of a message without
+# reading it. A file whose hash has no references left is an orphan and is
+# removed by sweep_orphans().
+ATTACHMENT_DIR = os.environ.get('ATTACHMENT_DIR', os.path.join("uploads", "objects"))
+MAX_ATTACHMENT_BYTES = int(os.environ.get('MAX_ATTACHMENT_MB', 10)) * 1024 * 1024
+# Whole request; larger bodies are refused before anything is read
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_MB', 25)) * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Files younger than this are never swept: they may belong to a message that
+# is still being delivered
+ORPHAN_GRACE_SECONDS = int(os.environ.get('ATTACHMENT_GRACE_SECONDS', 3600))
+
+# Deletes start a background sweep at most this often per process
+SWEEP_INTERVAL_SECONDS = 600
+_swept_recently = TTLCache(maxsize=1, ttl=SWEEP_INTERVAL_SECONDS)
+
+
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# How attachment bytes leave the server: "" streams them from the worker,
+# "x-sendfile" (Apache, lighttpd) and "x-accel-redirect" (nginx) hand the file
+# to the front server. For nginx, ATTACHMENT_ACCEL_PREFIX must be an internal
+# location aliased to ATTACHMENT_DIR.
+ATTACHMENT_SENDFILE = os.environ.get('ATTACHMENT_SENDFILE', '').lower()
+ATTACHMENT_ACCEL_PREFIX = os.environ.get('ATTACHMENT_ACCEL_PREFIX', '/internal/attachments/')
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+def attachment_path(digest):
+    """Where the file with hash `digest` is stored; None for anything that is not a hash"""
+    if not HASH_PATTERN.match(digest or ""):
+        return None
+    return os.path.join(ATTACHMENT_DIR, digest[:2], digest)
+
+
+def accel_path(digest):
+    """Internal nginx URI of a stored file, for X-Accel-Redirect"""
+    return f"{ATTACHMENT_ACCEL_PREFIX.rstrip('/')}/{digest[:2]}/{digest}"
+
+
+def store_upload(file, max_bytes=MAX_ATTACHMENT_BYTES):
+    """Stream an uploaded file to the store and return its descriptor
+
+    Raises AttachmentTooLarge as soon as more than `max_bytes` were read.
+    """
+    tmp_dir = os.path.join(ATTACHMENT_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    sha = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = file.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise AttachmentTooLarge(f"{file.filename} is larger than {max_bytes // (1024 * 1024)} MB")
+                sha.update(chunk)
+                out.write(chunk)
+        digest = sha.hexdigest()
+        path = attachment_path(digest)
+        if os.path.exists(path):
+            # Already stored; refresh the mtime so a running sweep leaves it alone
+            os.utime(path)
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return {
+        'name': secure_filename(file.filename) or "attachment",
+        'hash': digest,
+        'size': size,
+        'type': file.mimetype or "application/octet-stream"
+    }
+
+
+def store_uploads(files):
+    """Descriptors of all non-empty uploads in `files`"""
+    return [store_upload(file) for file in files if file and file.filename]
+
+
+def attachment_hashes(mail):
+    """Hashes of the stored attachments of a message (legacy file names are skipped)"""
+    return [a['hash'] for a in mail.get('attachments') or [] if isinstance(a, dict) and a.get('hash')]
+
+
+def reference_updates(user_key, folder, mail_id, mail):
+    """Updates that record the attachments of a new message, for its delivery write"""
+    updates = {}
+    for digest in attachment_hashes(mail):
+        updates[f"attachment_refs/{digest}/{user_key}:{folder}:{mail_id}"] = True
+        updates[f"mail_attachments/{user_key}/{mail_id}/{digest}"] = folder
+    return updates
+
+
+def _release(user_key, mail_id, entries):
+    updates = {f"mail_attachments/{user_key}/{mail_id}": None}
+    for digest, folder in (entries or {}).items():
+        updates[f"attachment_refs/{digest}/{user_key}:{folder}:{mail_id}"] = None
+    return updates
+
+
+def release_updates(user_key, mail_ids):
+    """Updates that drop the attachment references of deleted messages (one keyed read)"""
+    entries = read_keys(firebase.ref.child("mail_attachments").child(user_key), mail_ids)
+    updates = {}
+    for mail_id, entry in entries.items():
+        updates.update(_release(user_key, mail_id, entry))
+    return updates
+
+
+def release_all_updates(user_key):
+    """Updates that drop every attachment reference of a user (deleted account)"""
+    entries = firebase.ref.child("mail_attachments").child(user_key).get() or {}
+    updates = {}
+    for mail_id, entry in entries.items():
+        updates.update(_release(user_key, mail_id, entry))
+    return updates
+
+
+def sweep_orphans(grace_seconds=ORPHAN_GRACE_SECONDS, dry_run=False, log=print, progress=None):
+    """Delete stored files that no message references any more"""
+    referenced = firebase.ref.child("attachment_refs").get(shallow=True) or {}
+    cutoff = time.time() - grace_seconds
+    scanned = removed = freed = 0
+    if not os.path.isdir(ATTACHMENT_DIR):
+        return {'scanned': 0, 'removed': 0, 'freed_bytes': 0, 'dry_run': dry_run}
+    for bucket in os.scandir(ATTACHMENT_DIR):
+        if not bucket.is_dir():
+            continue
+        for entry in os.scandir(bucket.path):
+            scanned += 1
+            # Everything in tmp/ is a leftover of an interrupted upload
+            if bucket.name != "tmp" and entry.name in referenced:
+                continue
+            try:
+                stat = entry.stat()
+                if stat.st_mtime > cutoff:
+                    continue
+                if not dry_run:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                continue  # removed by a sweep in another process
+            removed += 1
+            freed += stat.st_size
+    log(f"Attachment sweep: {removed} of {scanned} files unreferenced ({freed} bytes)")
+    return {'scanned': scanned, 'removed': removed, 'freed_bytes': freed, 'dry_run': dry_run}
+
+
+def _sweep_in_background():
+    try:
+        sweep_orphans()
+    except Exception:
+        traceback.print_exc()
+
+
+def schedule_sweep():
+    """Start a background sweep after references were released (throttled)
+
+    The sweep runs on a plain daemon thread rather than as a job, so it
+    leaves no jobs/<id> record behind. Returns whether one was started.
+    """
+    if "sweep" in _swept_recently:
+        return False
+    _swept_recently.set("sweep", True)
+    threading.Thread(target=_sweep_in_background, name="attachment-sweep", daemon=True).start()
+    return True
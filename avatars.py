@@ -0,0 +1,280 @@
+import os
+import re
+import base64
+import hashlib
+import threading
+import time
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFont
+import firebase
+from cache import TTLCache
+
+# Initials avatar rendering.
+# Everything that does not depend on the initials is prepared once: the
+# vignette overlay, the vignetted and downsampled background of each colour and
+# the loaded fonts. Per avatar only the text is drawn at render size and
+# downsampled (as a mask, cropped to the text) onto the ready background.
+# Finished PNGs are memoized by (initials, colour) - there are only a few
+# hundred initial pairs per colour, so most registrations are cache hits.
+AVATAR_CACHE_SIZE = int(os.environ.get('AVATAR_CACHE_SIZE', 1024))
+AVATAR_FONT = "DejaVuSans-Bold.ttf"
+
+# Drawn at 400px and downsampled to 200px for anti-aliasing
+RENDER_SIZE = 400
+OUTPUT_SIZE = 200
+
+
+class AvatarEngine:
+    def __init__(self, font_path=AVATAR_FONT, render_size=RENDER_SIZE, output_size=OUTPUT_SIZE,
+                 cache_size=AVATAR_CACHE_SIZE):
+        self.font_path = font_path
+        self.render_size = render_size
+        self.output_size = output_size
+        # Rendered avatars never go stale, the TTL only bounds memory for idle entries
+        self.rendered = TTLCache(maxsize=cache_size, ttl=24 * 3600)
+        self._vignette = None
+        self._backgrounds = {}
+        self._fonts = {}
+        # FreeType faces and the shared images are not safe to use from several threads
+        self._lock = threading.Lock()
+
+    def _vignette_mask(self):
+        """Subtle dark vignette overlay, identical for every avatar"""
+        if self._vignette is None:
+            size = self.render_size
+            overlay = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+            overlay_draw = ImageDraw.Draw(overlay)
+            for i in range(20):
+                alpha = int(255 * (i / 20) * 0.1)  # Very subtle
+                overlay_draw.ellipse([i, i, size - i, size - i], outline=None, fill=(0, 0, 0, alpha))
+            self._vignette = overlay
+        return self._vignette
+
+    def _background(self, color):
+        """Vignetted background of one colour, already at output size"""
+        background = self._backgrounds.get(color)
+        if background is None:
+            base = Image.new("RGBA", (self.render_size, self.render_size), color)
+            background = Image.alpha_composite(base, self._vignette_mask()).convert('RGB')
+            if self.render_size > self.output_size:
+                background = background.resize((self.output_size, self.output_size), Image.Resampling.LANCZOS)
+            self._backgrounds[color] = background
+        return background
+
+    def _font(self, size):
+        """Font of the given size; None when the TrueType font is unavailable"""
+        if size not in self._fonts:
+            try:
+                self._fonts[size] = ImageFont.truetype(self.font_path, size)
+            except OSError:
+                self._fonts[size] = None
+        return self._fonts[size]
+
+    def _fit_font(self, draw, initials):
+        """Largest font that leaves some padding around the initials"""
+        fontsize = int(self.render_size * 0.4)
+        font = None
+        while fontsize > 40:
+            font = self._font(fontsize)
+            if font is None:
+                return ImageFont.load_default()
+            bbox = draw.textbbox((0, 0), initials, font=font)
+            if bbox[2] - bbox[0] < self.render_size * 0.7 and bbox[3] - bbox[1] < self.render_size * 0.7:
+                break
+            fontsize -= 8
+        return font
+
+    def _draw(self, initials, color):
+        size = self.render_size
+        shadow = Image.new("L", (size, size), 0)
+        draw = ImageDraw.Draw(shadow)
+        font = self._fit_font(draw, initials)
+
+        # Center the text, adjusting for the font baseline
+        bbox = draw.textbbox((0, 0), initials, font=font)
+        x = (size - (bbox[2] - bbox[0])) / 2
+        y = (size - (bbox[3] - bbox[1])) / 2 - (bbox[1] / 2)
+
+        # Text shadow for depth, then the text itself - drawn as masks
+        draw.text((x + 2, y + 2), initials, fill=255, font=font)
+        text = Image.new("L", (size, size), 0)
+        ImageDraw.Draw(text).text((x, y), initials, fill=255, font=font)
+
+        # Only the area around the text has to be downsampled; the crop is
+        # aligned to the scale factor and padded for the resampling filter
+        scale = size // self.output_size
+        pad = 4 * scale
+        left, top, right, bottom = shadow.getbbox() or (0, 0, scale, scale)
+        left = max(0, (left - pad) // scale * scale)
+        top = max(0, (top - pad) // scale * scale)
+        right = min(size, -(-(right + pad) // scale) * scale)
+        bottom = min(size, -(-(bottom + pad) // scale) * scale)
+        crop = (left, top, right, bottom)
+        small = ((right - left) // scale, (bottom - top) // scale)
+        offset = (left // scale, top // scale)
+
+        img = self._background(color).copy()
+        img.paste((0, 0, 0), (offset[0], offset[1], offset[0] + small[0], offset[1] + small[1]),
+                  shadow.crop(crop).resize(small, Image.Resampling.LANCZOS))
+        img.paste((255, 255, 255), (offset[0], offset[1], offset[0] + small[0], offset[1] + small[1]),
+                  text.crop(crop).resize(small, Image.Resampling.LANCZOS))
+
+        buffer = BytesIO()
+        img.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def render(self, initials, color):
+        """PNG bytes of one avatar (memoized)"""
+        key = (initials, color)
+        png = self.rendered.get(key)
+        if png is None:
+            with self._lock:
+                png = self._draw(initials, color)
+            self.rendered.set(key, png)
+        return png
+
+    def render_many(self, requests):
+        """Render a batch of (initials, colour) pairs; returns {(initials, colour): png}
+
+        Each distinct pair is drawn at most once and the shared lock is taken
+        once for the whole batch instead of per avatar.
+        """
+        results = {}
+        missing = []
+        for key in dict.fromkeys(requests):
+            png = self.rendered.get(key)
+            if png is None:
+                missing.append(key)
+            else:
+                results[key] = png
+        if missing:
+            with self._lock:
+                for initials, color in missing:
+                    results[(initials, color)] = self._draw(initials, color)
+            for key in missing:
+                self.rendered.set(key, results[key])
+        return results
+
+    def stats(self):
+        return self.rendered.stats()
+
+
+def avatar_initials(first_name, last_name):
+    """Initials shown on a generated avatar"""
+    initials = ((first_name[0] if first_name else "") + (last_name[0] if last_name else "")).upper()
+    return initials if initials.strip() else "U"
+
+
+engine = AvatarEngine()
+
+
+# ---------------- Avatar store ----------------
+# Profile pictures are stored once per distinct image under avatars/<sha256>
+# and served from /avatar/<sha256>. User records only keep the hash, so reading
+# a user no longer drags the picture along, and since a hash always names the
+# same bytes browsers may cache the image forever.
+AVATAR_STORE_CACHE_SIZE = int(os.environ.get('AVATAR_STORE_CACHE_SIZE', 512))
+AVATAR_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+avatar_blobs = TTLCache(maxsize=AVATAR_STORE_CACHE_SIZE, ttl=24 * 3600)
+
+
+def avatar_hash(png):
+    return hashlib.sha256(png).hexdigest()
+
+
+def store_avatar(png):
+    """Store PNG bytes in the avatar store and return their hash"""
+    digest = avatar_hash(png)
+    if digest not in avatar_blobs:
+        # Content addressed, so writing the same image again is harmless
+        firebase.ref.child("avatars").child(digest).set(base64.b64encode(png).decode('utf-8'))
+        avatar_blobs.set(digest, png)
+    return digest
+
+
+def load_avatar(digest):
+    """PNG bytes stored under `digest`, or None"""
+    if not AVATAR_HASH_PATTERN.match(digest or ""):
+        return None
+    png = avatar_blobs.get(digest)
+    if png is None:
+        encoded = firebase.ref.child("avatars").child(digest).get()
+        if not isinstance(encoded, str):
+            return None
+        png = base64.b64decode(encoded)
+        avatar_blobs.set(digest, png)
+    return png
+
+
+def avatar_url(digest):
+    return f"/avatar/{digest}"
+
+
+def profile_pic_url(user_data):
+    """URL of a user's profile picture, or None
+
+    Records that have not been migrated yet still carry the picture itself.
+    """
+    if not user_data:
+        return None
+    if user_data.get('avatar_hash'):
+        return avatar_url(user_data['avatar_hash'])
+    return user_data.get('profile_pic') or None
+
+
+def decode_data_url(data_url):
+    """PNG bytes of a data:image/png;base64 URL, or None for anything else"""
+    prefix = "data:image/png;base64,"
+    if not isinstance(data_url, str) or not data_url.startswith(prefix):
+        return None
+    try:
+        return base64.b64decode(data_url[len(prefix):], validate=True)
+    except ValueError:
+        return None
+
+
+def benchmark(count=200, colors=("#FF5733", "#33A1FF", "#28A745", "#FFC300")):
+    """Time avatar rendering per avatar: cold engine, warm engine (new pairs) and memoized
+
+    "cold" is what every avatar used to cost, since nothing was kept between calls.
+    """
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    pairs = [(letters[i % 26] + letters[(i // 26) % 26], colors[i % len(colors)]) for i in range(count)]
+    results = {}
+
+    started = time.perf_counter()
+    for initials, color in pairs[:20]:
+        AvatarEngine(cache_size=0)._draw(initials, color)
+    results['cold_ms'] = (time.perf_counter() - started) * 1000 / 20
+
+    warm = AvatarEngine()
+    warm.render("XX", colors[0])  # prepare the mask, backgrounds and fonts
+    for color in colors:
+        warm._background(color)
+    started = time.perf_counter()
+    for initials, color in pairs:
+        warm.render(initials, color)
+    results['warm_ms'] = (time.perf_counter() - started) * 1000 / count
+
+    started = time.perf_counter()
+    for initials, color in pairs:
+        warm.render(initials, color)
+    results['memoized_ms'] = (time.perf_counter() - started) * 1000 / count
+
+    batch = AvatarEngine()
+    started = time.perf_counter()
+    batch.render_many(pairs)
+    results['batch_ms'] = (time.perf_counter() - started) * 1000 / count
+
+    results['speedup_warm'] = round(results['cold_ms'] / results['warm_ms'], 1)
+    results['speedup_memoized'] = round(results['cold_ms'] / results['memoized_ms'], 1)
+    for key in ('cold_ms', 'warm_ms', 'memoized_ms', 'batch_ms'):
+        results[key] = round(results[key], 3)
+    return results
+
+
+if __name__ == "__main__":
+    # python avatars.py - micro-benchmark of the avatar engine
+    for name, value in benchmark().items():
+        print(f"{name:>18}: {value}")
@@ -0,0 +1,352 @@
+# Benchmarks of the mail routes against the in-memory database.
+#
+#   python bench.py                          # 100, 1000 and 10000 message mailboxes
+#   python bench.py --sizes 100000 --latency-ms 20
+#   python bench.py --save                   # write benchmarks/baseline-<size>.json
+#   python bench.py --compare                # exit 1 on a regression against them
+#
+# Mailboxes are generated from a seed, so two runs see the same messages and
+# Firebase call counts and bytes are comparable across machines; wall times
+# are only comparable on the same machine, and even there vary from run to
+# run, so --compare only checks them with --wall-threshold. Every database
+# round trip sleeps --latency-ms, which is what makes call counts and fanout
+# show in wall time.
+import os
+
+# Must be set before the app (and with it firebase.py) is imported
+os.environ['FIREBASE_BACKEND'] = 'memory'
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+# Notifications are queued but never sent, so the receiver's settings reads
+# do not land in the numbers of whatever route runs next
+os.environ.setdefault('NOTIFY_WORKERS', '0')
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+from datetime import datetime
+import firebase
+from app import app, generate_avatar
+from avatars import avatar_blobs
+from changelog import initial_cursor
+from directory import directory
+from mailindex import location_updates
+from mailstore import PUSH_CHARS, push_key_floor, categorize_mail, format_time
+from metrics import FIREBASE_BYTES
+from profiles import profile_cache
+from search import index_updates
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+DEFAULT_SIZES = (100, 1000, 10000)
+
+BENCH_EMAIL = "bench@bharatmail.in"
+BENCH_KEY = BENCH_EMAIL.replace(".", ",")
+CORRESPONDENTS = 50
+# Messages are spread over the year before this instant (fixed for repeatability)
+BASE_MS = 1760000000000
+SPAN_MS = 365 * 24 * 3600 * 1000
+SEARCH_TERM = "invoice"
+
+FIRST_NAMES = ("Aarav", "Diya", "Ishaan", "Kavya", "Rohan", "Ananya", "Vihaan", "Meera", "Arjun", "Saanvi")
+LAST_NAMES = ("Sharma", "Patel", "Iyer", "Reddy", "Gupta", "Nair", "Singh", "Das", "Mehta", "Rao")
+# Includes the category keywords so all inbox categories get messages
+WORDS = (
+    "meeting", "project", "invoice", "report", "schedule", "team", "review", "budget", "client", "draft",
+    "please", "attached", "thanks", "tomorrow", "week", "call", "notes", "plan", "launch", "design",
+    "sale", "discount", "offer", "friend", "party", "invite", "update", "news", "reminder", "alert",
+    "the", "and", "for", "with", "about", "from", "your", "our", "this", "next"
+)
+
+
+def _sentence(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _push_key(rng, ms):
+    return push_key_floor(ms) + "".join(rng.choice(PUSH_CHARS) for _ in range(12))
+
+
+def synthetic_mail(rng, sender, receiver, timestamp_ms):
+    subject = _sentence(rng, 2, 7).capitalize()
+    message = _sentence(rng, 15, 80).capitalize() + "."
+    return {
+        "sender": sender,
+        "receiver": receiver,
+        "subject": subject,
+        "message": message,
+        "attachments": [],
+        "timestamp": str(datetime.fromtimestamp(timestamp_ms / 1000)),
+        "timestamp_ms": timestamp_ms,
+        "category": categorize_mail(subject, message),
+        "is_reply": rng.random() < 0.2,
+        "cc": "",
+        "bcc": ""
+    }
+
+
+def seed_mailbox(size, seed=42):
+    """Replace the in-memory database with a bench user owning `size` messages
+
+    Roughly 70% inbox, 25% sent and 5% drafts, with their search and mail
+    index entries. Only the bench user's copies are written; the
+    correspondents exist as users but have empty mailboxes.
+    """
+    rng = random.Random(seed)
+    db = firebase.memory
+    with db.lock:
+        db.root = {}
+
+    updates = {}
+    correspondents = []
+    for i in range(CORRESPONDENTS + 1):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        username = "bench" if i == 0 else f"{first.lower()}{i}"
+        email = f"{username}@bharatmail.in"
+        user_key = email.replace(".", ",")
+        updates[f"users/{user_key}"] = {
+            "first_name": first, "last_name": last, "username": username, "email": email,
+            "password": "bench", "phone": "", "created_at": str(datetime.fromtimestamp(BASE_MS / 1000 - SPAN_MS / 1000))
+        }
+        updates[f"user_directory/{user_key}"] = {"first_name": first, "last_name": last}
+        if i:
+            correspondents.append(email)
+
+    ids = {"inbox": [], "sent": [], "drafts": []}
+    for i in range(size):
+        timestamp_ms = BASE_MS - SPAN_MS + (i * SPAN_MS) // size + rng.randint(0, 999)
+        roll = rng.random()
+        other = rng.choice(correspondents)
+        if roll < 0.05:
+            folder, mail_id = "drafts", str(rng.randint(100000, 999999))
+            mail = synthetic_mail(rng, BENCH_EMAIL, other, timestamp_ms)
+        elif roll < 0.30:
+            folder, mail_id = "sent", _push_key(rng, timestamp_ms)
+            mail = synthetic_mail(rng, BENCH_EMAIL, other, timestamp_ms)
+            mail["id"] = _push_key(rng, timestamp_ms)  # id of the receiver's copy
+        else:
+            folder, mail_id = "inbox", _push_key(rng, timestamp_ms)
+            mail = synthetic_mail(rng, other, BENCH_EMAIL, timestamp_ms)
+        updates[f"{folder}/{BENCH_KEY}/{mail_id}"] = mail
+        updates.update(index_updates(BENCH_KEY, folder, mail_id, mail))
+        updates.update(location_updates(BENCH_KEY, folder, mail_id))
+        ids[folder].append(mail_id)
+
+    # Straight into the tree: no simulated latency, no call accounting
+    with db.lock:
+        for path, value in updates.items():
+            db._write(path.split("/"), value)
+        db.calls = 0
+
+    # Process-wide caches still describe the previous mailbox
+    profile_cache.clear()
+    avatar_blobs.clear()
+    directory.reload()
+    return ids, correspondents
+
+
+def bench_client():
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_email'] = BENCH_EMAIL
+        session['accounts'] = [BENCH_EMAIL]
+        session['csrf_token'] = "bench-csrf-token"
+    return client
+
+
+def route_scenarios(client, ids, correspondents):
+    """(name, callable) per route; each callable raises when the route did not succeed"""
+    headers = {'X-CSRF-Token': "bench-csrf-token"}
+    inbox_ids = sorted(ids["inbox"])
+    read_id = inbox_ids[len(inbox_ids) // 2] if inbox_ids else "missing"
+    sync_cursor = initial_cursor()
+    counter = iter(range(10 ** 9))
+
+    def request(method, url, expect=200, **kwargs):
+        def run():
+            response = client.open(url, method=method, **kwargs)
+            if response.status_code != expect:
+                raise RuntimeError(f"{method} {url} returned {response.status_code}")
+            return response
+        return run
+
+    def compose():
+        n = next(counter)
+        response = client.post("/compose", data={
+            'receiver': correspondents[n % len(correspondents)].split("@")[0],
+            'subject': f"Benchmark message {n}",
+            'message': "Quarterly report attached, please review before the meeting."
+        })
+        if response.status_code != 302 or not response.location.endswith("/inbox"):
+            raise RuntimeError(f"compose failed ({response.status_code} -> {response.location})")
+
+    return [
+        ("inbox", request("GET", "/inbox")),
+        ("inbox_search", request("GET", f"/inbox?search={SEARCH_TERM}")),
+        ("refresh_emails", request("POST", "/api/refresh", headers=headers, json={})),
+        ("read_mail", request("GET", f"/read/{read_id}")),
+        # As linked from the list, which knows the folder
+        ("read_mail_listed", request("GET", f"/read/{read_id}?folder=inbox")),
+        ("check_new_emails", request("POST", "/api/check-new-emails", headers=headers)),
+        ("sync_emails", request("POST", "/api/sync", headers=headers, json={'cursor': sync_cursor})),
+        # Last: it adds a message to the sent folder on every run
+        ("compose", compose)
+    ]
+
+
+def function_scenarios(seed=42, batch=1000):
+    """(name, callable) for the helpers the routes lean on; each call runs `batch` times"""
+    rng = random.Random(seed)
+    texts = [(_sentence(rng, 2, 7), _sentence(rng, 15, 80)) for _ in range(batch)]
+    stamps = [BASE_MS - rng.randint(0, SPAN_MS) for _ in range(batch)]
+    legacy = [str(datetime.fromtimestamp(ms / 1000)) for ms in stamps]
+    names = [(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)) for _ in range(batch // 10)]
+
+    def categorize():
+        for subject, message in texts:
+            categorize_mail(subject, message)
+
+    def format_epoch():
+        for ms in stamps:
+            format_time(None, ms)
+
+    def format_legacy():
+        for timestamp in legacy:
+            format_time(timestamp)
+
+    def avatars():
+        random.seed(seed)  # generate_avatar picks a random background
+        for first, last in names:
+            generate_avatar(first, last)
+
+    return [
+        (f"categorize_mail_x{batch}", categorize),
+        (f"format_time_x{batch}", format_epoch),
+        (f"format_time_legacy_x{batch}", format_legacy),
+        (f"generate_avatar_x{len(names)}", avatars)
+    ]
+
+
+def measure(run, repeat):
+    """Median / p95 wall time and mean Firebase calls and bytes of `repeat` runs after a warm-up"""
+    run()  # warm caches and first-use code paths
+    db = firebase.memory
+    times = []
+    calls = traffic = 0
+    for _ in range(repeat):
+        calls_before, bytes_before = db.calls, FIREBASE_BYTES.total()
+        started = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - started) * 1000)
+        calls += db.calls - calls_before
+        traffic += FIREBASE_BYTES.total() - bytes_before
+    times.sort()
+    return {
+        'wall_ms': round(times[len(times) // 2], 3),
+        'wall_ms_p95': round(times[min(len(times) - 1, int(len(times) * 0.95))], 3),
+        'firebase_calls': round(calls / repeat, 1),
+        'firebase_bytes': round(traffic / repeat)
+    }
+
+
+def run_size(size, latency_ms, repeat, seed):
+    started = time.perf_counter()
+    ids, correspondents = seed_mailbox(size, seed)
+    print(f"\n== {size} messages (seeded in {time.perf_counter() - started:.1f}s, "
+          f"latency {latency_ms} ms/call, {repeat} runs) ==")
+    firebase.memory.latency = latency_ms / 1000
+    try:
+        client = bench_client()
+        results = {}
+        for name, run in route_scenarios(client, ids, correspondents) + function_scenarios(seed):
+            results[name] = measure(run, repeat)
+            print_row(name, results[name])
+    finally:
+        firebase.memory.latency = 0
+    return {
+        'meta': {
+            'size': size, 'latency_ms': latency_ms, 'repeat': repeat, 'seed': seed,
+            'python': platform.python_version(), 'date': datetime.now().isoformat(timespec="seconds")
+        },
+        'results': results
+    }
+
+
+def print_row(name, result):
+    print(f"{name:>28} {result['wall_ms']:>10.2f} ms  p95 {result['wall_ms_p95']:>10.2f} ms"
+          f"  {result['firebase_calls']:>8} calls  {result['firebase_bytes']:>12} bytes")
+
+
+def baseline_path(size):
+    return os.path.join(BASELINE_DIR, f"baseline-{size}.json")
+
+
+def compare(report, baseline, wall_threshold, bytes_threshold):
+    """Regressions of `report` against `baseline` as printable lines
+
+    More Firebase calls is always a regression; bytes and wall time only
+    beyond their thresholds. Wall time is only checked with a wall_threshold
+    (opt-in, 0 skips it), and then against the p95 of the baseline.
+    """
+    regressions = []
+    # Differences below one simulated round trip are scheduling noise
+    wall_slack = max(2.0, report['meta']['latency_ms'])
+    if baseline['meta'].get('latency_ms') != report['meta']['latency_ms']:
+        print(f"  note: baseline was recorded with latency {baseline['meta'].get('latency_ms')} ms")
+    for name, result in report['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        if result['firebase_calls'] > old['firebase_calls']:
+            regressions.append(f"{name}: {old['firebase_calls']} -> {result['firebase_calls']} Firebase calls")
+        if result['firebase_bytes'] > old['firebase_bytes'] * (1 + bytes_threshold) + 1024:
+            regressions.append(f"{name}: {old['firebase_bytes']} -> {result['firebase_bytes']} bytes")
+        old_wall = old.get('wall_ms_p95', old['wall_ms'])
+        if wall_threshold and result['wall_ms'] > old_wall * (1 + wall_threshold) + wall_slack:
+            regressions.append(f"{name}: {old_wall} ms (baseline p95) -> {result['wall_ms']} ms")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark BharatMail routes against the in-memory database")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma separated mailbox sizes (messages), e.g. 100,1000,100000")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="simulated latency per database call")
+    parser.add_argument("--repeat", type=int, default=5, help="measured runs per scenario")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save", action="store_true", help="write the results as the new baselines")
+    parser.add_argument("--compare", action="store_true", help="compare with the saved baselines")
+    parser.add_argument("--wall-threshold", type=float, default=0,
+                        help="also compare wall time, allowing this growth of the median over the baseline p95 "
+                             "(e.g. 0.5 = 50%%; off by default, wall times are noisy)")
+    parser.add_argument("--bytes-threshold", type=float, default=0.10, help="allowed growth of bytes transferred")
+    args = parser.parse_args(argv)
+
+    regressions = []
+    for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+        report = run_size(size, args.latency_ms, args.repeat, args.seed)
+        path = baseline_path(size)
+        if args.compare:
+            if not os.path.exists(path):
+                print(f"  no baseline for {size} messages ({path})")
+            else:
+                with open(path) as f:
+                    found = compare(report, json.load(f), args.wall_threshold, args.bytes_threshold)
+                for line in found:
+                    print(f"  REGRESSION {line}")
+                regressions.extend(f"[{size}] {line}" for line in found)
+        if args.save:
+            os.makedirs(BASELINE_DIR, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+                f.write("\n")
+            print(f"  saved {path}")
+
+    if args.compare:
+        print(f"\n{len(regressions)} regression(s)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import os
+import firebase
+from cache import TTLCache
+from events import hub
+from mailstore import FOLDERS, new_push_key, now_ms, push_key_floor, push_key_time
+
+# Per-user change log used by the delta sync API.
+# Every write to a user's inbox/sent/drafts appends a small entry under
+# changes/<user_key>/<push key>, deletes leave a tombstone, and clients ask for
+# everything after the cursor they were handed last time.
+CHANGE_RETENTION_MS = int(os.environ.get('CHANGE_RETENTION_DAYS', 7)) * 24 * 3600 * 1000
+MAX_CHANGES_PER_SYNC = 200
+
+# Keys are generated by whichever worker did the write, so an entry can land
+# slightly "in the past". Cursors never move past now - SYNC_SETTLE_MS and the
+# last few seconds are re-sent; applying a change twice is harmless.
+SYNC_SETTLE_MS = 2000
+
+# Pruning old entries is throttled to once per user per process and hour
+_pruned_recently = TTLCache(maxsize=4096, ttl=3600)
+
+
+def change_updates(user_key, op, folder, mail_id):
+    """Path -> value updates that record one change, for a multi-path update()
+
+    `op` is "put" for added or edited messages and "delete" for tombstones.
+    A tombstone without a folder removes the id from every folder.
+    """
+    return {
+        f"changes/{user_key}/{new_push_key()}": {
+            "op": op,
+            "folder": folder,
+            "id": mail_id,
+            "at": now_ms()
+        }
+    }
+
+
+def record_changes(updates):
+    """Write change entries collected with change_updates() in one round trip
+    and wake the affected users' event streams"""
+    if not updates:
+        return
+    try:
+        firebase.ref.update(updates)
+    except Exception as e:
+        # A missed entry only costs the client a full refresh later
+        print(f"Error recording mailbox changes: {e}")
+        return
+    publish_changes(updates)
+
+
+def publish_changes(updates):
+    """Wake the event streams of the users in change_updates() entries that were
+    written as part of another multi-path update"""
+    for path, change in updates.items():
+        _, user_key, key = path.split("/")
+        hub.publish(user_key, {'cursor': key, 'folder': change['folder'], 'id': change['id']})
+
+
+def initial_cursor():
+    """Cursor for a client that has just loaded the full mailbox"""
+    return push_key_floor(now_ms() - SYNC_SETTLE_MS)
+
+
+def read_changes(user_key, cursor):
+    """Return (changes, new cursor, more, reset) for everything after `cursor`
+
+    `reset` means the cursor is unknown or older than the retention window and
+    the client has to reload the mailbox instead of applying a delta.
+    """
+    cursor_time = push_key_time(cursor)
+    if cursor_time is None or cursor_time < now_ms() - CHANGE_RETENTION_MS:
+        return [], initial_cursor(), False, True
+
+    result = firebase.ref.child("changes").child(user_key).order_by_key() \
+        .start_at(cursor).limit_to_first(MAX_CHANGES_PER_SYNC + 2).get() or {}
+    changes = [(key, change) for key, change in result.items() if key > cursor and isinstance(change, dict)]
+
+    more = len(changes) > MAX_CHANGES_PER_SYNC
+    changes = changes[:MAX_CHANGES_PER_SYNC]
+    if more:
+        new_cursor = changes[-1][0]
+    else:
+        new_cursor = max(cursor, push_key_floor(now_ms() - SYNC_SETTLE_MS))
+
+    prune_changes(user_key)
+    return [change for _, change in changes], new_cursor, more, False
+
+
+def latest_change_key(user_key):
+    """Key of the newest change entry of a user (one-item keyed query)"""
+    try:
+        latest = firebase.ref.child("changes").child(user_key).order_by_key().limit_to_last(1).get() or {}
+    except Exception as e:
+        print(f"Error reading latest change for {user_key}: {e}")
+        return None
+    return next(iter(latest), None)
+
+
+def prune_changes(user_key):
+    """Drop change entries older than the retention window (throttled)"""
+    if user_key in _pruned_recently:
+        return
+    _pruned_recently.set(user_key, True)
+    try:
+        expired = firebase.ref.child("changes").child(user_key).order_by_key() \
+            .end_at(push_key_floor(now_ms() - CHANGE_RETENTION_MS)).limit_to_first(500).get() or {}
+        if expired:
+            firebase.ref.child("changes").child(user_key).update({key: None for key in expired})
+    except Exception as e:
+        print(f"Error pruning change log for {user_key}: {e}")
+
+
+def summarize_changes(changes):
+    """Collapse a change list into the latest op per (folder, id), in log order
+
+    A tombstone without a folder also replaces the earlier changes of the id
+    in every folder.
+    """
+    latest = {}
+    for change in changes:
+        folder = change.get('folder')
+        mail_id = change.get('id')
+        if not mail_id or (folder not in FOLDERS and not (folder is None and change.get('op') == "delete")):
+            continue
+        key = (folder, mail_id)
+        if folder is None:
+            for earlier in FOLDERS:
+                latest.pop((earlier, mail_id), None)
+        latest.pop(key, None)  # re-insert so dict order follows the last change
+        latest[key] = change.get('op')
+    puts = [key for key, op in latest.items() if op == "put"]
+    deletes = [key for key, op in latest.items() if op == "delete"]
+    return puts, deletes
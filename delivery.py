@@ -0,0 +1,44 @@
+import firebase
+from attachments import reference_updates
+from changelog import change_updates, publish_changes
+from mailindex import location_updates, delivery_updates
+from mailstore import new_push_key
+from search import index_updates
+
+# Delivery of a new message. Both copies get locally generated push keys, so
+# the inbox copy, the sent copy, their change log entries and their mail and
+# search index entries and attachment references all go out in one multi-path
+# update: either the whole message is delivered or nothing is.
+
+
+def delivery_write(mail_data, inbox_id, sent_id):
+    """Path -> value updates that deliver one message"""
+    sender_key = mail_data['sender'].replace(".", ",")
+    receiver_key = mail_data['receiver'].replace(".", ",")
+    # The sent copy remembers the id of the receiver's copy, as it always did
+    sent_copy = {**mail_data, 'id': inbox_id}
+    return {
+        f"inbox/{receiver_key}/{inbox_id}": mail_data,
+        f"sent/{sender_key}/{sent_id}": sent_copy,
+        **change_updates(receiver_key, "put", "inbox", inbox_id),
+        **change_updates(sender_key, "put", "sent", sent_id),
+        **index_updates(receiver_key, "inbox", inbox_id, mail_data),
+        **index_updates(sender_key, "sent", sent_id, mail_data),
+        **location_updates(receiver_key, "inbox", inbox_id),
+        **location_updates(sender_key, "sent", sent_id),
+        **delivery_updates(sender_key, receiver_key, inbox_id),
+        **reference_updates(receiver_key, "inbox", inbox_id, mail_data),
+        **reference_updates(sender_key, "sent", sent_id, mail_data)
+    }
+
+
+def deliver_mail(mail_data):
+    """Store a new message in the receiver's inbox and the sender's sent folder
+    with a single write; returns (inbox_id, sent_id)"""
+    inbox_id = new_push_key()
+    sent_id = new_push_key()
+    updates = delivery_write(mail_data, inbox_id, sent_id)
+    firebase.ref.update(updates)
+    # Wake both mailboxes' event streams
+    publish_changes({path: value for path, value in updates.items() if path.startswith("changes/")})
+    return inbox_id, sent_id
@@ -0,0 +1,192 @@
+import os
+import bisect
+import threading
+import time
+import firebase
+from storage import storage
+from migrations import BatchWriter, iter_children
+
+# In-memory user directory for recipient autocomplete.
+# A projection of the user records (names only) is kept under
+# user_directory/<user_key>, so loading it never touches passwords or pictures.
+# The directory is checked against a shallow read of `users` on load: users
+# missing from the projection (registered before it existed) are listed by
+# address only until `flask backfill-user-directory` has projected them,
+# entries of deleted users are skipped. One thread per worker loads, the
+# others keep answering from the previous load (or wait for the first one).
+# Lookups are prefix searches with bisect over a sorted list of (term, email)
+# pairs for email, local part, first name, last name and full name.
+DIRECTORY_REFRESH_SECONDS = int(os.environ.get('DIRECTORY_REFRESH_SECONDS', 300))
+AUTOCOMPLETE_LIMIT = 8
+MAX_AUTOCOMPLETE_LIMIT = 20
+
+
+def directory_entry(email, first_name, last_name):
+    """What autocomplete shows for one user"""
+    first_name = (first_name or "").strip()
+    last_name = (last_name or "").strip()
+    name = f"{first_name} {last_name}".strip() or email.split('@')[0].replace('.', ' ').title()
+    return {'email': email, 'name': name, 'first_name': first_name, 'last_name': last_name}
+
+
+def entry_terms(entry):
+    """Lowercase strings a prefix query can match for one user"""
+    terms = {
+        entry['email'].lower(),
+        entry['email'].split('@')[0].lower(),
+        entry['name'].lower(),
+        entry['first_name'].lower(),
+        entry['last_name'].lower()
+    }
+    terms.discard("")
+    return terms
+
+
+class UserDirectory:
+    def __init__(self, refresh_seconds=DIRECTORY_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._entries = {}
+        self._terms = []
+        self._loaded_at = None
+
+    def _load(self):
+        projected = firebase.ref.child("user_directory").get() or {}
+        user_keys = firebase.ref.child("users").get(shallow=True) or {}
+
+        entries = {}
+        for user_key in user_keys:
+            email = user_key.replace(",", ".")
+            fields = projected.get(user_key)
+            if not isinstance(fields, dict):
+                fields = {}  # not projected yet, see backfill_user_directory
+            entries[email] = directory_entry(email, fields.get('first_name'), fields.get('last_name'))
+
+        terms = sorted((term, email) for email, entry in entries.items() for term in entry_terms(entry))
+        with self._lock:
+            self._entries = entries
+            self._terms = terms
+            self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        loaded_at = self._loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at <= self.refresh_seconds:
+            return
+        if loaded_at is None:
+            # Nothing to answer from yet: wait for whichever thread loads first
+            with self._load_lock:
+                if self._loaded_at is None:
+                    self._load()
+        elif self._load_lock.acquire(blocking=False):
+            # Other workers' registrations show up here after at most
+            # refresh_seconds; meanwhile other threads use the previous load
+            try:
+                if self._loaded_at == loaded_at:
+                    self._load()
+            finally:
+                self._load_lock.release()
+
+    def reload(self):
+        """Re-read the directory now instead of at the next refresh"""
+        with self._load_lock:
+            self._load()
+
+    def search(self, query, limit=AUTOCOMPLETE_LIMIT):
+        """Up to `limit` users with an email or name starting with `query`"""
+        query = (query or "").strip().lower()
+        if not query:
+            return []
+        self._ensure_loaded()
+        with self._lock:
+            results = []
+            seen = set()
+            i = bisect.bisect_left(self._terms, (query, ""))
+            while i < len(self._terms) and len(results) < limit:
+                term, email = self._terms[i]
+                if not term.startswith(query):
+                    break
+                if email not in seen:
+                    seen.add(email)
+                    results.append(self._entries[email])
+                i += 1
+            return results
+
+    def exists(self, email):
+        """Whether `email` belongs to a registered user
+
+        Answered from the directory; addresses it does not know yet (e.g. users
+        registered on another worker since the last refresh) cost one shallow read.
+        """
+        self._ensure_loaded()
+        if email in self._entries:
+            return True
+        return storage.user_exists(email.replace(".", ","))
+
+    def put(self, email, first_name, last_name):
+        """Add or update a user (call after the user record was written)"""
+        entry = directory_entry(email, first_name, last_name)
+        try:
+            firebase.ref.child("user_directory").child(email.replace(".", ",")).set({
+                'first_name': entry['first_name'],
+                'last_name': entry['last_name']
+            })
+        except Exception as e:
+            print(f"Error updating user directory for {email}: {e}")
+        with self._lock:
+            self._remove_terms(email)
+            self._entries[email] = entry
+            for term in entry_terms(entry):
+                bisect.insort(self._terms, (term, email))
+
+    def remove(self, email):
+        """Drop a deleted user"""
+        try:
+            firebase.ref.child("user_directory").child(email.replace(".", ",")).delete()
+        except Exception as e:
+            print(f"Error removing {email} from user directory: {e}")
+        with self._lock:
+            self._remove_terms(email)
+            self._entries.pop(email, None)
+
+    def _remove_terms(self, email):
+        entry = self._entries.get(email)
+        if not entry:
+            return
+        for term in entry_terms(entry):
+            i = bisect.bisect_left(self._terms, (term, email))
+            if i < len(self._terms) and self._terms[i] == (term, email):
+                del self._terms[i]
+
+    def stats(self):
+        return {'users': len(self._entries), 'terms': len(self._terms)}
+
+
+def backfill_user_directory(batch_size=500, dry_run=False, log=print):
+    """Project every user record into user_directory/ and drop entries of deleted users"""
+    writer = BatchWriter(batch_size, dry_run)
+    projected = firebase.ref.child("user_directory").get(shallow=True) or {}
+    scanned = 0
+    for user_key, user in iter_children(firebase.ref.child("users")):
+        scanned += 1
+        writer.set(f"user_directory/{user_key}", {
+            'first_name': (user.get('first_name') or "").strip(),
+            'last_name': (user.get('last_name') or "").strip()
+        })
+    user_keys = firebase.ref.child("users").get(shallow=True) or {}
+    removed = 0
+    for user_key in set(projected) - set(user_keys):
+        writer.set(f"user_directory/{user_key}", None)
+        removed += 1
+    writer.flush()
+    log(f"{scanned} users projected, {removed} stale entries removed")
+    return {
+        'scanned': scanned,
+        'removed': removed,
+        'updated': writer.written,
+        'batches': writer.batches,
+        'dry_run': dry_run
+    }
+
+
+directory = UserDirectory()
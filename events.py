@@ -0,0 +1,161 @@
+import os
+import json
+import queue
+import threading
+import time
+
+# In-process fan-out hub for the /api/events Server-Sent Events stream.
+# Writes that land in the change log (see changelog.record_changes) are
+# published to the hub and wake every stream of the affected user right away.
+# The hub only knows about streams held by this process, so with several
+# gunicorn workers each stream also probes the change log every
+# STREAM_POLL_SECONDS to pick up writes handled by other workers.
+STREAM_POLL_SECONDS = float(os.environ.get('STREAM_POLL_SECONDS', 10))
+STREAM_HEARTBEAT_SECONDS = 20
+
+# Streams are closed after a while so worker threads get recycled;
+# EventSource reconnects on its own and resumes from Last-Event-ID.
+STREAM_MAX_SECONDS = int(os.environ.get('STREAM_MAX_SECONDS', 300))
+
+# Every open stream holds one worker thread, so streams may only take a
+# quarter of the worker's threads (WEB_THREADS, passed to gunicorn --threads)
+# and the rest stay free for normal requests
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 100))
+MAX_STREAMS = int(os.environ.get('MAX_EVENT_STREAMS', max(1, WEB_THREADS // 4)))
+STREAM_RETRY_MS = 3000
+STREAM_FULL_RETRY_MS = 30000
+
+
+class Subscription:
+    """One open stream; events past `maxsize` are dropped since a single wake-up already triggers a sync"""
+
+    def __init__(self, user_key, maxsize=100):
+        self.user_key = user_key
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            pass
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventHub:
+    def __init__(self, max_streams=MAX_STREAMS):
+        self.max_streams = max_streams
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._count = 0
+        self.published = 0
+
+    def full(self):
+        """Whether this process is at MAX_STREAMS (a hint - subscribe() decides)"""
+        with self._lock:
+            return self._count >= self.max_streams
+
+    def subscribe(self, user_key):
+        """Register a stream for `user_key`; None when this process is at MAX_STREAMS"""
+        with self._lock:
+            if self._count >= self.max_streams:
+                return None
+            subscription = Subscription(user_key)
+            self._subscribers.setdefault(user_key, set()).add(subscription)
+            self._count += 1
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_key)
+            if subscribers and subscription in subscribers:
+                subscribers.discard(subscription)
+                self._count -= 1
+                if not subscribers:
+                    del self._subscribers[subscription.user_key]
+
+    def publish(self, user_key, event):
+        """Hand `event` to every stream of `user_key` held by this process"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_key, ()))
+            self.published += 1
+        for subscription in subscribers:
+            subscription.put(event)
+        return len(subscribers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'streams': self._count,
+                'users': len(self._subscribers),
+                'max_streams': self.max_streams,
+                'published': self.published
+            }
+
+
+hub = EventHub()
+
+
+def format_event(event, data, event_id=None):
+    """Serialize one SSE message"""
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def stream_changes(user_key, cursor, latest_change):
+    """Yield SSE messages for one stream of `user_key` until STREAM_MAX_SECONDS have passed
+
+    Every message is a "changes" event whose id is the newest change key seen;
+    clients react by calling /api/sync with their own cursor. `latest_change`
+    returns the newest change key of the user (or None) and is used to catch
+    writes made by other processes.
+
+    The stream only subscribes once the response is iterated, so a client
+    that goes away before that never takes a slot.
+    """
+    subscription = hub.subscribe(user_key)
+    if subscription is None:
+        # The worker filled up after the route checked; ask to retry later
+        yield f"retry: {STREAM_FULL_RETRY_MS}\n\n"
+        return
+    try:
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        started = last_poll = last_sent = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - started >= STREAM_MAX_SECONDS:
+                return
+            wait = max(0.0, min(STREAM_POLL_SECONDS - (now - last_poll), STREAM_HEARTBEAT_SECONDS))
+            event = subscription.get(timeout=wait)
+
+            if event is None and time.monotonic() - last_poll >= STREAM_POLL_SECONDS:
+                last_poll = time.monotonic()
+                key = latest_change()
+                if key and (cursor is None or key > cursor):
+                    event = {'cursor': key}
+
+            if event is not None:
+                # Collapse a burst (e.g. a bulk delete) into one wake-up
+                while True:
+                    newer = subscription.get(timeout=0)
+                    if newer is None:
+                        break
+                    event = newer
+                if cursor is None or event['cursor'] > cursor:
+                    cursor = event['cursor']
+                    last_sent = time.monotonic()
+                    yield format_event("changes", event, event_id=cursor)
+            elif time.monotonic() - last_sent >= STREAM_HEARTBEAT_SECONDS:
+                # Comment line keeps proxies from closing an idle connection
+                last_sent = time.monotonic()
+                yield ": ping\n\n"
+    finally:
+        hub.unsubscribe(subscription)
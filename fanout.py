@@ -0,0 +1,93 @@
+import os
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+# Concurrent execution of the independent database reads of one request.
+# Firebase calls are blocking HTTP requests, so a page that needs the user
+# record, three folders and a few profiles waited for the sum of all of them.
+# Submitting them to a shared, bounded pool makes the page wait for roughly
+# the slowest one. Calls must not submit further calls themselves (the pool
+# could fill up with callers waiting on their own children). Calls run in a
+# copy of the submitter's context, so they share its request read cache.
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', 32))
+FANOUT_TIMEOUT = float(os.environ.get('FANOUT_TIMEOUT', 10))
+
+_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+
+# label -> [calls, total ms, max ms, errors, timeouts]
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+class FanoutTimeout(TimeoutError):
+    pass
+
+
+def _record(label, elapsed_ms=None, error=False, timeout=False):
+    with _stats_lock:
+        entry = _stats.setdefault(label, [0, 0.0, 0.0, 0, 0])
+        if elapsed_ms is not None:
+            entry[0] += 1
+            entry[1] += elapsed_ms
+            entry[2] = max(entry[2], elapsed_ms)
+        entry[3] += error
+        entry[4] += timeout
+
+
+def _timed(label, fn, args, kwargs):
+    started = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        _record(label, error=True)
+        raise
+    finally:
+        _record(label, (time.perf_counter() - started) * 1000)
+
+
+class Fanout:
+    """Independent calls of one request, started at once and collected by key
+
+    All results share one deadline `timeout` seconds after the Fanout was
+    created. result() re-raises what the call raised, or FanoutTimeout.
+    """
+
+    def __init__(self, timeout=FANOUT_TIMEOUT):
+        self.deadline = time.monotonic() + timeout
+        self._futures = {}
+
+    def submit(self, key, fn, *args, label=None, **kwargs):
+        """Start fn(*args, **kwargs); latency is accounted under `label` (default: key)"""
+        label = label or key
+        context = contextvars.copy_context()
+        self._futures[key] = (label, _executor.submit(context.run, _timed, label, fn, args, kwargs))
+        return key
+
+    def result(self, key):
+        label, future = self._futures[key]
+        try:
+            return future.result(timeout=max(0, self.deadline - time.monotonic()))
+        except FutureTimeout:
+            _record(label, timeout=True)
+            raise FanoutTimeout(f"{label} did not finish in time")
+
+    def results(self):
+        """{key: result} of every call (raises like result())"""
+        return {key: self.result(key) for key in self._futures}
+
+
+def fanout_stats():
+    """Per-label call counts and latencies"""
+    with _stats_lock:
+        return {
+            label: {
+                'calls': calls,
+                'avg_ms': round(total / calls, 1) if calls else None,
+                'max_ms': round(longest, 1),
+                'errors': errors,
+                'timeouts': timeouts
+            }
+            for label, (calls, total, longest, errors, timeouts) in _stats.items()
+        }
@@ -1,10 +1,19 @@
-import firebase_admin
-from firebase_admin import credentials, db
 import os
 import json
+from metrics import InstrumentedReference
+from readcache import CachedReference
+
+# FIREBASE_BACKEND selects the database behind `ref`:
+#   firebase - the Realtime Database (needs credentials, see below)
+#   memory   - an in-process tree (local development, tests, benchmarks)
+#   sqlite   - an indexed SQLite file at SQLITE_DB_PATH (single-node deployments)
+BACKEND = os.environ.get('FIREBASE_BACKEND', 'firebase')
+SQLITE_DB_PATH = os.environ.get('SQLITE_DB_PATH', 'bharatmail.sqlite3')
 
 # Try to use environment variables first (for production), then fall back to file (for local dev)
 def get_firebase_credentials():
+    from firebase_admin import credentials
+    
     # Check if we have Firebase credentials in environment variables
     firebase_config = os.environ.get('FIREBASE_CONFIG')
     if firebase_config:
@@ -28,10 +37,26 @@ def get_firebase_credentials():
         f"2. Place your credentials file at: {cred_path}"
     )
 
-# Initialize Firebase
-cred = get_firebase_credentials()
-firebase_admin.initialize_app(cred, {
-    'databaseURL': 'https://bharatmail-3698e-default-rtdb.firebaseio.com//'
-})
+if BACKEND == 'memory':
+    import memory_db
+    memory = memory_db.MemoryDatabase(latency=float(os.environ.get('FIREBASE_MEMORY_LATENCY_MS', 0)) / 1000)
+    ref = memory_db.Reference(memory, [])  # root reference
+elif BACKEND == 'sqlite':
+    import sqlite_db
+    sqlite = sqlite_db.SQLiteDatabase(SQLITE_DB_PATH)
+    ref = sqlite_db.Reference(sqlite, [])  # root reference
+else:
+    import firebase_admin
+    from firebase_admin import db
+    
+    # Initialize Firebase
+    cred = get_firebase_credentials()
+    firebase_admin.initialize_app(cred, {
+        'databaseURL': 'https://bharatmail-3698e-default-rtdb.firebaseio.com//'
+    })
+    
+    ref = db.reference('/')  # root reference
 
-ref = db.reference('/')  # root reference
+# Every call through `ref` is counted and timed for /metrics; repeated reads
+# within one request are answered by the request's read cache
+ref = CachedReference(InstrumentedReference(ref))
@@ -0,0 +1,68 @@
+import os
+import secrets
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import firebase
+from mailstore import now_ms
+
+# Background jobs for work that should not hold up a request (e.g. deleting an
+# account's mail). Jobs run on a small thread pool in the worker that started
+# them; their progress is written to jobs/<job_id> so any worker can report it.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+
+class JobProgress:
+    """Handed to a running job to report how far it got"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.ref = firebase.ref.child("jobs").child(job_id)
+
+    def update(self, done=None, total=None, message=None):
+        fields = {}
+        if done is not None:
+            fields['done'] = done
+        if total is not None:
+            fields['total'] = total
+        if message is not None:
+            fields['message'] = message
+        if fields:
+            try:
+                self.ref.update(fields)
+            except Exception as e:
+                # Losing a progress update must not fail the job
+                print(f"Error reporting progress of job {self.job_id}: {e}")
+
+
+def _run(job_id, fn, args, kwargs):
+    progress = JobProgress(job_id)
+    progress.ref.update({'status': "running", 'started_at': now_ms()})
+    try:
+        result = fn(*args, progress=progress, **kwargs)
+        progress.ref.update({'status': "done", 'finished_at': now_ms(), 'result': result})
+        print(f"Job {job_id} finished: {result}")
+    except Exception as e:
+        traceback.print_exc()
+        progress.ref.update({'status': "failed", 'finished_at': now_ms(), 'error': str(e)})
+
+
+def start_job(kind, fn, *args, **kwargs):
+    """Queue fn(*args, progress=JobProgress, **kwargs) and return the job id"""
+    job_id = secrets.token_urlsafe(16)
+    firebase.ref.child("jobs").child(job_id).set({
+        'kind': kind,
+        'status': "queued",
+        'done': 0,
+        'total': 0,
+        'created_at': now_ms()
+    })
+    _executor.submit(_run, job_id, fn, args, kwargs)
+    return job_id
+
+
+def get_job(job_id):
+    """Stored state of a job, or None"""
+    job = firebase.ref.child("jobs").child(job_id).get()
+    return job if isinstance(job, dict) else None
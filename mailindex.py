@@ -0,0 +1,87 @@
+import firebase
+from mailstore import FOLDERS, read_keys
+from migrations import BatchWriter, iter_folder_owners, iter_folder_items
+
+# Where every message of a user lives, so per-user operations never scan a folder:
+#   mail_index/<user_key>/<mail_id>/<folder> = True
+#       messages in the user's own inbox, sent and drafts (an id can sit in more
+#       than one folder, e.g. a mail sent to oneself)
+#   deliveries/<sender_key>/<receiver_key>/<mail_id> = True
+#       copies of mail the user sent that sit in other users' inboxes
+# Writers return path -> value updates to be merged into the write that stores
+# or removes the message. Entries whose message is gone are harmless: deleting
+# a path that does not exist is a no-op.
+
+
+def location_updates(user_key, folder, mail_id, present=True):
+    """Updates that record (or with present=False, forget) a message in a user's folder"""
+    return {f"mail_index/{user_key}/{mail_id}/{folder}": True if present else None}
+
+
+def delivery_updates(sender_key, receiver_key, mail_id, present=True):
+    """Updates that record (or forget) a sent message's copy in the receiver's inbox"""
+    if sender_key == receiver_key:
+        # Already covered by the sender's own inbox entry
+        return {}
+    return {f"deliveries/{sender_key}/{receiver_key}/{mail_id}": True if present else None}
+
+
+def message_locations(user_key, mail_ids):
+    """{mail_id: [folders]} for the given ids of a user; ids found nowhere map to []
+
+    Ids missing from the index (mail from before `flask rebuild-mail-index`)
+    are looked up in each folder with shallow reads.
+    """
+    indexed = read_keys(firebase.ref.child("mail_index").child(user_key), mail_ids)
+    return {mail_id: _folders(user_key, mail_id, indexed.get(mail_id)) for mail_id in dict.fromkeys(mail_ids)}
+
+
+def message_folders(user_key, mail_id):
+    """Folders holding one message of a user, from a direct read of its index entry"""
+    return _folders(user_key, mail_id, firebase.ref.child("mail_index").child(user_key).child(mail_id).get())
+
+
+def _folders(user_key, mail_id, indexed):
+    if isinstance(indexed, dict):
+        return [folder for folder in FOLDERS if indexed.get(folder)]
+    return [
+        folder for folder in FOLDERS
+        if firebase.ref.child(folder).child(user_key).child(mail_id).get(shallow=True)
+    ]
+
+
+def delivered_copies(user_key):
+    """[(receiver_key, mail_id)] of the user's sent mail sitting in other users' inboxes"""
+    delivered = firebase.ref.child("deliveries").child(user_key).get() or {}
+    return [
+        (receiver_key, mail_id)
+        for receiver_key, mail_ids in delivered.items()
+        for mail_id in (mail_ids or {})
+    ]
+
+
+def rebuild_mail_index(batch_size=500, dry_run=False, log=print):
+    """Rebuild mail_index and deliveries from the inbox, sent and drafts folders"""
+    if not dry_run:
+        firebase.ref.child("mail_index").delete()
+        firebase.ref.child("deliveries").delete()
+    writer = BatchWriter(batch_size, dry_run)
+    scanned = 0
+    for folder in FOLDERS:
+        for user_key in iter_folder_owners(folder):
+            for mail_id, mail in iter_folder_items(folder, user_key):
+                scanned += 1
+                for path, value in location_updates(user_key, folder, mail_id).items():
+                    writer.set(path, value)
+                sender = mail.get('sender')
+                if folder == "inbox" and sender:
+                    for path, value in delivery_updates(sender.replace(".", ","), user_key, mail_id).items():
+                        writer.set(path, value)
+            log(f"{folder}/{user_key} indexed ({scanned} messages scanned so far)")
+    writer.flush()
+    return {
+        'scanned': scanned,
+        'written': writer.written,
+        'batches': writer.batches,
+        'dry_run': dry_run
+    }
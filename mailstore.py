@@ -0,0 +1,541 @@
+import base64
+import heapq
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from operator import itemgetter
+import firebase
+from fanout import Fanout
+from profiles import get_profile, get_profiles
+
+# Cursor-based paging over the inbox/sent/drafts folders.
+# Only one window of each folder is downloaded per request; the window is
+# selected with ordered, limited Firebase queries rather than by fetching the
+# whole folder and slicing it in Python.
+MAILBOX_PAGE_SIZE = int(os.environ.get('MAILBOX_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = 200
+
+FOLDERS = ("inbox", "sent", "drafts")
+
+# Inbox and sent messages are written with push() so their keys are already
+# chronological. Drafts are re-saved in place under a fixed id, so they page by
+# their last-saved epoch timestamp (declared in database.rules.json as .indexOn).
+FOLDER_ORDER = {
+    "inbox": "$key",
+    "sent": "$key",
+    "drafts": "timestamp_ms"
+}
+
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+_push_lock = threading.Lock()
+_last_push = {'ms': None, 'random': []}
+
+
+def new_push_key():
+    """Generate a Firebase-style push key locally
+
+    The first 8 characters encode the creation time in ms, so keys sort
+    chronologically exactly like the ones push() returns. Like push(), keys
+    made in the same millisecond increment the random part of the previous
+    one, so a process's keys also sort in the order they were made.
+    """
+    with _push_lock:
+        ms = now_ms()
+        digits = _last_push['random']
+        if ms == _last_push['ms']:
+            i = len(digits) - 1
+            while i >= 0 and digits[i] == 63:
+                digits[i] = 0
+                i -= 1
+            if i >= 0:
+                digits[i] += 1
+        else:
+            digits = [random.randrange(64) for _ in range(12)]
+        _last_push['ms'] = ms
+        _last_push['random'] = digits
+    return push_key_floor(ms) + ''.join(PUSH_CHARS[digit] for digit in digits)
+
+
+def push_key_floor(ms):
+    """Time prefix of a push key - sorts before every key generated at or after `ms`"""
+    chars = []
+    for _ in range(8):
+        chars.append(PUSH_CHARS[ms % 64])
+        ms //= 64
+    return ''.join(reversed(chars))
+
+
+def push_key_time(key):
+    """Creation time (epoch ms) encoded in a push key, None if it is not one"""
+    if not isinstance(key, str) or len(key) < 8:
+        return None
+    ms = 0
+    for char in key[:8]:
+        index = PUSH_CHARS.find(char)
+        if index < 0:
+            return None
+        ms = ms * 64 + index
+    return ms
+
+
+def now_ms():
+    """Current time as epoch milliseconds"""
+    return int(time.time() * 1000)
+
+
+def new_timestamps():
+    """Timestamps for a message being written now - (display string, epoch ms)
+
+    `timestamp_ms` is the canonical field used for sorting, range queries and
+    "new since" checks; `timestamp` is kept in the legacy format for older clients.
+    """
+    ms = now_ms()
+    return str(datetime.fromtimestamp(ms / 1000)), ms
+
+
+def parse_legacy_timestamp(timestamp_str):
+    """Parse a legacy string timestamp - returns a naive datetime or None"""
+    if not timestamp_str or not isinstance(timestamp_str, str):
+        return None
+    try:
+        if 'T' in timestamp_str:
+            # ISO format - remove microseconds if present
+            timestamp_str = timestamp_str.split('.')[0] if '.' in timestamp_str else timestamp_str
+            dt = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+            return dt.replace(tzinfo=None) if dt.tzinfo else dt
+        # Legacy str(datetime.now()) format - drop microseconds
+        return datetime.strptime(timestamp_str.split('.')[0], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+
+
+def legacy_timestamp_ms(timestamp_str):
+    """Epoch milliseconds of a legacy string timestamp, 0 if it cannot be parsed"""
+    dt = parse_legacy_timestamp(timestamp_str)
+    if dt is None:
+        return 0
+    try:
+        return int(dt.timestamp() * 1000)
+    except (OverflowError, OSError, ValueError):
+        return 0
+
+
+def mail_timestamp_ms(mail):
+    """Sort key of a message - its epoch ms field, parsing the legacy string only as a fallback"""
+    value = mail.get('timestamp_ms')
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    return legacy_timestamp_ms(mail.get('timestamp'))
+
+
+def page_size(value, default=MAILBOX_PAGE_SIZE):
+    """Clamp a user supplied page size"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def encode_cursor(value, key):
+    raw = json.dumps([value, key], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into (order value, key) - returns None if it is malformed"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, key = json.loads(raw)
+        if not isinstance(key, str):
+            return None
+        return value, key
+    except (ValueError, TypeError):
+        return None
+
+
+def _order_value(order_by, key, mail):
+    if order_by == "$key":
+        return key
+    value = mail.get(order_by) if isinstance(mail, dict) else None
+    return value if value is not None else 0
+
+
+def _position(order_by, key, mail):
+    return (_order_value(order_by, key, mail), key)
+
+
+def _window(folder_ref, order_by, limit, before=None, after=None):
+    """Run the ordered query for one window, returns [(key, mail)] oldest first"""
+    wanted = limit + 1  # one extra item tells us whether there is more
+    # Entries that share the cursor's order value come back from the range
+    # query too, so over-fetch until enough items sort strictly past the cursor
+    request_size = wanted + 1
+    while True:
+        query = folder_ref.order_by_key() if order_by == "$key" else folder_ref.order_by_child(order_by)
+        if before:
+            query = query.end_at(before[0]).limit_to_last(request_size)
+        elif after:
+            query = query.start_at(after[0]).limit_to_first(request_size)
+        else:
+            query = query.limit_to_last(wanted)
+
+        result = query.get() or {}
+        items = [(k, m) for k, m in result.items() if isinstance(m, dict)]
+        if before:
+            items = [(k, m) for k, m in items if _position(order_by, k, m) < (before[0], before[1])]
+        elif after:
+            items = [(k, m) for k, m in items if _position(order_by, k, m) > (after[0], after[1])]
+
+        exhausted = len(result) < request_size
+        if not (before or after) or len(items) >= wanted or exhausted:
+            return items
+        request_size *= 2
+
+
+def fetch_folder_page(folder, user_key, limit=None, before=None, after=None):
+    """Fetch one window of a folder, newest first
+
+    `before` pages towards older mail and `after` towards newer mail; both are
+    opaque cursors handed out in a previous response. Returns the messages
+    (with their `id` set) plus the cursors for the neighbouring windows.
+    """
+    limit = page_size(limit)
+    order_by = FOLDER_ORDER[folder]
+    folder_ref = firebase.ref.child(folder).child(user_key)
+    before = decode_cursor(before)
+    after = decode_cursor(after) if not before else None
+
+    items = _window(folder_ref, order_by, limit, before, after)
+    items.sort(key=lambda item: _position(order_by, *item))
+
+    has_more = len(items) > limit
+    if after:
+        # Oldest-first query - the extra item is the newest one
+        items = items[:limit]
+        has_older, has_newer = True, has_more
+    else:
+        items = items[-limit:] if items else []
+        has_older, has_newer = has_more, bool(before)
+
+    messages = []
+    for key, mail in reversed(items):
+        mail['id'] = key
+        messages.append(mail)
+
+    # Cursor for the next (older) window, None once the folder is exhausted
+    next_cursor = None
+    if items and has_older:
+        next_cursor = encode_cursor(*_position(order_by, *items[0]))
+    # Cursor for polling mail newer than this window
+    prev_cursor = encode_cursor(*after) if after else None
+    if items:
+        prev_cursor = encode_cursor(*_position(order_by, *items[-1]))
+
+    return {
+        'messages': messages,
+        'next': next_cursor,
+        'prev': prev_cursor,
+        'has_more': has_older,
+        'has_newer': has_newer
+    }
+
+
+def fetch_messages(folder, user_key, mail_ids):
+    """Read the given messages of one folder with keyed range reads, in the order of `mail_ids`"""
+    found = read_keys(firebase.ref.child(folder).child(user_key), mail_ids)
+    messages = []
+    for mail_id in dict.fromkeys(mail_ids):
+        mail = found.get(mail_id)
+        if isinstance(mail, dict):
+            mail['id'] = mail_id
+            messages.append(mail)
+    return messages
+
+
+def fetch_messages_after(folder, user_key, after_key, limit=None):
+    """Messages of a push-keyed folder (inbox, sent) added after the key `after_key`
+
+    Keys are chronological, so this is one keyed range query however large
+    the folder is. Returns (messages oldest first, with their `id` set, and
+    whether more arrived than `limit`).
+    """
+    limit = page_size(limit)
+    folder_ref = firebase.ref.child(folder).child(user_key)
+    items = _window(folder_ref, "$key", limit, after=(after_key, after_key))
+    items.sort(key=lambda item: item[0])
+    messages = []
+    for key, mail in items[:limit]:
+        mail['id'] = key
+        messages.append(mail)
+    return messages, len(items) > limit
+
+
+def key_order(key):
+    """Sort key matching Firebase key order: 32-bit integer keys first (numerically), then strings"""
+    try:
+        number = int(key)
+    except (TypeError, ValueError):
+        return (1, 0, key)
+    if str(number) == str(key) and -2 ** 31 <= number < 2 ** 31:
+        return (0, number, '')
+    return (1, 0, str(key))
+
+
+def read_keys(parent_ref, keys, slack=4):
+    """{key: value} for the given children of `parent_ref` that exist
+
+    Ids picked from a list sit close together in key order, so one keyed range
+    query covers them. Integer-like keys (draft ids) sort before all other
+    keys, so they get a range of their own. Each range is capped at `slack`
+    entries per requested key; keys past the cap (ids scattered over a large
+    folder, like search hits) are read one by one, concurrently - so this must
+    not be called from a Fanout call.
+    """
+    keys = sorted(set(keys), key=key_order)
+    values = {}
+    for numeric in (True, False):
+        group = [key for key in keys if (key_order(key)[0] == 0) == numeric]
+        if group:
+            values.update(_read_key_range(parent_ref, group, slack))
+    return values
+
+
+def _read_key_range(parent_ref, keys, slack):
+    limit = max(len(keys) * slack, 100)
+    found = parent_ref.order_by_key().start_at(keys[0]).end_at(keys[-1]).limit_to_first(limit).get() or {}
+    values = {key: found[key] for key in keys if key in found}
+    last = next(reversed(found), None) if len(found) >= limit else None
+    if last is None:
+        return values
+    reads = Fanout()
+    for key in keys:
+        if key_order(key) > key_order(last):
+            reads.submit(key, parent_ref.child(key).get, label="read:keys")
+    values.update((key, value) for key, value in reads.results().items() if value is not None)
+    return values
+
+
+# ---------------- Mailbox view ----------------
+# Inbox categories in priority order with their keywords. Messages are
+# categorized once when they are delivered and the result is stored on the
+# message; after editing these lists run `flask recategorize-mail`.
+CATEGORY_KEYWORDS = (
+    ("Promotions", ("sale", "discount", "offer", "deal", "promo")),
+    ("Social", ("friend", "party", "social", "invite", "like", "comment")),
+    ("Updates", ("update", "news", "alert", "notification", "reminder"))
+)
+CATEGORY_PRIORITY = {category: rank for rank, (category, _) in enumerate(CATEGORY_KEYWORDS)}
+
+
+def _category_pattern():
+    # One alternation with a named group per category; whole words only
+    # (plus a plural "s"), so "like" does not match "likely"
+    groups = [
+        f"(?P<{category}>{'|'.join(re.escape(word) for word in keywords)})"
+        for category, keywords in CATEGORY_KEYWORDS
+    ]
+    return re.compile(r"\b(?:" + "|".join(groups) + r")s?\b", re.IGNORECASE)
+
+
+CATEGORY_PATTERN = _category_pattern()
+
+
+def categorize_mail(subject, message):
+    """Pick the inbox category of a message from its subject and body in one regex pass"""
+    best = None
+    for text in (subject, message):
+        for match in CATEGORY_PATTERN.finditer(text or ""):
+            category = match.lastgroup
+            if best is None or CATEGORY_PRIORITY[category] < CATEGORY_PRIORITY[best]:
+                best = category
+                if CATEGORY_PRIORITY[best] == 0:
+                    return best
+    return best or "Inbox"
+
+
+def mail_category(mail):
+    """Stored category of an inbox message; legacy messages are categorized on the fly"""
+    category = mail.get("category")
+    if category in INBOX_CATEGORIES:
+        return category
+    return categorize_mail(mail.get("subject", ""), mail.get("message", ""))
+
+
+def format_time(timestamp_str, timestamp_ms=None):
+    """Format timestamp for display - uses the epoch ms field when the message has one"""
+    try:
+        if timestamp_ms:
+            dt = datetime.fromtimestamp(timestamp_ms / 1000)
+        else:
+            if not timestamp_str:
+                return "Unknown"
+            dt = parse_legacy_timestamp(timestamp_str)
+            if dt is None:
+                # If all parsing fails, return original
+                return timestamp_str
+        
+        now = datetime.now()
+        diff = now - dt
+        
+        if diff.days == 0:
+            if diff.seconds < 3600:  # Less than 1 hour
+                minutes = diff.seconds // 60
+                return f"{minutes}m ago" if minutes > 0 else "Just now"
+            else:
+                hours = diff.seconds // 3600
+                return f"{hours}h ago"
+        elif diff.days == 1:
+            return "Yesterday"
+        elif diff.days < 7:
+            return f"{diff.days}d ago"
+        else:
+            return dt.strftime('%b %d')
+            
+    except Exception as e:
+        print(f"Error formatting time {timestamp_str}: {e}")
+        return "Unknown"
+
+
+def mail_addresses(*mail_lists):
+    """Collect the distinct sender/receiver addresses of one or more mail lists"""
+    addresses = set()
+    for mails in mail_lists:
+        for mail in mails:
+            addresses.add(mail.get('sender'))
+            addresses.add(mail.get('receiver'))
+    addresses.discard(None)
+    addresses.discard('')
+    return addresses
+
+
+def folder_cursors(**pages):
+    """Paging state of each fetched folder window, as handed to the client"""
+    return {
+        folder: {'next': page.get('next'), 'prev': page.get('prev'), 'has_more': page.get('has_more', False)}
+        for folder, page in pages.items()
+    }
+
+
+def enhance_email_data(mail, current_email, category=None, profiles=None):
+    """Enhance email data with avatar, name, and formatted time
+
+    `profiles` is an address -> avatar data map resolved up front with
+    get_profiles(); without it the two addresses are resolved here.
+    """
+    try:
+        # Parse the timestamp once - legacy messages without the epoch field get it here
+        mail['timestamp_ms'] = mail_timestamp_ms(mail)
+        
+        # Add formatted time
+        mail['formatted_time'] = format_time(mail.get('timestamp'), mail['timestamp_ms'])
+        
+        # Add message preview
+        message = mail.get('message', '')
+        mail['message_preview'] = message[:100] + '...' if len(message) > 100 else message
+        
+        # Add category if provided
+        if category:
+            mail['category'] = category
+        
+        sender_email = mail.get('sender')
+        receiver_email = mail.get('receiver')
+        if profiles is None:
+            profiles = get_profiles([sender_email, receiver_email])
+        
+        # Always get sender data
+        if sender_email:
+            sender_data = profiles.get(sender_email) or get_profile(sender_email)
+            mail['sender_name'] = sender_data['name']
+            mail['sender_initials'] = sender_data['initials']
+            mail['sender_avatar_color'] = sender_data['avatar_color']
+            mail['sender_avatar'] = sender_data['avatar']
+        
+        # Always get receiver data
+        if receiver_email:
+            receiver_data = profiles.get(receiver_email) or get_profile(receiver_email)
+            mail['receiver_name'] = receiver_data['name']
+            mail['receiver_initials'] = receiver_data['initials']
+            mail['receiver_avatar_color'] = receiver_data['avatar_color']
+            mail['receiver_avatar'] = receiver_data['avatar']
+        
+    except Exception as e:
+        print(f"Error enhancing email data: {e}")
+    
+    return mail
+
+
+INBOX_CATEGORIES = ("Inbox", "Promotions", "Social", "Updates")
+
+# Category label every message of a non-inbox folder is shown under
+FOLDER_CATEGORY = {
+    "sent": "Sent",
+    "drafts": "Drafts"
+}
+
+
+def build_mailbox_view(current_email, pages, ranked=False):
+    """Build the categorized mailbox view shared by /inbox and /api/refresh
+
+    `pages` maps folder name -> fetch_folder_page() result. Every timestamp is
+    parsed once into `timestamp_ms`, each folder is ordered once, and "All Mail"
+    is a k-way merge of the already ordered folders. The category lists and the
+    unified list share the same message objects.
+
+    With `ranked` the inbox page holds search results, best match first: they
+    keep that order and lead the unified list.
+    """
+    empty_page = {'messages': []}
+
+    # Received messages from the user's inbox
+    received = [m for m in pages.get("inbox", empty_page)['messages'] if m.get('receiver') == current_email]
+    folders = {
+        "inbox": received,
+        "sent": pages.get("sent", empty_page)['messages'],
+        "drafts": pages.get("drafts", empty_page)['messages']
+    }
+
+    # Resolve every distinct sender/receiver once for the whole window
+    profiles = get_profiles(mail_addresses(*folders.values()))
+
+    categorized_mails = {category: [] for category in INBOX_CATEGORIES}
+    for folder, mails in folders.items():
+        for mail in mails:
+            mail['timestamp_ms'] = mail_timestamp_ms(mail)
+        if not (ranked and folder == "inbox"):
+            # Pages arrive (nearly) in order already, so this sort is close to linear
+            mails.sort(key=itemgetter('timestamp_ms'), reverse=True)
+
+        if folder == "inbox":
+            for mail in mails:
+                category = mail_category(mail)
+                enhance_email_data(mail, current_email, category, profiles)
+                categorized_mails[category].append(mail)
+        else:
+            category = FOLDER_CATEGORY[folder]
+            for mail in mails:
+                enhance_email_data(mail, current_email, category, profiles)
+            categorized_mails[category] = mails
+
+    # Unified newest-first list for the All Mail view
+    if ranked:
+        others = [mails for folder, mails in folders.items() if folder != "inbox"]
+        all_emails_sorted = received + list(heapq.merge(*others, key=itemgetter('timestamp_ms'), reverse=True))
+    else:
+        all_emails_sorted = list(heapq.merge(*folders.values(), key=itemgetter('timestamp_ms'), reverse=True))
+
+    return {
+        'messages': received,
+        'categorized_mails': categorized_mails,
+        'all_emails_sorted': all_emails_sorted,
+        'cursors': folder_cursors(**pages)
+    }
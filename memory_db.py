@@ -0,0 +1,259 @@
+# In-memory stand-in for the firebase_admin Realtime Database API.
+# Implements the parts of db.Reference / db.Query the app uses (get, set,
+# update, push, delete, transaction and key/child/value ordered queries) so the
+# app can run locally and under test without credentials or network access.
+# Select it with FIREBASE_BACKEND=memory (see firebase.py).
+import copy
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+def _split(path):
+    return [p for p in (path or '').split('/') if p]
+
+
+def _key_sort(key):
+    # Keys that are 32-bit integers sort first, numerically, like in Firebase
+    try:
+        number = int(key)
+    except (TypeError, ValueError):
+        return (1, 0, key)
+    if str(number) == str(key) and -2 ** 31 <= number < 2 ** 31:
+        return (0, number, '')
+    return (1, 0, str(key))
+
+
+def _value_sort(value):
+    if value is None:
+        return (0, 0, '')
+    if value is False:
+        return (1, 0, '')
+    if value is True:
+        return (2, 0, '')
+    if isinstance(value, (int, float)):
+        return (3, value, '')
+    if isinstance(value, str):
+        return (4, 0, value)
+    return (5, 0, '')
+
+
+class PushIds:
+    """Chronologically sortable push keys, same format as Firebase's"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_push_time = 0
+        self._last_rand = [0] * 12
+
+    def next(self):
+        now = int(time.time() * 1000)
+        with self._lock:
+            duplicate = now == self._last_push_time
+            self._last_push_time = now
+            chars = []
+            for _ in range(8):
+                chars.append(PUSH_CHARS[now % 64])
+                now //= 64
+            key = ''.join(reversed(chars))
+            if not duplicate:
+                self._last_rand = [random.randint(0, 63) for _ in range(12)]
+            else:
+                i = 11
+                while i >= 0 and self._last_rand[i] == 63:
+                    self._last_rand[i] = 0
+                    i -= 1
+                self._last_rand[i] += 1
+            return key + ''.join(PUSH_CHARS[i] for i in self._last_rand)
+
+
+def order_items(data, order_by, start=None, end=None, first=None, last=None):
+    """[(key, value)] of the children of `data` selected and ordered like a Firebase query"""
+    def sort_value(key, value):
+        if order_by == '$key':
+            return _key_sort(key)
+        if order_by == '$value':
+            return _value_sort(value)
+        node = value
+        for p in _split(order_by):
+            node = node.get(p) if isinstance(node, dict) else None
+        return _value_sort(node)
+
+    items = sorted(data.items(), key=lambda kv: (sort_value(*kv), _key_sort(kv[0])))
+    bound = _key_sort if order_by == '$key' else _value_sort
+    if start is not None:
+        items = [kv for kv in items if sort_value(*kv) >= bound(start)]
+    if end is not None:
+        items = [kv for kv in items if sort_value(*kv) <= bound(end)]
+    if first is not None:
+        items = items[:first]
+    if last is not None:
+        items = items[-last:] if last else []
+    return items
+
+
+class MemoryDatabase:
+    """A JSON tree guarded by one lock; `calls` counts round trips and `latency` simulates them"""
+
+    def __init__(self, latency=0.0):
+        self.root = {}
+        self.lock = threading.RLock()
+        self.calls = 0
+        self.latency = latency
+        self._push_ids = PushIds()
+
+    def push_id(self):
+        return self._push_ids.next()
+
+    def _read(self, parts):
+        node = self.root
+        for p in parts:
+            if not isinstance(node, dict) or p not in node:
+                return None
+            node = node[p]
+        return node
+
+    def _write(self, parts, value):
+        if not parts:
+            self.root = value if isinstance(value, dict) else {}
+            return
+        if value is None:
+            trail = []
+            node = self.root
+            for p in parts[:-1]:
+                if not isinstance(node, dict) or p not in node:
+                    return
+                trail.append((node, p))
+                node = node[p]
+            if isinstance(node, dict):
+                node.pop(parts[-1], None)
+            # prune empty parents
+            for parent, p in reversed(trail):
+                if parent[p] == {}:
+                    del parent[p]
+            return
+        node = self.root
+        for p in parts[:-1]:
+            if not isinstance(node.get(p), dict):
+                node[p] = {}
+            node = node[p]
+        node[parts[-1]] = value
+
+    def _tick(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class Reference:
+    """Mirror of firebase_admin.db.Reference"""
+
+    def __init__(self, db, parts):
+        self._db = db
+        self._parts = parts
+
+    @property
+    def key(self):
+        return self._parts[-1] if self._parts else None
+
+    @property
+    def path(self):
+        return '/' + '/'.join(self._parts)
+
+    def child(self, path):
+        return Reference(self._db, self._parts + _split(path))
+
+    def get(self, etag=False, shallow=False):
+        self._db._tick()
+        with self._db.lock:
+            value = self._db._read(self._parts)
+            if shallow and isinstance(value, dict):
+                return {k: True for k in value}
+            return copy.deepcopy(value)
+
+    def set(self, value):
+        self._db._tick()
+        value = json.loads(json.dumps(value))
+        with self._db.lock:
+            self._db._write(self._parts, value)
+
+    def update(self, value):
+        if not value or not isinstance(value, dict):
+            raise ValueError('Value argument must be a non-empty dictionary.')
+        self._db._tick()
+        value = json.loads(json.dumps(value))
+        with self._db.lock:
+            for path, v in value.items():
+                self._db._write(self._parts + _split(path), v)
+
+    def push(self, value=''):
+        key = self._db.push_id()
+        ref = self.child(key)
+        ref.set(value)
+        return ref
+
+    def delete(self):
+        self._db._tick()
+        with self._db.lock:
+            self._db._write(self._parts, None)
+
+    def transaction(self, transaction_update):
+        with self._db.lock:
+            current = copy.deepcopy(self._db._read(self._parts))
+            new = transaction_update(current)
+            self._db._write(self._parts, json.loads(json.dumps(new)))
+            return new
+
+    def order_by_key(self):
+        return Query(self, '$key')
+
+    def order_by_child(self, path):
+        return Query(self, path)
+
+    def order_by_value(self):
+        return Query(self, '$value')
+
+
+class Query:
+    """Mirror of firebase_admin.db.Query; bounds are inclusive like Firebase's"""
+
+    def __init__(self, ref, order_by):
+        self._ref = ref
+        self._order_by = order_by
+        self._start = None
+        self._end = None
+        self._first = None
+        self._last = None
+
+    def start_at(self, start):
+        self._start = start
+        return self
+
+    def end_at(self, end):
+        self._end = end
+        return self
+
+    def equal_to(self, value):
+        self._start = self._end = value
+        return self
+
+    def limit_to_first(self, n):
+        self._first = n
+        return self
+
+    def limit_to_last(self, n):
+        self._last = n
+        return self
+
+    def get(self):
+        self._ref._db._tick()
+        with self._ref._db.lock:
+            data = self._ref._db._read(self._ref._parts)
+            if not isinstance(data, dict):
+                return copy.deepcopy(data)
+            items = order_items(data, self._order_by, self._start, self._end, self._first, self._last)
+            return OrderedDict((k, copy.deepcopy(v)) for k, v in items)
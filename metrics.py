@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+
+# Minimal Prometheus instrumentation (text exposition format 0.0.4) without
+# a client library. Counters and histograms are updated on the hot path
+# under one small lock; values owned by other modules (cache statistics,
+# rate-limit rejections, queue depths) are read by collectors at scrape time.
+METRICS_FIREBASE_BYTES = os.environ.get('METRICS_FIREBASE_BYTES', '1') != '0'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(labels):
+    labels = list(labels)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self, **labels):
+        """Sum of all series whose labels include `labels`"""
+        wanted = [(self.labelnames.index(name), value) for name, value in labels.items()]
+        with _lock:
+            return sum(value for key, value in self._values.items()
+                       if all(key[i] == v for i, v in wanted))
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with _lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_labels_text(zip(self.labelnames, key))} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with _lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels_text(labels + [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels_text(labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """Register fn() -> [(name, type, help, [(labels dict, value)])], called at scrape time"""
+        self.collectors.append(fn)
+        return fn
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        for collect in self.collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                print(f"Error collecting metrics from {collect.__name__}: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels_text(sorted(labels.items()))} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.histogram(
+    "bharatmail_request_duration_seconds", "Request latency by route",
+    ("endpoint", "method", "status"))
+MESSAGES_PER_REQUEST = registry.histogram(
+    "bharatmail_messages_per_request", "Messages loaded to answer a request",
+    ("endpoint",), buckets=COUNT_BUCKETS)
+FIREBASE_CALLS = registry.counter(
+    "bharatmail_firebase_calls_total", "Firebase calls by operation and path pattern",
+    ("op", "path", "outcome"))
+FIREBASE_LATENCY = registry.histogram(
+    "bharatmail_firebase_call_duration_seconds", "Firebase call latency by operation and path pattern",
+    ("op", "path"))
+FIREBASE_BYTES = registry.counter(
+    "bharatmail_firebase_bytes_total", "JSON bytes read from / written to Firebase by path pattern",
+    ("op", "path", "direction"))
+READ_CACHE_LOOKUPS = registry.counter(
+    "bharatmail_read_cache_lookups_total", "Database reads looked up in the request read cache by route",
+    ("endpoint", "outcome"))
+
+
+# ---------------- Firebase instrumentation ----------------
+# Path segments below a top-level node are keys (users, message ids, hashes,
+# tokens) and are collapsed to "*" so the number of series stays bounded;
+# the fixed sub-nodes of the indexes are kept.
+STRUCTURAL_SEGMENTS = {"docs", "terms", "vocab", "first_name", "last_name", "avatar_hash", "profile_pic"}
+
+
+def path_pattern(parts):
+    if not parts:
+        return "/"
+    pattern = [parts[0]]
+    for part in parts[1:]:
+        pattern.append(part if part in STRUCTURAL_SEGMENTS else "*")
+    return "/" + "/".join(pattern)
+
+
+def _size(value):
+    if not METRICS_FIREBASE_BYTES or value is None:
+        return 0
+    try:
+        return len(json.dumps(value, separators=(",", ":"), default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _timed_call(op, parts, fn, args, kwargs, sent=None):
+    path = path_pattern(parts)
+    started = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        FIREBASE_CALLS.inc(op=op, path=path, outcome="error")
+        raise
+    finally:
+        FIREBASE_LATENCY.observe(time.perf_counter() - started, op=op, path=path)
+    FIREBASE_CALLS.inc(op=op, path=path, outcome="ok")
+    if sent is not None:
+        FIREBASE_BYTES.inc(_size(sent), op=op, path=path, direction="sent")
+    if op in ("get", "query", "get_children"):
+        FIREBASE_BYTES.inc(_size(result), op=op, path=path, direction="received")
+    return result
+
+
+class InstrumentedQuery:
+    def __init__(self, query, parts):
+        self._query = query
+        self._parts = parts
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):
+            return InstrumentedQuery(attr(*args, **kwargs), self._parts)
+        return chained
+
+    def get(self, *args, **kwargs):
+        return _timed_call("query", self._parts, self._query.get, args, kwargs)
+
+
+class InstrumentedReference:
+    """Wraps a firebase_admin (or memory_db) Reference and accounts every call"""
+
+    def __init__(self, ref, parts=()):
+        self._ref = ref
+        self._parts = tuple(parts)
+
+    def __getattr__(self, name):
+        return getattr(self._ref, name)
+
+    def child(self, path):
+        parts = self._parts + tuple(part for part in str(path).split("/") if part)
+        return InstrumentedReference(self._ref.child(path), parts)
+
+    def get(self, *args, **kwargs):
+        op = "get_shallow" if kwargs.get("shallow") else "get"
+        return _timed_call(op, self._parts, self._ref.get, args, kwargs)
+
+    def get_children(self, keys, shallow=False):
+        # SQLite backend only (see sqlite_db.Reference.get_children)
+        return _timed_call("get_children", self._parts, self._ref.get_children, (keys,), {'shallow': shallow})
+
+    def set(self, value):
+        return _timed_call("set", self._parts, self._ref.set, (value,), {}, sent=value)
+
+    def update(self, value):
+        # A multi-path update at the root is accounted under its first node
+        parts = self._parts or tuple(next(iter(value), "").split("/")[:1])
+        op = "update" if self._parts else "multi_update"
+        return _timed_call(op, parts, self._ref.update, (value,), {}, sent=value)
+
+    def push(self, value=''):
+        pushed = _timed_call("push", self._parts, self._ref.push, (value,), {}, sent=value)
+        return InstrumentedReference(pushed, self._parts + (pushed.key,))
+
+    def delete(self):
+        return _timed_call("delete", self._parts, self._ref.delete, (), {})
+
+    def transaction(self, transaction_update):
+        return _timed_call("transaction", self._parts, self._ref.transaction, (transaction_update,), {})
+
+    def order_by_key(self):
+        return InstrumentedQuery(self._ref.order_by_key(), self._parts)
+
+    def order_by_child(self, path):
+        return InstrumentedQuery(self._ref.order_by_child(path), self._parts)
+
+    def order_by_value(self):
+        return InstrumentedQuery(self._ref.order_by_value(), self._parts)
+
+
+def cache_samples(caches):
+    """Collector families for {cache name: TTLCache.stats()}"""
+    hits, misses, sizes, ratios = [], [], [], []
+    for name, stats in caches.items():
+        labels = {'cache': name}
+        hits.append((labels, stats.get('hits', 0)))
+        misses.append((labels, stats.get('misses', 0)))
+        sizes.append((labels, stats.get('size', 0)))
+        ratios.append((labels, stats.get('hit_ratio') or 0))
+    return [
+        ("bharatmail_cache_hits_total", "counter", "Cache hits", hits),
+        ("bharatmail_cache_misses_total", "counter", "Cache misses", misses),
+        ("bharatmail_cache_entries", "gauge", "Entries currently cached", sizes),
+        ("bharatmail_cache_hit_ratio", "gauge", "Cache hits / lookups since start", ratios)
+    ]
@@ -0,0 +1,147 @@
+import firebase
+from mailstore import FOLDERS, legacy_timestamp_ms, categorize_mail
+from avatars import avatar_hash, store_avatar, decode_data_url
+
+# Offline data migrations, run through the Flask CLI (see the commands in app.py).
+# Folders are streamed in key-ordered windows instead of downloading whole
+# subtrees, and fixes are written back in batched multi-path updates.
+STREAM_WINDOW = 500
+
+
+def iter_folder_owners(folder):
+    """Yield the user keys that have a node under `folder` (shallow read, keys only)"""
+    owners = firebase.ref.child(folder).get(shallow=True) or {}
+    for user_key in sorted(owners):
+        yield user_key
+
+
+def iter_folder_items(folder, user_key, window=STREAM_WINDOW):
+    """Yield (key, message) pairs of one folder, `window` messages per read"""
+    return iter_children(firebase.ref.child(folder).child(user_key), window)
+
+
+def iter_children(parent_ref, window=STREAM_WINDOW):
+    """Yield the (key, value) pairs of the dict children of `parent_ref`, `window` per read"""
+    last_key = None
+    while True:
+        query = parent_ref.order_by_key()
+        if last_key is not None:
+            query = query.start_at(last_key)
+        # start_at is inclusive, so fetch one extra item to skip the previous last key
+        result = query.limit_to_first(window + (1 if last_key is not None else 0)).get() or {}
+        items = [(k, m) for k, m in result.items() if k != last_key]
+        for key, value in items:
+            if isinstance(value, dict):
+                yield key, value
+        if len(items) < window:
+            return
+        last_key = items[-1][0]
+
+
+class BatchWriter:
+    """Collects path -> value updates and flushes them as one multi-path update"""
+
+    def __init__(self, batch_size=500, dry_run=False):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.pending = {}
+        self.written = 0
+        self.batches = 0
+
+    def set(self, path, value):
+        self.pending[path] = value
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if not self.dry_run:
+            firebase.ref.update(self.pending)
+        self.written += len(self.pending)
+        self.batches += 1
+        self.pending = {}
+
+
+def backfill_timestamps(batch_size=500, dry_run=False, log=print):
+    """Add `timestamp_ms` to every message that only has the legacy string timestamp"""
+    writer = BatchWriter(batch_size, dry_run)
+    scanned = unparseable = 0
+    for folder in FOLDERS:
+        for user_key in iter_folder_owners(folder):
+            for key, mail in iter_folder_items(folder, user_key):
+                scanned += 1
+                if isinstance(mail.get('timestamp_ms'), (int, float)):
+                    continue
+                timestamp_ms = legacy_timestamp_ms(mail.get('timestamp'))
+                if not timestamp_ms:
+                    unparseable += 1
+                    log(f"Could not parse timestamp of {folder}/{user_key}/{key}: {mail.get('timestamp')!r}")
+                    continue
+                writer.set(f"{folder}/{user_key}/{key}/timestamp_ms", timestamp_ms)
+            log(f"{folder}/{user_key} done ({scanned} messages scanned so far)")
+    writer.flush()
+    return {
+        'scanned': scanned,
+        'updated': writer.written,
+        'batches': writer.batches,
+        'unparseable': unparseable,
+        'dry_run': dry_run
+    }
+
+
+def recategorize_mail(batch_size=500, dry_run=False, log=print):
+    """Store the current keyword category on every inbox message whose category differs"""
+    writer = BatchWriter(batch_size, dry_run)
+    scanned = 0
+    changed = {}
+    for user_key in iter_folder_owners("inbox"):
+        for key, mail in iter_folder_items("inbox", user_key):
+            scanned += 1
+            category = categorize_mail(mail.get('subject', ''), mail.get('message', ''))
+            if mail.get('category') == category:
+                continue
+            changed[category] = changed.get(category, 0) + 1
+            writer.set(f"inbox/{user_key}/{key}/category", category)
+        log(f"inbox/{user_key} done ({scanned} messages scanned so far)")
+    writer.flush()
+    return {
+        'scanned': scanned,
+        'updated': writer.written,
+        'by_category': changed,
+        'batches': writer.batches,
+        'dry_run': dry_run
+    }
+
+
+def migrate_profile_pictures(batch_size=500, dry_run=False, log=print):
+    """Move inline data: URL profile pictures into the avatar store, leaving the hash on the user"""
+    writer = BatchWriter(batch_size, dry_run)
+    scanned = moved = invalid = 0
+    hashes = set()
+    for user_key, user in iter_children(firebase.ref.child("users")):
+        scanned += 1
+        profile_pic = user.get('profile_pic')
+        if not profile_pic:
+            continue
+        png = decode_data_url(profile_pic)
+        if png is None:
+            # Static file paths and other URLs are left alone
+            invalid += 1
+            log(f"users/{user_key}: profile_pic is not a PNG data URL, skipped")
+            continue
+        digest = avatar_hash(png) if dry_run else store_avatar(png)
+        hashes.add(digest)
+        writer.set(f"users/{user_key}/avatar_hash", digest)
+        writer.set(f"users/{user_key}/profile_pic", None)
+        moved += 1
+    writer.flush()
+    log(f"{scanned} users scanned")
+    return {
+        'scanned': scanned,
+        'moved': moved,
+        'distinct_images': len(hashes),
+        'skipped': invalid,
+        'batches': writer.batches,
+        'dry_run': dry_run
+    }
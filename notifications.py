@@ -0,0 +1,236 @@
+import os
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+import firebase
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Background dispatch of new-mail push notifications.
+# Delivery only calls dispatcher.notify(); everything else - reading the
+# receiver's notification settings, building the payload and talking to the
+# push service - happens on a small pool of worker threads. Mails that arrive
+# for the same user within NOTIFY_COALESCE_SECONDS go out as one notification.
+# Failed sends are retried with exponential backoff. The queue is bounded by
+# the number of users waiting; when it is full new notifications are dropped
+# (they are a nicety, the mail itself is already delivered).
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', 2))
+NOTIFY_QUEUE_SIZE = int(os.environ.get('NOTIFY_QUEUE_SIZE', 1000))
+NOTIFY_COALESCE_SECONDS = float(os.environ.get('NOTIFY_COALESCE_SECONDS', 2))
+NOTIFY_MAX_ATTEMPTS = 4
+NOTIFY_BACKOFF_SECONDS = 1.0
+# Mails listed in a coalesced notification; the rest are only counted
+MAX_MAILS_PER_NOTIFICATION = 5
+
+# notifications/<user_key> changes only when the user toggles notifications
+_settings = TTLCache(maxsize=4096, ttl=60)
+
+
+class LogTransport:
+    """Logs notifications instead of sending them (development and tests)"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, subscription, payload):
+        self.sent.append((subscription, payload))
+        del self.sent[:-100]
+        logger.info("Push notification: %s - %s", payload['title'], payload['body'])
+
+
+class WebPushTransport:
+    """Sends Web Push messages with pywebpush (optional dependency)"""
+
+    def __init__(self, private_key, subject):
+        from pywebpush import webpush  # only needed when this transport is used
+        self._webpush = webpush
+        self.private_key = private_key
+        self.claims = {'sub': subject}
+
+    def send(self, subscription, payload):
+        self._webpush(
+            subscription_info=subscription,
+            data=json.dumps(payload),
+            vapid_private_key=self.private_key,
+            vapid_claims=dict(self.claims),
+            timeout=10
+        )
+
+
+def default_transport():
+    """Transport picked by NOTIFICATION_TRANSPORT ("log" or "webpush")"""
+    if os.environ.get('NOTIFICATION_TRANSPORT', 'log') == 'webpush':
+        return WebPushTransport(os.environ['VAPID_PRIVATE_KEY'],
+                                os.environ.get('VAPID_SUBJECT', 'mailto:admin@bharatmail.in'))
+    return LogTransport()
+
+
+def notification_settings(user_key):
+    """The user's stored notification settings (cached), or None"""
+    settings = _settings.get(user_key)
+    if settings is None:
+        settings = firebase.ref.child("notifications").child(user_key).get() or {}
+        _settings.set(user_key, settings)
+    return settings or None
+
+
+def invalidate_settings(user_email):
+    """Call after the user's notification settings were changed"""
+    _settings.pop(user_email.replace(".", ","))
+
+
+def settings_cache_stats():
+    return _settings.stats()
+
+
+def build_payload(mails, total):
+    """Notification for `total` new mails, the first few of which are in `mails`"""
+    if total == 1:
+        mail = mails[0]
+        return {
+            'title': f"New email from {mail.get('sender', 'Unknown')}",
+            'body': mail.get('subject') or '(No subject)',
+            'icon': '/static/logo.png',
+            'badge': '/static/logo.png',
+            'url': '/inbox',
+            'mailId': mail.get('id')
+        }
+    senders = list(dict.fromkeys(mail.get('sender', 'Unknown') for mail in mails))
+    return {
+        'title': f"{total} new emails",
+        'body': ", ".join(senders) + (" and others" if total > len(mails) else ""),
+        'icon': '/static/logo.png',
+        'badge': '/static/logo.png',
+        'url': '/inbox',
+        'mailIds': [mail.get('id') for mail in mails]
+    }
+
+
+class NotificationDispatcher:
+    def __init__(self, transport=None, workers=NOTIFY_WORKERS, queue_size=NOTIFY_QUEUE_SIZE,
+                 coalesce_seconds=NOTIFY_COALESCE_SECONDS, max_attempts=NOTIFY_MAX_ATTEMPTS,
+                 backoff_seconds=NOTIFY_BACKOFF_SECONDS):
+        self.transport = transport
+        self.workers = workers
+        self.queue_size = queue_size
+        self.coalesce_seconds = coalesce_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        # user_email -> {'mails', 'total', 'queued_at', 'attempts'}; scheduled in _due
+        self._pending = {}
+        self._due = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self.counters = {'queued': 0, 'coalesced': 0, 'sent': 0, 'skipped': 0,
+                         'retried': 0, 'failed': 0, 'dropped': 0}
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def _start(self):
+        # Threads are started on first use so they live in the serving process
+        # (gunicorn forks after importing the app)
+        if self._threads:
+            return
+        if self.transport is None:
+            self.transport = default_transport()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"notify-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def notify(self, user_email, mail):
+        """Queue a new-mail notification for `user_email`; never blocks"""
+        with self._cond:
+            self._start()
+            batch = self._pending.get(user_email)
+            if batch is not None:
+                batch['total'] += 1
+                if len(batch['mails']) < MAX_MAILS_PER_NOTIFICATION:
+                    batch['mails'].append(mail)
+                self.counters['coalesced'] += 1
+                return True
+            if len(self._pending) >= self.queue_size:
+                self.counters['dropped'] += 1
+                return False
+            self._pending[user_email] = {'mails': [mail], 'total': 1, 'queued_at': time.monotonic(), 'attempts': 0}
+            self._schedule(user_email, self.coalesce_seconds)
+            self.counters['queued'] += 1
+            return True
+
+    def _schedule(self, user_email, delay):
+        heapq.heappush(self._due, (time.monotonic() + delay, next(self._seq), user_email))
+        self._cond.notify()
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._due and self._due[0][0] <= time.monotonic():
+                    _, _, user_email = heapq.heappop(self._due)
+                    batch = self._pending.pop(user_email, None)
+                    if batch is not None:
+                        return user_email, batch
+                    continue
+                self._cond.wait(timeout=self._due[0][0] - time.monotonic() if self._due else None)
+
+    def _work(self):
+        while True:
+            user_email, batch = self._next_batch()
+            try:
+                sent = self._send(user_email, batch)
+            except Exception as e:
+                self._retry(user_email, batch, e)
+                continue
+            with self._cond:
+                if sent:
+                    latency = time.monotonic() - batch['queued_at']
+                    self.counters['sent'] += 1
+                    self._latency_total += latency
+                    self._latency_max = max(self._latency_max, latency)
+                else:
+                    self.counters['skipped'] += 1
+
+    def _send(self, user_email, batch):
+        settings = notification_settings(user_email.replace(".", ","))
+        if not settings or not settings.get('enabled') or not settings.get('subscription'):
+            return False
+        self.transport.send(settings['subscription'], build_payload(batch['mails'], batch['total']))
+        return True
+
+    def _retry(self, user_email, batch, error):
+        with self._cond:
+            batch['attempts'] += 1
+            if batch['attempts'] >= self.max_attempts:
+                self.counters['failed'] += 1
+                print(f"Giving up on notification for {user_email}: {error}")
+                return
+            newer = self._pending.get(user_email)
+            if newer is not None:
+                # Mails that arrived meanwhile are already scheduled; the failed ones ride along
+                newer['total'] += batch['total']
+                newer['mails'] = (batch['mails'] + newer['mails'])[:MAX_MAILS_PER_NOTIFICATION]
+                newer['queued_at'] = batch['queued_at']
+                newer['attempts'] = batch['attempts']
+            else:
+                self._pending[user_email] = batch
+                self._schedule(user_email, self.backoff_seconds * 2 ** (batch['attempts'] - 1))
+            self.counters['retried'] += 1
+            print(f"Error sending notification to {user_email} (attempt {batch['attempts']}): {error}")
+
+    def stats(self):
+        with self._cond:
+            sent = self.counters['sent']
+            return {
+                **self.counters,
+                'queue_depth': len(self._pending),
+                'workers': len(self._threads),
+                'avg_latency_ms': round(self._latency_total * 1000 / sent, 1) if sent else None,
+                'max_latency_ms': round(self._latency_max * 1000, 1)
+            }
+
+
+dispatcher = NotificationDispatcher()
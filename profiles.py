@@ -0,0 +1,110 @@
+import os
+from cache import TTLCache
+from avatars import profile_pic_url
+
+# Sender/receiver profile resolution shared across requests.
+# Entries only hold what the mail list renders (name, initials, colour, avatar),
+# never the full user record, and are invalidated explicitly on profile changes.
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 1024))
+PROFILE_CACHE_TTL = int(os.environ.get('PROFILE_CACHE_TTL', 300))
+
+profile_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+
+AVATAR_DATA_COLORS = ['#FF5733', '#33A1FF', '#28A745', '#FFC300', '#8E44AD', '#FF69B4', '#20B2AA', '#FF4500']
+
+
+def fallback_avatar_data(email):
+    """Avatar data for addresses without a user record"""
+    return {
+        'initials': email[:2].upper() if email else 'U',
+        'avatar_color': '#666666',
+        'avatar': None,
+        'name': email.split('@')[0].replace('.', ' ').title() if email else 'Unknown'
+    }
+
+
+def build_avatar_data(email, user_data):
+    """Build avatar data (initials, color, avatar image) from a user record"""
+    if not user_data:
+        return fallback_avatar_data(email)
+
+    first_name = user_data.get('first_name', '').strip()
+    last_name = user_data.get('last_name', '').strip()
+
+    # Generate initials
+    if first_name and last_name:
+        initials = (first_name[0] + last_name[0]).upper()
+    elif first_name:
+        initials = first_name[:2].upper()
+    elif last_name:
+        initials = last_name[:2].upper()
+    else:
+        initials = email[:2].upper()
+
+    # Generate consistent background color based on email
+    color_index = sum(ord(c) for c in email) % len(AVATAR_DATA_COLORS)
+
+    return {
+        'initials': initials,
+        'avatar_color': AVATAR_DATA_COLORS[color_index],
+        'avatar': profile_pic_url(user_data),
+        'name': f"{first_name} {last_name}".strip() or email.split('@')[0].replace('.', ' ').title()
+    }
+
+
+def prime_profile(email, user_data):
+    """Store a user record that was already fetched for another reason"""
+    if email:
+        profile_cache.set(email, build_avatar_data(email, user_data))
+
+
+def get_profiles(emails):
+    """Resolve many addresses at once - each distinct address is fetched at most once,
+    all missing ones together (storage.get_users)"""
+    profiles = {}
+    missing = []
+    for email in set(e for e in emails if e):
+        data = profile_cache.get(email)
+        if data is None:
+            missing.append(email)
+        else:
+            profiles[email] = data
+
+    if not missing:
+        return profiles
+    # storage imports mailstore, which imports this module
+    from storage import storage
+    try:
+        users = storage.get_users([email.replace(".", ",") for email in missing])
+    except Exception as e:
+        print(f"Error getting user avatar data for {missing}: {e}")
+        # Don't cache failures, the next request will retry
+        users = None
+    for email in missing:
+        if users is None:
+            profiles[email] = fallback_avatar_data(email)
+            continue
+        data = build_avatar_data(email, users.get(email.replace(".", ",")))
+        profile_cache.set(email, data)
+        profiles[email] = data
+    return profiles
+
+
+def get_profile(email):
+    """Resolve a single address"""
+    if not email:
+        return {
+            'initials': 'U',
+            'avatar_color': '#666666',
+            'avatar': None
+        }
+    return get_profiles([email])[email]
+
+
+def invalidate_profile(email):
+    """Drop a cached profile after the user record changed or was deleted"""
+    profile_cache.pop(email)
+
+
+def profile_cache_stats():
+    return profile_cache.stats()
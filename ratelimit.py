@@ -0,0 +1,163 @@
+import os
+import math
+import time
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Sliding-window rate limiting with constant time and memory per key.
+# Each key keeps the request count of the current fixed window and of the one
+# before; the rate is estimated as
+#   previous * (share of the previous window still inside the sliding window) + current
+# which is what a true sliding log would count, assuming requests in the
+# previous window were spread evenly.
+# Backends:
+#   memory - per process; idle keys are evicted after two windows
+#   sqlite - one file shared by all workers on the host, so N gunicorn
+#            workers allow the configured rate instead of N times it
+#   none   - no limits (benchmarks, load tests)
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', os.path.join(tempfile.gettempdir(), "bharatmail-ratelimit.sqlite3"))
+
+
+def sliding_window(state, now, limit, window):
+    """Apply one request to (window_start, count, previous) state
+
+    Returns (allowed, new state, retry_after seconds).
+    """
+    start = math.floor(now / window) * window
+    window_start, count, previous = state or (start, 0, 0)
+    if window_start != start:
+        previous = count if window_start == start - window else 0
+        count = 0
+    elapsed = now - start
+    estimate = previous * (1 - elapsed / window) + count
+    if estimate + 1 > limit:
+        if count + 1 > limit or not previous:
+            retry_after = window - elapsed
+        else:
+            # Until enough of the previous window has slid out
+            retry_after = window * (1 - (limit - count - 1) / previous) - elapsed
+        return False, (start, count, previous), max(1, math.ceil(retry_after))
+    return True, (start, count + 1, previous), 0
+
+
+class MemoryBackend:
+    """Per-process state; least recently used keys are dropped once idle"""
+
+    def __init__(self):
+        self._state = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        with self._lock:
+            entry = self._state.pop(key, None)
+            allowed, state, retry_after = sliding_window(entry and entry[1], now, limit, window)
+            # Idle for two windows the state counts nothing any more
+            self._state[key] = (now + 2 * window, state)
+            self._evict(now)
+            return allowed, retry_after
+
+    def _evict(self, now):
+        # Keys are in last-use order, so expired ones are at the front
+        while self._state:
+            key, (expires_at, _) = next(iter(self._state.items()))
+            if expires_at > now:
+                break
+            del self._state[key]
+
+    def size(self):
+        return len(self._state)
+
+
+class SQLiteBackend:
+    """State in a SQLite file shared by the workers of one host"""
+
+    EVICT_EVERY = 1000
+
+    def __init__(self, path=RATE_LIMIT_DB):
+        self.path = path
+        self._local = threading.local()
+        self._hits = 0
+        with self._connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS rate_limits (
+                key TEXT PRIMARY KEY, window_start REAL, count INTEGER, previous INTEGER, expires_at REAL)""")
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def hit(self, key, limit, window, now):
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT window_start, count, previous FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            allowed, state, retry_after = sliding_window(row, now, limit, window)
+            db.execute("INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?, ?)", (key, *state, now + 2 * window))
+            self._hits += 1
+            if self._hits % self.EVICT_EVERY == 0:
+                db.execute("DELETE FROM rate_limits WHERE expires_at <= ?", (now,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return allowed, retry_after
+
+    def size(self):
+        return self._connect().execute("SELECT COUNT(*) FROM rate_limits").fetchone()[0]
+
+
+class NullBackend:
+    """Allows everything; for benchmarks and load tests that must not be throttled"""
+
+    def hit(self, key, limit, window, now):
+        return True, 0
+
+    def size(self):
+        return 0
+
+
+class RateLimiter:
+    def __init__(self, backend):
+        self.backend = backend
+        self.allowed = 0
+        self.rejected = {}
+
+    def hit(self, scope, key, limit, window):
+        """Count one request of `key` against `scope`; returns (allowed, retry_after)"""
+        try:
+            allowed, retry_after = self.backend.hit(f"{scope}:{key}", limit, window, time.time())
+        except sqlite3.Error as e:
+            # A broken limiter store must not take the app down with it
+            print(f"Rate limiter error: {e}")
+            return True, 0
+        if allowed:
+            self.allowed += 1
+        else:
+            self.rejected[scope] = self.rejected.get(scope, 0) + 1
+        return allowed, retry_after
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'keys': self.backend.size(),
+            'allowed': self.allowed,
+            'rejected': dict(self.rejected)
+        }
+
+
+def default_backend():
+    if RATE_LIMIT_BACKEND == "sqlite":
+        return SQLiteBackend(RATE_LIMIT_DB)
+    if RATE_LIMIT_BACKEND == "none":
+        return NullBackend()
+    return MemoryBackend()
+
+
+limiter = RateLimiter(default_backend())
@@ -0,0 +1,170 @@
+import os
+import copy
+import threading
+import contextvars
+
+# Request-scoped identity map in front of the database reference.
+# While a request is handled every path read through `firebase.ref` is
+# remembered, and later reads of the same path - or of anything below a node
+# that was read whole - are answered from memory. Writes through the same
+# reference drop the entries they touch (the path, everything below it and
+# its ancestors), so a request always sees its own writes. The map is thrown
+# away when the request ends; reads outside a request (jobs, notification
+# workers, CLI commands) go straight to the database. Fanout calls run in the
+# context of the request that submitted them and share its map.
+# Callers get copies, so changing a returned dict cannot change what the next
+# reader sees, and nodes with more than READ_CACHE_MAX_CHILDREN children
+# (whole folders) are not kept: copying them costs more than the read they
+# could save. Ordered queries are not cached.
+READ_CACHE = os.environ.get('READ_CACHE', '1') != '0'
+READ_CACHE_MAX_CHILDREN = int(os.environ.get('READ_CACHE_MAX_CHILDREN', 100))
+
+_current = contextvars.ContextVar("read_cache", default=None)
+_MISSING = object()
+
+
+def _shallow(value):
+    return {key: True for key in value} if isinstance(value, dict) else value
+
+
+class ReadCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (path parts, shallow) -> value as read
+        self._entries = {}
+        self.reads = 0
+        self.saved = 0
+
+    def _find(self, parts, shallow):
+        if (parts, shallow) in self._entries:
+            return True, self._entries[(parts, shallow)]
+        # A whole read of the node or of an ancestor also holds this path
+        for depth in range(len(parts), -1, -1):
+            value = self._entries.get((parts[:depth], False), _MISSING)
+            if value is _MISSING:
+                continue
+            for part in parts[depth:]:
+                value = value.get(part) if isinstance(value, dict) else None
+            return True, _shallow(value) if shallow else value
+        return False, None
+
+    def lookup(self, parts, shallow=False):
+        """(True, copy of the value) if the path was read before, else (False, None)"""
+        with self._lock:
+            self.reads += 1
+            found, value = self._find(parts, shallow)
+            if not found:
+                return False, None
+            self.saved += 1
+        return True, copy.deepcopy(value)
+
+    def store(self, parts, shallow, value):
+        if isinstance(value, dict) and len(value) > READ_CACHE_MAX_CHILDREN:
+            return
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[(parts, shallow)] = value
+
+    def invalidate(self, parts):
+        """Forget the path, everything below it and its ancestors"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0][:len(parts)] == parts or parts[:len(key[0])] == key[0]]:
+                del self._entries[key]
+
+
+def start():
+    """Give the current request a fresh read cache"""
+    if READ_CACHE:
+        _current.set(ReadCache())
+
+
+def stop():
+    """Drop the current request's read cache and return it (None if there was none)"""
+    cache = _current.get()
+    _current.set(None)
+    return cache
+
+
+def _split(path):
+    return tuple(part for part in str(path).split("/") if part)
+
+
+class CachedReference:
+    """Wraps a Reference; plain reads go through the current request's ReadCache"""
+
+    def __init__(self, ref, parts=()):
+        self._ref = ref
+        self._parts = tuple(parts)
+
+    def __getattr__(self, name):
+        return getattr(self._ref, name)
+
+    def _invalidate(self, *paths):
+        cache = _current.get()
+        if cache is not None:
+            for parts in paths:
+                cache.invalidate(parts)
+
+    def child(self, path):
+        return CachedReference(self._ref.child(path), self._parts + _split(path))
+
+    def get(self, *args, **kwargs):
+        cache = _current.get()
+        if cache is None or args or set(kwargs) - {"shallow"}:
+            return self._ref.get(*args, **kwargs)
+        shallow = bool(kwargs.get("shallow"))
+        found, value = cache.lookup(self._parts, shallow)
+        if found:
+            return value
+        value = self._ref.get(**kwargs)
+        cache.store(self._parts, shallow, value)
+        return value
+
+    def get_children(self, keys, shallow=False):
+        # SQLite backend only (see sqlite_db.Reference.get_children)
+        cache = _current.get()
+        if cache is None:
+            return self._ref.get_children(keys, shallow=shallow)
+        values = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            found, value = cache.lookup(self._parts + (key,), shallow)
+            if not found:
+                missing.append(key)
+            elif value is not None:
+                values[key] = value
+        if missing:
+            fetched = self._ref.get_children(missing, shallow=shallow)
+            for key in missing:
+                cache.store(self._parts + (key,), shallow, fetched.get(key))
+            values.update(fetched)
+        return values
+
+    def set(self, value):
+        try:
+            return self._ref.set(value)
+        finally:
+            self._invalidate(self._parts)
+
+    def update(self, value):
+        try:
+            return self._ref.update(value)
+        finally:
+            self._invalidate(*(self._parts + _split(path) for path in value))
+
+    def push(self, value=''):
+        pushed = self._ref.push(value)
+        self._invalidate(self._parts + (pushed.key,))
+        return CachedReference(pushed, self._parts + (pushed.key,))
+
+    def delete(self):
+        try:
+            return self._ref.delete()
+        finally:
+            self._invalidate(self._parts)
+
+    def transaction(self, transaction_update):
+        try:
+            return self._ref.transaction(transaction_update)
+        finally:
+            self._invalidate(self._parts)
@@ -0,0 +1,233 @@
+import re
+import firebase
+from fanout import Fanout
+from migrations import BatchWriter, iter_folder_owners, iter_folder_items
+from mailstore import FOLDERS, read_keys
+
+# Per-user inverted index for mailbox search, stored under search_index/<user_key>:
+#   terms/<token>/<mail_id> = {"f": folder, "w": weight}   postings
+#   vocab/<token>           = True                        term list for prefix lookups
+#   docs/<mail_id>          = {"f": folder, "t": {token: weight}}
+# `docs` remembers what a message was indexed under so it can be removed again
+# without reading the message. Writers return path -> value updates so they can
+# go out in the same multi-path update as the message itself.
+
+# Weight of a token by the field it was found in; a message scores the sum
+FIELD_WEIGHTS = (("subject", 3), ("sender", 2), ("receiver", 2), ("message", 1))
+MAX_TOKENS_PER_MAIL = 300
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 40
+
+# A prefix expands to at most this many vocabulary terms
+MAX_PREFIX_TERMS = 20
+# Postings read per term, newest mail first; older matches of very common
+# terms are not searched
+MAX_POSTINGS_PER_TERM = 1000
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Lowercase alphanumeric tokens of `text` (duplicates kept)"""
+    return [
+        token for token in TOKEN_PATTERN.findall((text or "").lower())
+        if MIN_TOKEN_LENGTH <= len(token) <= MAX_TOKEN_LENGTH
+    ]
+
+
+def mail_tokens(mail):
+    """token -> weight for one message; addresses are indexed by their local part"""
+    weights = {}
+    for field, weight in FIELD_WEIGHTS:
+        value = mail.get(field) or ""
+        if field in ("sender", "receiver"):
+            value = value.split("@")[0]
+        for token in set(tokenize(value)):
+            weights[token] = weights.get(token, 0) + weight
+    if len(weights) > MAX_TOKENS_PER_MAIL:
+        # Keep the strongest tokens of very long messages
+        strongest = sorted(weights.items(), key=lambda item: (-item[1], item[0]))[:MAX_TOKENS_PER_MAIL]
+        weights = dict(strongest)
+    return weights
+
+
+def _index_path(user_key, *parts):
+    return "/".join(("search_index", user_key) + parts)
+
+
+def index_updates(user_key, folder, mail_id, mail):
+    """Updates that add one message to its owner's index
+
+    Use for new messages only; re-indexing an edited message needs
+    unindex_updates() first so tokens that disappeared are dropped.
+    """
+    weights = mail_tokens(mail)
+    updates = {_index_path(user_key, "docs", mail_id): {"f": folder, "t": weights} if weights else None}
+    for token, weight in weights.items():
+        updates[_index_path(user_key, "terms", token, mail_id)] = {"f": folder, "w": weight}
+        updates[_index_path(user_key, "vocab", token)] = True
+    return updates
+
+
+def _doc_removals(user_key, mail_id, doc):
+    if not isinstance(doc, dict):
+        return {}
+    updates = {_index_path(user_key, "docs", mail_id): None}
+    for token in doc.get("t") or {}:
+        # Vocabulary entries are left behind and cleaned up lazily by search_mail()
+        updates[_index_path(user_key, "terms", token, mail_id)] = None
+    return updates
+
+
+def unindex_updates(user_key, mail_id):
+    """Updates that remove one message from the index (one read of its docs entry)"""
+    doc = firebase.ref.child("search_index").child(user_key).child("docs").child(mail_id).get()
+    return _doc_removals(user_key, mail_id, doc)
+
+
+def unindex_many_updates(user_key, mail_ids):
+    """Updates that remove several messages from the index (one keyed read of their docs)"""
+    docs = read_keys(firebase.ref.child("search_index").child(user_key).child("docs"), mail_ids)
+    updates = {}
+    for mail_id, doc in docs.items():
+        updates.update(_doc_removals(user_key, mail_id, doc))
+    return updates
+
+
+def reindex_updates(user_key, folder, mail_id, mail):
+    """Updates that replace the indexed content of an edited message (e.g. a draft)"""
+    updates = unindex_updates(user_key, mail_id)
+    updates.update(index_updates(user_key, folder, mail_id, mail))
+    return updates
+
+
+def write_index_updates(updates):
+    """Apply index updates in one round trip; a failed index write never fails the request"""
+    if not updates:
+        return
+    try:
+        firebase.ref.update(updates)
+    except Exception as e:
+        print(f"Error updating search index: {e}")
+
+
+def _expand_prefix(index_ref, prefix):
+    """Vocabulary terms starting with `prefix`"""
+    terms = index_ref.child("vocab").order_by_key().start_at(prefix) \
+        .end_at(prefix + "\uf8ff").limit_to_first(MAX_PREFIX_TERMS).get() or {}
+    return list(terms)
+
+
+def _read_postings(index_ref, term):
+    return index_ref.child("terms").child(term).order_by_key().limit_to_last(MAX_POSTINGS_PER_TERM).get() or {}
+
+
+def _postings(terms, entries_by_term):
+    """mail_id -> (folder, weight) over the postings of `terms`, keeping the best weight"""
+    postings = {}
+    for term in terms:
+        for mail_id, entry in entries_by_term[term].items():
+            folder, weight = entry.get("f"), entry.get("w", 1)
+            previous = postings.get(mail_id)
+            if previous is None or weight > previous[1]:
+                postings[mail_id] = (folder, weight)
+    return postings
+
+
+def search_mail(user_key, query, folders=FOLDERS, limit=50):
+    """Ranked [(folder, mail_id, score)] of the messages matching every token of `query`
+
+    The last token matches as a prefix (search-as-you-type), the others as
+    whole tokens; a trailing "*" makes any token a prefix. Ties are broken by
+    mail id, which puts newer push keys first.
+    """
+    tokens = []
+    for raw in (query or "").lower().split():
+        is_prefix = raw.endswith("*")
+        parts = tokenize(raw)
+        for i, token in enumerate(parts):
+            tokens.append((token, is_prefix and i == len(parts) - 1))
+    if not tokens:
+        return []
+    last_token, _ = tokens[-1]
+    tokens[-1] = (last_token, True)
+
+    # Two rounds of concurrent reads: the prefix expansions, then the posting
+    # lists of every term (this uses Fanout, so it must not run in a Fanout call)
+    index_ref = firebase.ref.child("search_index").child(user_key)
+    expansions = Fanout()
+    for token, is_prefix in tokens:
+        if is_prefix:
+            expansions.submit(token, _expand_prefix, index_ref, token, label="search:vocab")
+    terms_of = [
+        (token, expansions.result(token) if is_prefix else [token])
+        for token, is_prefix in tokens
+    ]
+    reads = Fanout()
+    for term in dict.fromkeys(term for _, terms in terms_of for term in terms):
+        reads.submit(term, _read_postings, index_ref, term, label="search:terms")
+    entries_by_term = reads.results()
+
+    stale = [term for term, entries in entries_by_term.items() if not entries]
+    if stale:
+        # Every message under these terms has been deleted
+        try:
+            index_ref.child("vocab").update({term: None for term in stale})
+        except Exception as e:
+            print(f"Error cleaning search vocabulary: {e}")
+
+    scores = None
+    for token, terms in terms_of:
+        postings = _postings(terms, entries_by_term)
+        if scores is None:
+            scores = postings
+        else:
+            scores = {
+                mail_id: (folder, weight + postings[mail_id][1])
+                for mail_id, (folder, weight) in scores.items() if mail_id in postings
+            }
+        if not scores:
+            return []
+
+    hits = [(folder, mail_id, score) for mail_id, (folder, score) in scores.items() if folder in folders]
+    hits.sort(key=lambda hit: hit[1], reverse=True)
+    hits.sort(key=lambda hit: hit[2], reverse=True)
+    return hits[:limit]
+
+
+def rebuild_search_index(user_key=None, batch_size=500, dry_run=False, log=print):
+    """Drop and rebuild the search index of one user (or everyone) from the mail folders"""
+    writer = BatchWriter(batch_size, dry_run)
+    if user_key:
+        owners = [user_key]
+    else:
+        owners = sorted(set(owner for folder in FOLDERS for owner in iter_folder_owners(folder)))
+
+    indexed = 0
+    for owner in owners:
+        if not dry_run:
+            firebase.ref.child("search_index").child(owner).delete()
+        for folder in FOLDERS:
+            for mail_id, mail in iter_folder_items(folder, owner):
+                for path, value in index_updates(owner, folder, mail_id, mail).items():
+                    writer.set(path, value)
+                indexed += 1
+        # Flush per user so a failure leaves at most one user half indexed
+        writer.flush()
+        log(f"search_index/{owner} rebuilt ({indexed} messages indexed so far)")
+
+    if not user_key:
+        # Indexes of users that no longer own any mail
+        existing = firebase.ref.child("search_index").get(shallow=True) or {}
+        for owner in set(existing) - set(owners):
+            if not dry_run:
+                firebase.ref.child("search_index").child(owner).delete()
+            log(f"search_index/{owner} removed (no mail)")
+
+    return {
+        'users': len(owners),
+        'indexed': indexed,
+        'written': writer.written,
+        'batches': writer.batches,
+        'dry_run': dry_run
+    }
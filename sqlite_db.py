@@ -0,0 +1,450 @@
+# SQLite implementation of the firebase_admin Realtime Database API the app
+# uses (the same surface as memory_db), for single-node deployments and for
+# tests that need the data to survive a restart. Select it with
+# FIREBASE_BACKEND=sqlite; the file is SQLITE_DB_PATH (see firebase.py).
+#
+# The JSON tree is stored as records, one row per (parent path, key):
+#   users/<key>, inbox/<user_key>/<mail_id>, changes/<user_key>/<change_id>, ...
+# RECORD_DEPTH says how deep below each top-level node the records sit.
+# Reading a record, or anything inside one, is a primary key lookup; reading a
+# node above the records is one range scan over their parent paths. Queries on
+# a node whose children are records run as SQL - ordered by key on the primary
+# key and ordered by timestamp_ms on an expression index - so paging a folder
+# or asking for mail newer than some point never loads the whole folder.
+import json
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from memory_db import PushIds, order_items
+
+# Depth of the records below a path prefix ("*" matches any key); the longest
+# matching prefix wins. Values above the record depth that are not objects
+# (e.g. search_index/<user>/vocab/<term> = true) are stored as records too.
+RECORD_DEPTH = {
+    ("users",): 2,
+    ("user_directory",): 2,
+    ("avatars",): 2,
+    ("notifications",): 2,
+    ("jobs",): 2,
+    ("inbox",): 3,
+    ("sent",): 3,
+    ("drafts",): 3,
+    ("changes",): 3,
+    ("mail_index",): 3,
+    ("mail_attachments",): 3,
+    ("attachment_refs",): 3,
+    ("deliveries",): 4,
+    ("search_index",): 4,
+    # One row per posting, so indexing a message does not rewrite whole posting lists
+    ("search_index", "*", "terms"): 5
+}
+DEFAULT_RECORD_DEPTH = 2
+
+# Children can be ordered in SQL by these paths (a JSON path is built from them)
+CHILD_PATH_PATTERN = re.compile(r"^[A-Za-z0-9_]+(/[A-Za-z0-9_]+)*$")
+# Must match the expressions of the indexes below for the planner to use them
+TIMESTAMP_COLUMN = "json_extract(value, '$.timestamp_ms')"
+# Firebase key order: keys that are 32-bit integers first, numerically, then
+# the others as strings. Same text as key_order() builds for query bounds.
+KEY_ORDER_COLUMN = (
+    "(CASE WHEN CAST(CAST(key AS INTEGER) AS TEXT) = key"
+    " AND CAST(key AS INTEGER) BETWEEN -2147483648 AND 2147483647"
+    " THEN printf('0%010d', CAST(key AS INTEGER) + 2147483648) ELSE '1' || key END)"
+)
+MAX_KEYS_PER_QUERY = 500
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS nodes (
+        parent TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (parent, key))""",
+    f"CREATE INDEX IF NOT EXISTS nodes_key_order ON nodes (parent, {KEY_ORDER_COLUMN})",
+    # Replaced by nodes_timestamp_order, which breaks ties in key order
+    "DROP INDEX IF EXISTS nodes_timestamp",
+    f"CREATE INDEX IF NOT EXISTS nodes_timestamp_order ON nodes (parent, {TIMESTAMP_COLUMN}, {KEY_ORDER_COLUMN})"
+)
+
+
+def _split(path):
+    return [p for p in str(path or '').split('/') if p]
+
+
+def _join(parts):
+    return '/'.join(parts)
+
+
+def record_depth(parts):
+    depth, matched = DEFAULT_RECORD_DEPTH, 0
+    for prefix, prefix_depth in RECORD_DEPTH.items():
+        if matched < len(prefix) <= len(parts) and all(p in ("*", q) for p, q in zip(prefix, parts)):
+            depth, matched = prefix_depth, len(prefix)
+    return depth
+
+
+def _clean(value):
+    """Drop nulls and empty objects, like Firebase does; None if nothing is left"""
+    if isinstance(value, dict):
+        cleaned = {}
+        for key, child in value.items():
+            child = _clean(child)
+            if child is not None:
+                cleaned[str(key)] = child
+        return cleaned or None
+    return value
+
+
+def key_order(key):
+    """The value of KEY_ORDER_COLUMN for `key`"""
+    key = str(key)
+    try:
+        number = int(key)
+    except ValueError:
+        number = None
+    if number is not None and str(number) == key and -2 ** 31 <= number < 2 ** 31:
+        return "0%010d" % (number + 2 ** 31)
+    return "1" + key
+
+
+def _order_column(order_by):
+    if order_by == '$key':
+        return KEY_ORDER_COLUMN
+    if order_by == '$value':
+        return "json_extract(value, '$')"
+    if CHILD_PATH_PATTERN.match(order_by):
+        return f"json_extract(value, '$.{order_by.replace('/', '.')}')"
+    return None
+
+
+def _children_are_records(parts):
+    return record_depth(parts + ["*"]) == len(parts) + 1
+
+
+class SQLiteDatabase:
+    """The tree in one SQLite file; one connection per thread, `calls` counts round trips"""
+
+    def __init__(self, path):
+        if path == ":memory:":
+            # Every thread would get its own empty database
+            raise ValueError("SQLite backend needs a file; use FIREBASE_BACKEND=memory for an in-memory database")
+        self.path = path
+        self.calls = 0
+        self._local = threading.local()
+        self._push_ids = PushIds()
+        with self.transaction(write=True) as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+    def push_id(self):
+        return self._push_ids.next()
+
+    def connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def transaction(self, write=False):
+        """A connection inside a transaction; write=True takes the write lock up front"""
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _tick(self):
+        self.calls += 1
+
+
+# ---------------- Tree operations (inside a transaction) ----------------
+
+def _lookup(db, parts):
+    """(depth, value) of the record at `parts` or above it, None if there is none"""
+    depth = min(len(parts), record_depth(parts))
+    if not depth:
+        return None
+    clauses = " OR ".join(["(parent = ? AND key = ?)"] * depth)
+    params = []
+    for i in range(depth):
+        params += [_join(parts[:i]), parts[i]]
+    row = db.execute(f"SELECT parent, key, value FROM nodes WHERE {clauses}", params).fetchone()
+    if row is None:
+        return None
+    parent, key, value = row
+    return len(_split(parent)) + 1, json.loads(value)
+
+
+def _descendants(db, parts):
+    """[(path relative to `parts`, value)] of the records below `parts`"""
+    if not parts:
+        rows = db.execute("SELECT parent, key, value FROM nodes")
+    else:
+        prefix = _join(parts)
+        # "0" is the character after "/", so the range holds exactly the paths below prefix/
+        rows = db.execute(
+            "SELECT parent, key, value FROM nodes WHERE parent = ? "
+            "UNION ALL SELECT parent, key, value FROM nodes WHERE parent >= ? AND parent < ?",
+            (prefix, prefix + "/", prefix + "0"))
+    return [(_split(parent)[len(parts):] + [key], json.loads(value)) for parent, key, value in rows]
+
+
+def _child_keys(db, parts):
+    prefix = _join(parts)
+    keys = [key for key, in db.execute("SELECT key FROM nodes WHERE parent = ?", (prefix,))]
+    if parts:
+        parents = db.execute("SELECT DISTINCT parent FROM nodes WHERE parent >= ? AND parent < ?",
+                             (prefix + "/", prefix + "0"))
+    else:
+        parents = db.execute("SELECT DISTINCT parent FROM nodes WHERE parent != ''")
+    keys += [_split(parent)[len(parts)] for parent, in parents]
+    return {key: True for key in keys}
+
+
+def _read(db, parts, shallow=False):
+    found = _lookup(db, parts)
+    if found:
+        depth, value = found
+        for p in parts[depth:]:
+            value = value.get(p) if isinstance(value, dict) else None
+        if shallow and isinstance(value, dict):
+            return {key: True for key in value}
+        return value
+    if parts and len(parts) >= record_depth(parts):
+        return None
+    if shallow:
+        return _child_keys(db, parts) or None
+    tree = {}
+    for path, value in _descendants(db, parts):
+        node = tree
+        for p in path[:-1]:
+            node = node.setdefault(p, {})
+        node[path[-1]] = value
+    return tree or None
+
+
+def _delete_tree(db, parts):
+    if not parts:
+        db.execute("DELETE FROM nodes")
+        return
+    prefix = _join(parts)
+    db.execute("DELETE FROM nodes WHERE parent = ? AND key = ?", (_join(parts[:-1]), parts[-1]))
+    db.execute("DELETE FROM nodes WHERE parent = ?", (prefix,))
+    db.execute("DELETE FROM nodes WHERE parent >= ? AND parent < ?", (prefix + "/", prefix + "0"))
+
+
+def _flatten(parts, value, rows):
+    if isinstance(value, dict) and len(parts) < record_depth(parts):
+        for key, child in value.items():
+            _flatten(parts + [key], child, rows)
+    elif parts:
+        rows.append((_join(parts[:-1]), parts[-1], json.dumps(value)))
+
+
+def _write(db, parts, value):
+    """Set (or with None, delete) the value at `parts`"""
+    value = _clean(value)
+    depth = record_depth(parts)
+    if len(parts) > depth:
+        # Inside a record: read, modify and write back that one row
+        found = _lookup(db, parts)
+        record = {}
+        if found:
+            found_depth, current = found
+            if found_depth == depth and isinstance(current, dict):
+                record = current
+            elif value is None:
+                return
+            else:
+                # A plain value above the path is replaced by an object
+                _delete_tree(db, parts[:found_depth])
+        elif value is None:
+            return
+        node = record
+        for p in parts[depth:-1]:
+            if not isinstance(node.get(p), dict):
+                node[p] = {}
+            node = node[p]
+        node[parts[-1]] = value
+        record = _clean(record)
+        row = (_join(parts[:depth - 1]), parts[depth - 1])
+        if record is None:
+            db.execute("DELETE FROM nodes WHERE parent = ? AND key = ?", row)
+        else:
+            db.execute("INSERT OR REPLACE INTO nodes (parent, key, value) VALUES (?, ?, ?)",
+                       row + (json.dumps(record),))
+        return
+    if value is not None:
+        # Plain values above the path are replaced by the objects leading to it
+        for i in range(1, len(parts)):
+            db.execute("DELETE FROM nodes WHERE parent = ? AND key = ?", (_join(parts[:i - 1]), parts[i - 1]))
+    _delete_tree(db, parts)
+    if value is not None:
+        rows = []
+        _flatten(parts, value, rows)
+        db.executemany("INSERT INTO nodes (parent, key, value) VALUES (?, ?, ?)", rows)
+
+
+class Reference:
+    """Mirror of firebase_admin.db.Reference"""
+
+    def __init__(self, db, parts):
+        self._db = db
+        self._parts = parts
+
+    @property
+    def key(self):
+        return self._parts[-1] if self._parts else None
+
+    @property
+    def path(self):
+        return '/' + _join(self._parts)
+
+    def child(self, path):
+        return Reference(self._db, self._parts + _split(path))
+
+    def get(self, etag=False, shallow=False):
+        self._db._tick()
+        with self._db.transaction() as db:
+            return _read(db, self._parts, shallow)
+
+    def get_children(self, keys, shallow=False):
+        """{key: value} of the given children that exist, one indexed query per 500 keys
+
+        Not part of the firebase_admin API; used by storage.SQLiteMailStorage.
+        With shallow=True only the keys are read ({key: True}).
+        """
+        keys = list(dict.fromkeys(keys))
+        self._db._tick()
+        with self._db.transaction() as db:
+            if not _children_are_records(self._parts):
+                data = _read(db, self._parts, shallow)
+                return {key: data[key] for key in keys if isinstance(data, dict) and key in data}
+            found = {}
+            column = "'true'" if shallow else "value"
+            for i in range(0, len(keys), MAX_KEYS_PER_QUERY):
+                chunk = keys[i:i + MAX_KEYS_PER_QUERY]
+                rows = db.execute(
+                    f"SELECT key, {column} FROM nodes WHERE parent = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [_join(self._parts)] + chunk)
+                found.update((key, json.loads(value)) for key, value in rows)
+            return found
+
+    def set(self, value):
+        self._db._tick()
+        value = json.loads(json.dumps(value))
+        with self._db.transaction(write=True) as db:
+            _write(db, self._parts, value)
+
+    def update(self, value):
+        if not value or not isinstance(value, dict):
+            raise ValueError('Value argument must be a non-empty dictionary.')
+        self._db._tick()
+        value = json.loads(json.dumps(value))
+        # All paths in one transaction: the update is applied completely or not at all
+        with self._db.transaction(write=True) as db:
+            for path, v in value.items():
+                _write(db, self._parts + _split(path), v)
+
+    def push(self, value=''):
+        ref = self.child(self._db.push_id())
+        ref.set(value)
+        return ref
+
+    def delete(self):
+        self._db._tick()
+        with self._db.transaction(write=True) as db:
+            _write(db, self._parts, None)
+
+    def transaction(self, transaction_update):
+        self._db._tick()
+        with self._db.transaction(write=True) as db:
+            new = transaction_update(_read(db, self._parts))
+            _write(db, self._parts, json.loads(json.dumps(new)))
+            return new
+
+    def order_by_key(self):
+        return Query(self, '$key')
+
+    def order_by_child(self, path):
+        return Query(self, path)
+
+    def order_by_value(self):
+        return Query(self, '$value')
+
+
+class Query:
+    """Mirror of firebase_admin.db.Query; bounds are inclusive like Firebase's
+
+    Runs as SQL when the children of the node are records and the order is
+    by key, value or a plain child path; otherwise the node is read and
+    ordered like memory_db does.
+    """
+
+    def __init__(self, ref, order_by):
+        self._ref = ref
+        self._order_by = order_by
+        self._start = None
+        self._end = None
+        self._first = None
+        self._last = None
+
+    def start_at(self, start):
+        self._start = start
+        return self
+
+    def end_at(self, end):
+        self._end = end
+        return self
+
+    def equal_to(self, value):
+        self._start = self._end = value
+        return self
+
+    def limit_to_first(self, n):
+        self._first = n
+        return self
+
+    def limit_to_last(self, n):
+        self._last = n
+        return self
+
+    def _select(self, db, column):
+        sql = "SELECT key, value FROM nodes WHERE parent = ?"
+        params = [_join(self._ref._parts)]
+        for bound, op in ((self._start, ">="), (self._end, "<=")):
+            if bound is not None:
+                sql += f" AND {column} {op} ?"
+                params.append(key_order(bound) if column == KEY_ORDER_COLUMN else bound)
+        direction = "DESC" if self._last is not None else "ASC"
+        sql += f" ORDER BY {column} {direction}"
+        if column != KEY_ORDER_COLUMN:
+            sql += f", {KEY_ORDER_COLUMN} {direction}"
+        limit = self._last if self._last is not None else self._first
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        rows = db.execute(sql, params).fetchall()
+        if self._last is not None:
+            rows.reverse()
+        return OrderedDict((key, json.loads(value)) for key, value in rows)
+
+    def get(self):
+        self._ref._db._tick()
+        column = _order_column(self._order_by)
+        with self._ref._db.transaction() as db:
+            if column and _children_are_records(self._ref._parts):
+                return self._select(db, column)
+            data = _read(db, self._ref._parts)
+        if not isinstance(data, dict):
+            return data
+        items = order_items(data, self._order_by, self._start, self._end, self._first, self._last)
+        return OrderedDict(items)
@@ -136,7 +136,7 @@ self.addEventListener('notificationclick', function(event) {
   let urlToOpen = event.notification.data?.url || '/inbox';
   
   if (event.notification.data?.mailId) {
-    urlToOpen = `/read/${event.notification.data.mailId}`;
+    urlToOpen = `/read/${event.notification.data.mailId}?folder=inbox`;
   }
 
   event.waitUntil(
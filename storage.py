@@ -0,0 +1,185 @@
+import firebase
+from attachments import release_updates, schedule_sweep
+from changelog import change_updates, record_changes, publish_changes
+from delivery import deliver_mail
+from fanout import Fanout
+from mailindex import location_updates, message_locations, message_folders
+from mailstore import FOLDERS, fetch_folder_page, fetch_messages, fetch_messages_after
+from search import reindex_updates, unindex_many_updates, write_index_updates
+
+# Typed operations on users and mailboxes.
+# Routes call these instead of composing database paths, so every access
+# pattern is written once and each backend answers it the way it is best at:
+#   MailStorage       - any Realtime Database style reference (Firebase or the
+#                       in-memory database): keyed and ordered queries, reads
+#                       of independent nodes in parallel, one multi-path
+#                       update per write
+#   SQLiteMailStorage - FIREBASE_BACKEND=sqlite: lookups of many keys are one
+#                       indexed query instead of one read per key, and
+#                       messages are located without the mail index
+# Users are addressed by key (the email with "." replaced by ","); messages
+# come back as dicts with their `id` set.
+
+
+class MailStorage:
+    # ---------------- Users ----------------
+    def get_user(self, user_key):
+        """The user record, or None"""
+        return firebase.ref.child("users").child(user_key).get()
+
+    def get_users(self, user_keys):
+        """{user_key: record or None}, all read at once"""
+        reads = Fanout()
+        for user_key in set(user_keys):
+            reads.submit(user_key, self.get_user, user_key, label="users")
+        return reads.results()
+
+    def user_exists(self, user_key):
+        return bool(firebase.ref.child("users").child(user_key).get(shallow=True))
+
+    def create_user(self, user_key, record):
+        firebase.ref.child("users").child(user_key).set(record)
+
+    def update_user(self, user_key, fields):
+        """Change some fields of a user record (None removes a field)"""
+        firebase.ref.child("users").child(user_key).update(fields)
+
+    def delete_user(self, user_key):
+        """Remove the user record; the mail is removed by accounts.delete_account_data"""
+        firebase.ref.child("users").child(user_key).delete()
+
+    # ---------------- Mailboxes ----------------
+    def folder_page(self, folder, user_key, limit=None, before=None, after=None):
+        """One window of a folder, newest first (see mailstore.fetch_folder_page)"""
+        return fetch_folder_page(folder, user_key, limit, before=before, after=after)
+
+    def messages_after(self, folder, user_key, after_key, limit=None):
+        """(messages, has_more) added to inbox or sent after `after_key`, oldest first"""
+        return fetch_messages_after(folder, user_key, after_key, limit)
+
+    def get_message(self, folder, user_key, mail_id):
+        mail = firebase.ref.child(folder).child(user_key).child(mail_id).get()
+        if not isinstance(mail, dict):
+            return None
+        mail['id'] = mail_id
+        return mail
+
+    def get_messages(self, folder, user_key, mail_ids):
+        """The given messages of one folder that exist, in the order of `mail_ids`"""
+        return fetch_messages(folder, user_key, mail_ids)
+
+    def find_message(self, user_key, mail_id, folder=None):
+        """(folder, message) of a message of the user, or (None, None)
+
+        `folder` is where the caller expects the message (the list it was
+        opened from) and is read first. Otherwise the mail index says which
+        folder to read; inbox wins over sent over drafts.
+        """
+        if folder in FOLDERS:
+            mail = self.get_message(folder, user_key, mail_id)
+            if mail:
+                return folder, mail
+        for found_in in self.message_folders(user_key, mail_id):
+            if found_in == folder:
+                continue
+            mail = self.get_message(found_in, user_key, mail_id)
+            if mail:
+                return found_in, mail
+        return None, None
+
+    def message_folders(self, user_key, mail_id):
+        """Folders holding one message of the user, in FOLDERS order"""
+        return message_folders(user_key, mail_id)
+
+    def locate_messages(self, user_key, mail_ids):
+        """{mail_id: [folders]} for the given ids; ids found nowhere map to []"""
+        return message_locations(user_key, mail_ids)
+
+    def list_drafts(self, user_key):
+        """{draft_id: draft}"""
+        return firebase.ref.child("drafts").child(user_key).get() or {}
+
+    def save_draft(self, user_key, draft_id, draft):
+        """Create or overwrite a draft and keep the change log and indexes in step"""
+        firebase.ref.child("drafts").child(user_key).child(draft_id).set(draft)
+        record_changes(change_updates(user_key, "put", "drafts", draft_id))
+        write_index_updates({
+            **reindex_updates(user_key, "drafts", draft_id, draft),
+            **location_updates(user_key, "drafts", draft_id)
+        })
+
+    def deliver(self, mail_data):
+        """Store a new message for its receiver and sender; returns (inbox_id, sent_id)"""
+        return deliver_mail(mail_data)
+
+    def delete_messages(self, user_key, mail_ids):
+        """Delete messages of a user from whichever folders hold them
+
+        Messages, their index entries, attachment references and the change
+        log tombstones go out in one multi-path update. Returns
+        {'deleted': {folder: count}, 'found': [ids], 'not_found': [ids]}.
+        """
+        locations = self.locate_messages(user_key, mail_ids)
+        deleted = {folder: 0 for folder in FOLDERS}
+        updates = {}
+        tombstones = {}
+        found = [mail_id for mail_id, folders in locations.items() if folders]
+        for mail_id in found:
+            for folder in locations[mail_id]:
+                updates[f"{folder}/{user_key}/{mail_id}"] = None
+                updates.update(location_updates(user_key, folder, mail_id, present=False))
+                deleted[folder] += 1
+            # Tombstones so other open clients drop the messages on their next sync
+            tombstones.update(change_updates(user_key, "delete", None, mail_id))
+        updates.update(unindex_many_updates(user_key, found))
+        updates.update(release_updates(user_key, found))
+        updates.update(tombstones)
+
+        if updates:
+            firebase.ref.update(updates)
+            publish_changes(tombstones)
+            schedule_sweep()
+        return {
+            'deleted': deleted,
+            'found': found,
+            'not_found': [mail_id for mail_id, folders in locations.items() if not folders]
+        }
+
+
+class SQLiteMailStorage(MailStorage):
+    """Multi-key lookups as single queries on the (parent, key) primary key"""
+
+    def get_users(self, user_keys):
+        user_keys = list(dict.fromkeys(user_keys))
+        found = firebase.ref.child("users").get_children(user_keys)
+        return {user_key: found.get(user_key) for user_key in user_keys}
+
+    def get_messages(self, folder, user_key, mail_ids):
+        found = firebase.ref.child(folder).child(user_key).get_children(mail_ids)
+        messages = []
+        for mail_id in dict.fromkeys(mail_ids):
+            mail = found.get(mail_id)
+            if isinstance(mail, dict):
+                mail['id'] = mail_id
+                messages.append(mail)
+        return messages
+
+    def locate_messages(self, user_key, mail_ids):
+        # The folders themselves are indexed by id, so the mail index is not needed
+        present = {
+            folder: firebase.ref.child(folder).child(user_key).get_children(mail_ids, shallow=True)
+            for folder in FOLDERS
+        }
+        return {
+            mail_id: [folder for folder in FOLDERS if mail_id in present[folder]]
+            for mail_id in dict.fromkeys(mail_ids)
+        }
+
+
+def default_storage():
+    if firebase.BACKEND == "sqlite":
+        return SQLiteMailStorage()
+    return MailStorage()
+
+
+storage = default_storage()
@@ -0,0 +1,93 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+os.environ['FIREBASE_BACKEND'] = 'memory'
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+os.environ.setdefault('NOTIFY_WORKERS', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import firebase
+import memory_db
+import sqlite_db
+from attachments import release_updates
+from metrics import InstrumentedReference
+from search import search_mail, unindex_many_updates
+from storage import storage
+
+ALICE = "alice@bharatmail.in"
+BOB = "bob@bharatmail.in"
+DIGEST = "ab" * 32
+
+
+def mail(sender, receiver, subject):
+    return {
+        'sender': sender, 'receiver': receiver, 'subject': subject,
+        'message': "quarterly numbers", 'cc': '', 'bcc': '',
+        'attachments': [{'hash': DIGEST, 'name': "report.pdf", 'size': 3, 'type': "application/pdf"}],
+        'timestamp': "2026-01-01 10:00:00", 'timestamp_ms': 1767261600000
+    }
+
+
+class MixedKeyDeleteTest(unittest.TestCase):
+    """Draft ids are integer-like and sort before push keys in Firebase key order"""
+
+    def connect(self):
+        self.database = memory_db.MemoryDatabase()
+        return memory_db.Reference(self.database, [])
+
+    def setUp(self):
+        firebase.ref = InstrumentedReference(self.connect())
+        self.user_key = ALICE.replace(".", ",")
+        self.inbox_id, _ = storage.deliver(mail(BOB, ALICE, "quarterly report"))
+        _, self.sent_id = storage.deliver(mail(ALICE, BOB, "quarterly reply"))
+        self.draft_id = "123456"
+        storage.save_draft(self.user_key, self.draft_id, {**mail(ALICE, BOB, "quarterly draft"), 'attachments': []})
+        self.mail_ids = [self.draft_id, self.inbox_id, self.sent_id]
+
+    def node(self, *parts):
+        return firebase.ref.child("/".join(parts)).get()
+
+    def test_key_ranges_put_integer_keys_first(self):
+        inbox = firebase.ref.child("inbox").child(self.user_key)
+        inbox.child("9").set({'subject': "legacy"})
+        self.assertEqual(list(inbox.order_by_key().get()), ["9", self.inbox_id])
+        self.assertEqual(list(inbox.order_by_key().start_at("9").end_at(self.inbox_id).get()), ["9", self.inbox_id])
+        self.assertEqual(list(inbox.order_by_key().limit_to_last(1).get()), [self.inbox_id])
+
+    def test_unindex_many_updates_covers_drafts_and_push_keys(self):
+        updates = unindex_many_updates(self.user_key, self.mail_ids)
+        for mail_id in self.mail_ids:
+            self.assertIn(f"search_index/{self.user_key}/docs/{mail_id}", updates)
+
+    def test_release_updates_covers_push_keys_next_to_drafts(self):
+        updates = release_updates(self.user_key, self.mail_ids)
+        self.assertIn(f"attachment_refs/{DIGEST}/{self.user_key}:inbox:{self.inbox_id}", updates)
+        self.assertIn(f"attachment_refs/{DIGEST}/{self.user_key}:sent:{self.sent_id}", updates)
+
+    def test_bulk_delete_releases_index_and_attachments(self):
+        result = storage.delete_messages(self.user_key, self.mail_ids)
+        self.assertEqual(sorted(result['found']), sorted(self.mail_ids))
+        self.assertEqual(result['deleted'], {'inbox': 1, 'sent': 1, 'drafts': 1})
+
+        self.assertEqual(search_mail(self.user_key, "quarterly"), [])
+        self.assertFalse(self.node("search_index", self.user_key, "docs"))
+        self.assertFalse(self.node("search_index", self.user_key, "terms"))
+        self.assertFalse(self.node("mail_attachments", self.user_key))
+        refs = self.node("attachment_refs", DIGEST) or {}
+        self.assertFalse([ref for ref in refs if ref.startswith(self.user_key + ":")])
+
+
+class SQLiteMixedKeyDeleteTest(MixedKeyDeleteTest):
+    """Same on the SQLite backend, whose key ranges must match Firebase key order"""
+
+    def connect(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return sqlite_db.Reference(sqlite_db.SQLiteDatabase(os.path.join(directory, "test.sqlite3")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+os.environ['FIREBASE_BACKEND'] = 'memory'
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+os.environ.setdefault('NOTIFY_WORKERS', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import firebase
+import memory_db
+import sqlite_db
+from delivery import deliver_mail
+from search import search_mail
+
+ALICE = "alice@bharatmail.in"
+BOB = "bob@bharatmail.in"
+DIGEST = "cd" * 32
+
+
+def mail(sender, receiver, subject):
+    return {
+        'sender': sender, 'receiver': receiver, 'subject': subject,
+        'message': "see attached", 'cc': '', 'bcc': '',
+        'attachments': [{'hash': DIGEST, 'name': "notes.txt", 'size': 5, 'type': "text/plain"}],
+        'timestamp': "2026-01-01 10:00:00", 'timestamp_ms': 1767261600000
+    }
+
+
+class DeliveryTest(unittest.TestCase):
+    """A message and everything recorded about it go out in one multi-path write"""
+
+    def connect(self):
+        self.database = memory_db.MemoryDatabase()
+        return memory_db.Reference(self.database, [])
+
+    def setUp(self):
+        firebase.ref = self.connect()
+        self.alice_key = ALICE.replace(".", ",")
+        self.bob_key = BOB.replace(".", ",")
+
+    def node(self, *parts):
+        return firebase.ref.child("/".join(parts)).get()
+
+    def test_delivery_is_one_write(self):
+        calls = self.database.calls
+        inbox_id, sent_id = deliver_mail(mail(BOB, ALICE, "project notes"))
+        self.assertEqual(self.database.calls - calls, 1)
+
+        self.assertEqual(self.node("inbox", self.alice_key, inbox_id)['subject'], "project notes")
+        # The sent copy points at the receiver's copy
+        self.assertEqual(self.node("sent", self.bob_key, sent_id)['id'], inbox_id)
+        changes = list((self.node("changes", self.alice_key) or {}).values())
+        self.assertEqual([(c['op'], c['folder'], c['id']) for c in changes], [("put", "inbox", inbox_id)])
+        self.assertEqual(self.node("mail_index", self.alice_key, inbox_id), {'inbox': True})
+        self.assertEqual(self.node("mail_index", self.bob_key, sent_id), {'sent': True})
+        self.assertTrue(self.node("deliveries", self.bob_key, self.alice_key, inbox_id))
+        self.assertEqual(self.node("mail_attachments", self.alice_key, inbox_id), {DIGEST: "inbox"})
+        self.assertTrue(self.node("attachment_refs", DIGEST, f"{self.bob_key}:sent:{sent_id}"))
+        self.assertEqual([hit[1] for hit in search_mail(self.alice_key, "project")], [inbox_id])
+
+    def test_failed_write_delivers_nothing(self):
+        broken = mail(BOB, ALICE, "project notes")
+        broken['headers'] = object()  # cannot be stored, fails the whole update
+        with self.assertRaises(TypeError):
+            deliver_mail(broken)
+        for root in ("inbox", "sent", "changes", "mail_index", "deliveries", "search_index",
+                     "mail_attachments", "attachment_refs"):
+            self.assertIsNone(self.node(root), root)
+
+
+class SQLiteDeliveryTest(DeliveryTest):
+    """Same on the SQLite backend, where the update is one transaction"""
+
+    def connect(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.database = sqlite_db.SQLiteDatabase(os.path.join(directory, "test.sqlite3"))
+        return sqlite_db.Reference(self.database, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ['FIREBASE_BACKEND'] = 'memory'
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+os.environ.setdefault('NOTIFY_WORKERS', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import changelog
+import firebase
+import memory_db
+import sqlite_db
+from changelog import (SYNC_SETTLE_MS, CHANGE_RETENTION_MS, change_updates, initial_cursor, read_changes,
+                       summarize_changes)
+from mailstore import now_ms, push_key_floor
+from storage import storage
+
+ALICE = "alice@bharatmail.in"
+BOB = "bob@bharatmail.in"
+
+
+def mail(sender, receiver, subject):
+    return {
+        'sender': sender, 'receiver': receiver, 'subject': subject,
+        'message': "hello", 'cc': '', 'bcc': '', 'attachments': [],
+        'timestamp': "2026-01-01 10:00:00", 'timestamp_ms': 1767261600000
+    }
+
+
+class SyncCursorTest(unittest.TestCase):
+    """Cursors of /api/sync never skip a change, and deletes reach the client as tombstones"""
+
+    def connect(self):
+        return memory_db.Reference(memory_db.MemoryDatabase(), [])
+
+    def setUp(self):
+        firebase.ref = self.connect()
+        self.user_key = ALICE.replace(".", ",")
+        self.cursor = initial_cursor()
+
+    def sync(self):
+        changes, self.cursor, more, reset = read_changes(self.user_key, self.cursor)
+        self.assertFalse(reset)
+        return summarize_changes(changes), more
+
+    def test_delivered_mail_is_synced(self):
+        inbox_id, _ = storage.deliver(mail(BOB, ALICE, "one"))
+        (puts, deletes), more = self.sync()
+        self.assertEqual((puts, deletes, more), ([("inbox", inbox_id)], [], False))
+
+    def test_cursor_stays_behind_now(self):
+        storage.deliver(mail(BOB, ALICE, "one"))
+        self.sync()
+        self.assertLessEqual(self.cursor, push_key_floor(now_ms() - SYNC_SETTLE_MS))
+
+    def test_change_written_with_a_late_clock_is_not_skipped(self):
+        storage.deliver(mail(BOB, ALICE, "one"))
+        self.sync()
+        # Another worker whose clock is a second behind writes after this sync
+        with mock.patch("changelog.now_ms", return_value=now_ms() - 1000), \
+                mock.patch("mailstore.now_ms", return_value=now_ms() - 1000):
+            firebase.ref.update(change_updates(self.user_key, "put", "inbox", "late"))
+        (puts, _), _ = self.sync()
+        self.assertIn(("inbox", "late"), puts)
+
+    def test_deleted_mail_becomes_a_tombstone(self):
+        inbox_id, _ = storage.deliver(mail(BOB, ALICE, "one"))
+        storage.delete_messages(self.user_key, [inbox_id])
+        (puts, deletes), _ = self.sync()
+        # The put and the delete collapse into the delete
+        self.assertEqual((puts, deletes), ([], [(None, inbox_id)]))
+
+    def test_full_window_continues_where_it_stopped(self):
+        ids = [storage.deliver(mail(BOB, ALICE, f"mail {n}"))[0] for n in range(5)]
+        synced = []
+        with mock.patch.object(changelog, "MAX_CHANGES_PER_SYNC", 2):
+            more = True
+            while more:
+                (puts, _), more = self.sync()
+                synced.extend(mail_id for _, mail_id in puts)
+        self.assertEqual(synced, ids)
+
+    def test_expired_or_unknown_cursor_resets(self):
+        for cursor in ("not a cursor", push_key_floor(now_ms() - CHANGE_RETENTION_MS - 60000)):
+            _, new_cursor, _, reset = read_changes(self.user_key, cursor)
+            self.assertTrue(reset)
+            self.assertLessEqual(new_cursor, initial_cursor())
+
+
+class SQLiteSyncCursorTest(SyncCursorTest):
+    """Same on the SQLite backend"""
+
+    def connect(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return sqlite_db.Reference(sqlite_db.SQLiteDatabase(os.path.join(directory, "test.sqlite3")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()